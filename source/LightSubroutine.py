@@ -5,9 +5,10 @@ Created on Mon Mar 17 18:29:03 2014
 @author: ZELIG
 """
 import math
+import os
+import hashlib
 import numpy as np
-from light3d import compute_3D_light_matrix
-from read_in_ascii import read_in_ascii
+from light3d import build_ray_tables, arrows_list_to_array, RAY_TABLES_FORMAT
 
 def vec_scale(v, a):
     """
@@ -251,57 +252,51 @@ def prepare_actual_leaf_area_mat_from_dem(dem_mat, zsize, max_tree_ht):
     return actual_leaf_area_mat, dem_offset_index_mat
 
 
-if __name__ == '__main__':  #need this to run from commandline
-    from volume_slicer import VolumeSlicer
-
-    # define the plot size along the x,y, and z dimentions
-    # 10m by 10m by 1m
-    xsize, ysize, zsize = 10., 10., 1.
-    # the maximum height a tree can reach in m
-    MAX_TREE_HT = 50
-    # pre-compute the "arrows" that will be used to compute the light at every position in the actual leaf area matrix
-    arrows_list = build_arrows_list(xsize=xsize, ysize=ysize, zsize=zsize, PHIB=0.45, PHID=0.55)
-    # get the empty actual leaf area matrix that has been adjusted for the DEM
-    actual_leaf_area_mat, dem_offset_index_mat = prepare_actual_leaf_area_mat_from_dem(dem_ascii_filename='elevation10m.txt', 
-                                                             xsize=xsize,ysize=ysize,zsize=zsize, 
-                                                             max_tree_ht=MAX_TREE_HT)
-    #actual_leaf_area_mat[:,:,:] = 0.0
-    # Read in the radiation fraction matrix that is used to scale the proportion of radiation
-    # that is available to every location on the DEM at ground-level. This will be used to account for terrain shading.
-    # Same fraction used for top-of-canopy, since found no significant difference b/w the two.
-    radiation_fraction_mat = np.array(read_in_ascii(filename='radiationfraction_ascii.txt'), dtype=np.float)
-    rad_min = np.min(radiation_fraction_mat)
-    rad_max = np.max(radiation_fraction_mat) # the range is often very small, unless transect N-S?
-    print 'min rad = %s max rad = %s' %(rad_min, rad_max)
-
-    ## TEST
-    # put in a tree popsicle; to remove tree comment out the two lines below
-    px, py = 10, 10
-    actual_leaf_area_mat[px,py, dem_offset_index_mat[px,py]+30:-10] = 1e20  #that's one dense tree!
-    #px, py = 10, 11
-    #actual_leaf_area_mat[px,py, dem_offset_index_mat[px,py]+30:-10] = 100000.0
-    #px, py = 11, 10
-    #actual_leaf_area_mat[px,py, dem_offset_index_mat[px,py]+30:-10] = 100000.0
-    #px, py = 11, 11
-    #actual_leaf_area_mat[px,py, dem_offset_index_mat[px,py]+30:-10] = 100000.0
-    ## END TEST
-
-    #setup the actual_leaf_area_mat shape based on new nz, which includes terrain and max tree height "head space"
-    nx,ny,nz = actual_leaf_area_mat.shape
-    # finally compute the available light matrix based on the actual leaf area and the "arrow" directions and proportions
-    # actual_leaf_area_mat will have 0s and -1s in it during 1st year of sim, then populated with other values (-1s stay same)
-    al_mat = compute_3D_light_matrix(actual_leaf_area_mat, #with -1 flags at and below ground surface
-                                     radiation_fraction_mat, #scaled by max radiation received on s-facing slopes >10deg, computed in GIS
-                                     nx,ny,nz, #shape of actual leaf area matrix
-                                     arrows_list, #list of tuples for direct & diffuse angles for light computation
-                                     plot_area=xsize*ysize) #defines the size of one plot in m^2
-    print dem_offset_index_mat[0,0]
-    print actual_leaf_area_mat[0,0,:]
-    print al_mat[0,0,:]
-
-    m = VolumeSlicer(data=al_mat) #doesn't work in Windows OS; shadow to the south due to diffuse light component
-    m.configure_traits()
-
-    #example()
+def load_or_build_ray_tables(arrows_list, dem_offset_index_mat, nz, zsize, cache_dir=None):
+    """
+    Get the pre-computed ray tables (see light3d.build_ray_tables) for the "arrows" shot through the simulation grid.
+    Building the tables only depends on the arrows, the DEM and the height of the airspace, so when a cache folder
+    is given the tables are stored there and re-used by any later run (e.g. ensemble replicates) on the same DEM.
+
+    Parameters:  arrows_list -- list of tuples (dx, dy, dz, proportion of total radiation)
+                 dem_offset_index_mat -- tracks the dem offset index values under each x,y plot
+                 nz -- the number of vertical steps in the leaf area matrix the light is computed on
+                 zsize  --  z (vertical step size along tree for light computation, 1m)
+                 cache_dir -- folder in which to store/look up the ray tables, None means do not cache
+
+    Returns:     ray_tables -- a dictionary of ray_start, ray_column, ray_dem_delta, ray_horizon_height, ray_horizon_step and nz
+    """
+    arrows_mat = arrows_list_to_array(arrows_list)
+    dem_offset_index_mat = np.ascontiguousarray(dem_offset_index_mat, dtype=np.int64)
+    if cache_dir is None:
+        return build_ray_tables(arrows_mat, dem_offset_index_mat, nz, zsize)
+
+    # the cache file name is a checksum of everything the ray tables depend on, including the layout of the tables
+    key = hashlib.sha1()
+    key.update(RAY_TABLES_FORMAT)
+    key.update(arrows_mat.tostring())
+    key.update(dem_offset_index_mat.tostring())
+    key.update(str((dem_offset_index_mat.shape, nz, zsize)))
+    cache_file = os.path.join(cache_dir, 'ray_tables_%s.npz' % key.hexdigest())
+    if os.access(cache_file, os.F_OK):
+        cached = np.load(cache_file)
+        ray_tables = dict((name, cached[name]) for name in cached.files)
+        ray_tables['nz'] = int(ray_tables['nz'])
+        print 'Info :: Loaded ray tables from %s' % cache_file
+        return ray_tables
+
+    ray_tables = build_ray_tables(arrows_mat, dem_offset_index_mat, nz, zsize)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first, so a replicate starting at the same time never reads a partial file
+    tmp_file = '%s.%d.tmp.npz' % (cache_file[:-len('.npz')], os.getpid())
+    np.savez(tmp_file, **ray_tables)
+    os.rename(tmp_file, cache_file)
+    print 'Info :: Saved ray tables to %s' % cache_file
+    return ray_tables
 
 
+if __name__ == '__main__':  #need this to run from commandline
+    # time build_arrows_list and the light engines on synthetic terrain and canopies (see light_benchmark.py for the options)
+    from light_benchmark import main
+    main()
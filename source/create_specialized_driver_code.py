@@ -77,6 +77,7 @@ import numba
 import numpy as np
 from math import *
 from ${driver_module} import driver
+from workspace import workspace_buffer
 
 # the total number of species enabled
 number_of_species = ${len(make_id_to_name_lut(driver))}
@@ -127,21 +128,27 @@ def compute_species_factors_weather(GDD_matrix, drydays_fraction_mat, spp_in_sim
 
     return GDD_3D_spp_factor_matrix, soil_moist_3D_spp_factor_matrix
 
-@numba.jit()
-def compute_species_factors_soil(relative_soil_fertility_matrix, spp_in_sim, permafrost_matrix):
+def compute_species_factors_soil(relative_soil_fertility_matrix, spp_in_sim, permafrost_matrix, workspace=None):
     '''
 
     Parameters:  relative_soil_fertility_matrix -- a matrix the size of sim grid with values 0 to 1 for each plot in sim 
                  spp_in_sim -- a scalar of how many species are participation in the simulation
                  permafrost_matrix -- a matrix the size of sim grid with values of 0 or 1 for where permafrost absent or present, respectively
+                 workspace -- the matrices re-used from year to year (see workspace.py), None to allocate new ones
 
     Returns:    soil_fert_3D_spp_factor_matrix -- the species specific soil fertility factors, size : nx,ny,nspp
                 permafrost_factor_matrix -- the species specific permafrost factor, size: nx, ny, nspp
     '''
     nx,ny = relative_soil_fertility_matrix.shape
-    soil_fert_3D_spp_factor_matrix = np.zeros((nx,ny,spp_in_sim))
-    permafrost_factor_matrix = np.zeros((nx,ny,spp_in_sim))
+    soil_fert_3D_spp_factor_matrix = workspace_buffer(workspace, 'soil_fertility_factor', (nx,ny,spp_in_sim))
+    permafrost_factor_matrix = workspace_buffer(workspace, 'permafrost_factor', (nx,ny,spp_in_sim))
+    return compute_species_factors_soil_numba(relative_soil_fertility_matrix, permafrost_matrix,
+                                              soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix)
 
+@numba.jit(nopython=True)
+def compute_species_factors_soil_numba(relative_soil_fertility_matrix, permafrost_matrix,
+                                       soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix):
+    nx,ny,spp_in_sim = soil_fert_3D_spp_factor_matrix.shape
     for x in range(nx):
         for y in range(ny):
             for spp in range(spp_in_sim): #address of each cell in 3-D matrix
@@ -202,8 +209,7 @@ def compute_species_factors_numba(GDD_matrix, GDD_3D_spp_factor_matrix,
     return GDD_3D_spp_factor_matrix, soil_moist_3D_spp_factor_matrix, soil_fert_3D_spp_factor_matrix
 
 
-@numba.jit()
-def compute_available_light_factors_by_species(available_light_mat, number_of_species):
+def compute_available_light_factors_by_species(available_light_mat, number_of_species, workspace=None):
     '''
     For the input 3D matrix of available light, compute the species specific light factor for each of the 
     species in the simulation.
@@ -211,13 +217,20 @@ def compute_available_light_factors_by_species(available_light_mat, number_of_sp
     Parameters: available_light_mat -- available light for every location in the simulation 3D area
                                        size 3D: nx, ny, elev (where elev is max tree height + max DEM offset)
                 number_of_species -- the number of species in the simulation
+                workspace -- the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
-    Returns: light_factor_by_species_matrix -- species specific light factors computed above ground
+    Returns: light_factor_by_species_matrix -- species specific light factors computed above ground, in the precision
+                                               of available_light_mat (see LIGHT_PRECISION in the driver)
                                                size 4D: nx, ny, nz, number_of_species
     '''
     nx, ny, nz = available_light_mat.shape
-    light_factor_by_species_matrix = np.zeros((nx,ny,nz,number_of_species))
+    light_factor_by_species_matrix = workspace_buffer(workspace, 'light_factor_by_species', (nx,ny,nz,number_of_species),
+                                                      dtype=available_light_mat.dtype)
+    return compute_available_light_factors_by_species_numba(available_light_mat, light_factor_by_species_matrix)
 
+@numba.jit(nopython=True)
+def compute_available_light_factors_by_species_numba(available_light_mat, light_factor_by_species_matrix):
+    nx, ny, nz, number_of_species = light_factor_by_species_matrix.shape
     # iterate through each plot x,y
     for x in range(nx):
         for y in range(ny):
@@ -234,13 +247,16 @@ def compute_available_light_factors_by_species(available_light_mat, number_of_sp
                         elif spp == ${spp}:
                             light_factor_by_species_matrix[x,y,z,spp] = available_light_factor_numba_species_${spp}(al)
 % endfor
+                else:
+                    # no light here (or below ground)
+                    for spp in range(number_of_species):
+                        light_factor_by_species_matrix[x,y,z,spp] = 0.
 
     return light_factor_by_species_matrix
 
 
-@numba.jit()
 def compute_actual_leaf_area(DBH_matrix, species_code_matrix, crown_base_matrix, tree_height_matrix, total_leaf_area_matrix, 
-                               actual_leaf_area_mat, plot_area):
+                               actual_leaf_area_mat, plot_area, workspace=None):
     '''
     Take the computed foliage densities for each tree, and sum them within each plot, creating an accumulated
     foliage density profile for the plot to use as input into the light computation
@@ -259,13 +275,23 @@ def compute_actual_leaf_area(DBH_matrix, species_code_matrix, crown_base_matrix,
                  actual_leaf_area_mat   --  pre-initialized: contains -1 below ground and 0 above ground for each plot and air space above plot
                                             size: nx, ny, vertical space = (max_tree_ht+(max elevation in sim - min elevation in sim))
                  plot_area -- plot area (m^2)
+                 workspace -- the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
     Returns:  actual_leaf_area_mat --  contains contains the actual leaf area column for each plot in the simulation grid
-                                       size: nx, ny, MAX_TREE_HEIGHT
+                                       size: nx, ny, MAX_TREE_HEIGHT, precision: LIGHT_PRECISION in the driver
     '''
     MAX_TREE_HEIGHT = ${driver['MAX_TREE_HEIGHT']}
     nx,ny,ntrees = DBH_matrix.shape
-    actual_leaf_area_mat = np.zeros( (nx,ny,MAX_TREE_HEIGHT) )
+    # the whole light pipeline (leaf area, available light, light factors) follows the precision of this matrix
+    actual_leaf_area_mat = workspace_buffer(workspace, 'actual_leaf_area', (nx,ny,MAX_TREE_HEIGHT),
+                                            dtype=np.${driver.get('LIGHT_PRECISION', 'float64')}, zero=True)
+    return compute_actual_leaf_area_numba(DBH_matrix, crown_base_matrix, tree_height_matrix, total_leaf_area_matrix,
+                                          plot_area, actual_leaf_area_mat)
+
+@numba.jit(nopython=True)
+def compute_actual_leaf_area_numba(DBH_matrix, crown_base_matrix, tree_height_matrix, total_leaf_area_matrix,
+                                   plot_area, actual_leaf_area_mat):
+    nx,ny,ntrees = DBH_matrix.shape
     for x in range(nx):
         for y in range(ny):
             # iterate through each tree and add to the plot foliage density popsicle
@@ -285,8 +311,7 @@ def compute_actual_leaf_area(DBH_matrix, species_code_matrix, crown_base_matrix,
 
     return actual_leaf_area_mat
 
-@numba.jit()
-def compute_individual_tree_values(DBH_matrix, species_code_matrix, crown_base_matrix):
+def compute_individual_tree_values(DBH_matrix, species_code_matrix, crown_base_matrix, workspace=None):
     '''
     Compute species specific values for each tree in the simulation.
     The current computed values are:
@@ -306,6 +331,7 @@ def compute_individual_tree_values(DBH_matrix, species_code_matrix, crown_base_m
                                         size : nx, ny, ntrees
                  crown_base_matrix -- the height (m) of the base of each tree crown
                                       size : nx, ny, ntrees
+                 workspace -- the matrices re-used from year to year (see workspace.py), None to allocate new ones
 
     Returns : tree_height_matrix -- the species specific height (m) of each tree in the simulation
                                     size : nx, ny, ntrees
@@ -327,16 +353,29 @@ def compute_individual_tree_values(DBH_matrix, species_code_matrix, crown_base_m
                                                     size : nx, ny, ntrees
     '''
     nx,ny,ntrees = DBH_matrix.shape
-    tree_height_matrix = np.zeros((nx,ny,ntrees))
-    total_leaf_area_matrix = np.zeros((nx,ny,ntrees))
-    biomass_matrix = np.zeros((nx,ny,ntrees))
-    opt_inc_matrix = np.zeros((nx,ny,ntrees))
-    optimal_biomass_matrix = np.zeros((nx,ny,ntrees))
-    basal_area_matrix = np.zeros((nx,ny,ntrees))
-    biovolume_matrix = np.zeros((nx,ny,ntrees))
-    optimal_biovolume_matrix = np.zeros((nx,ny,ntrees))
-    optimal_biovolume_increment_matrix = np.zeros((nx,ny,ntrees))
+    tree_height_matrix = workspace_buffer(workspace, 'tree_height', (nx,ny,ntrees))
+    total_leaf_area_matrix = workspace_buffer(workspace, 'total_leaf_area', (nx,ny,ntrees))
+    biomass_matrix = workspace_buffer(workspace, 'biomass', (nx,ny,ntrees))
+    opt_inc_matrix = workspace_buffer(workspace, 'optimal_growth_increment', (nx,ny,ntrees))
+    optimal_biomass_matrix = workspace_buffer(workspace, 'optimal_biomass', (nx,ny,ntrees))
+    basal_area_matrix = workspace_buffer(workspace, 'basal_area', (nx,ny,ntrees))
+    biovolume_matrix = workspace_buffer(workspace, 'biovolume', (nx,ny,ntrees))
+    optimal_biovolume_matrix = workspace_buffer(workspace, 'optimal_biovolume', (nx,ny,ntrees))
+    optimal_biovolume_increment_matrix = workspace_buffer(workspace, 'optimal_biovolume_increment', (nx,ny,ntrees))
+    compute_individual_tree_values_numba(DBH_matrix, species_code_matrix, crown_base_matrix,
+                                         tree_height_matrix, total_leaf_area_matrix, biomass_matrix, opt_inc_matrix,
+                                         optimal_biomass_matrix, basal_area_matrix, biovolume_matrix, optimal_biovolume_matrix,
+                                         optimal_biovolume_increment_matrix)
 
+    return tree_height_matrix, total_leaf_area_matrix, biomass_matrix, opt_inc_matrix, optimal_biomass_matrix, basal_area_matrix, biovolume_matrix, \
+           optimal_biovolume_matrix, optimal_biovolume_increment_matrix
+
+@numba.jit(nopython=True)
+def compute_individual_tree_values_numba(DBH_matrix, species_code_matrix, crown_base_matrix,
+                                         tree_height_matrix, total_leaf_area_matrix, biomass_matrix, opt_inc_matrix,
+                                         optimal_biomass_matrix, basal_area_matrix, biovolume_matrix, optimal_biovolume_matrix,
+                                         optimal_biovolume_increment_matrix):
+    nx,ny,ntrees = DBH_matrix.shape
     for x in range(nx):
         for y in range(ny):
             for ind in range(ntrees):
@@ -361,9 +400,264 @@ def compute_individual_tree_values(DBH_matrix, species_code_matrix, crown_base_m
                     optimal_biovolume_matrix[x,y,ind] = tree_biovolume_numba_species_${spp}(dbh + opt_inc)
                     optimal_biovolume_increment_matrix[x,y,ind] = optimal_biovolume_matrix[x,y,ind] - biovolume_matrix[x,y,ind]
 % endfor
+                else:
+                    # no tree here (species code -1), all of its values are 0
+                    tree_height_matrix[x,y,ind] = 0.
+                    total_leaf_area_matrix[x,y,ind] = 0.
+                    biomass_matrix[x,y,ind] = 0.
+                    opt_inc_matrix[x,y,ind] = 0.
+                    optimal_biomass_matrix[x,y,ind] = 0.
+                    basal_area_matrix[x,y,ind] = 0.
+                    biovolume_matrix[x,y,ind] = 0.
+                    optimal_biovolume_matrix[x,y,ind] = 0.
+                    optimal_biovolume_increment_matrix[x,y,ind] = 0.
+
+
+def compute_tree_values_and_leaf_area(DBH_matrix, species_code_matrix, crown_base_matrix, plot_area, number_of_species, workspace=None):
+    '''
+    The fused version of compute_individual_tree_values, compute_actual_leaf_area, compute_basal_area_by_plot_by_species
+    and compute_biomass_by_plot_by_species (see TREE_KERNEL_FUSED in the driver): one pass over the trees computes the
+    allometry of each tree, adds its foliage to the leaf area profile of its plot, and sums its basal area and biomass by
+    species, so only the per tree values used later in the year are stored.
 
-    return tree_height_matrix, total_leaf_area_matrix, biomass_matrix, opt_inc_matrix, optimal_biomass_matrix, basal_area_matrix, biovolume_matrix, \
-           optimal_biovolume_matrix, optimal_biovolume_increment_matrix
+    Parameters : DBH_matrix -- a dbh value (cm) for each tree in the simulation
+                               size : nx, ny, ntrees
+                 species_code_matrix -- the species code for every tree in the simulation
+                                        size : nx, ny, ntrees
+                 crown_base_matrix -- the height (m) of the base of each tree crown
+                                      size : nx, ny, ntrees
+                 plot_area -- plot area (m^2)
+                 number_of_species -- the number of species in the simulation
+                 workspace -- the matrices re-used from year to year (see workspace.py), None to allocate new ones
+
+    Returns : tree_height_matrix, total_leaf_area_matrix, opt_inc_matrix, basal_area_matrix,
+              optimal_biovolume_increment_matrix -- as for compute_individual_tree_values, size : nx, ny, ntrees
+              actual_leaf_area_mat -- as for compute_actual_leaf_area, size : nx, ny, MAX_TREE_HEIGHT
+              grouped_basal_area_matrix -- the basal area (m^2) summed up for every species on a plot, size : nx, ny, nspp
+              grouped_biomass_matrix -- the biomass summed up for every species on a plot, size : nx, ny, nspp
+    '''
+    MAX_TREE_HEIGHT = ${driver['MAX_TREE_HEIGHT']}
+    nx,ny,ntrees = DBH_matrix.shape
+    tree_height_matrix = workspace_buffer(workspace, 'tree_height', (nx,ny,ntrees))
+    total_leaf_area_matrix = workspace_buffer(workspace, 'total_leaf_area', (nx,ny,ntrees))
+    opt_inc_matrix = workspace_buffer(workspace, 'optimal_growth_increment', (nx,ny,ntrees))
+    basal_area_matrix = workspace_buffer(workspace, 'basal_area', (nx,ny,ntrees))
+    optimal_biovolume_increment_matrix = workspace_buffer(workspace, 'optimal_biovolume_increment', (nx,ny,ntrees))
+    # the whole light pipeline (leaf area, available light, light factors) follows the precision of this matrix
+    actual_leaf_area_mat = workspace_buffer(workspace, 'actual_leaf_area', (nx,ny,MAX_TREE_HEIGHT),
+                                            dtype=np.${driver.get('LIGHT_PRECISION', 'float64')}, zero=True)
+    grouped_basal_area_matrix = workspace_buffer(workspace, 'basal_area_by_species', (nx,ny,number_of_species), zero=True)
+    grouped_biomass_matrix = workspace_buffer(workspace, 'biomass_by_species', (nx,ny,number_of_species), zero=True)
+    compute_tree_values_and_leaf_area_numba(DBH_matrix, species_code_matrix, crown_base_matrix, plot_area,
+                                            tree_height_matrix, total_leaf_area_matrix, opt_inc_matrix, basal_area_matrix,
+                                            optimal_biovolume_increment_matrix, actual_leaf_area_mat,
+                                            grouped_basal_area_matrix, grouped_biomass_matrix)
+
+    return tree_height_matrix, total_leaf_area_matrix, opt_inc_matrix, basal_area_matrix, optimal_biovolume_increment_matrix, \
+           actual_leaf_area_mat, grouped_basal_area_matrix, grouped_biomass_matrix
+
+@numba.jit(nopython=True)
+def compute_tree_values_and_leaf_area_numba(DBH_matrix, species_code_matrix, crown_base_matrix, plot_area,
+                                            tree_height_matrix, total_leaf_area_matrix, opt_inc_matrix, basal_area_matrix,
+                                            optimal_biovolume_increment_matrix, actual_leaf_area_mat,
+                                            grouped_basal_area_matrix, grouped_biomass_matrix):
+    nx,ny,ntrees = DBH_matrix.shape
+    for x in range(nx):
+        for y in range(ny):
+            for ind in range(ntrees):
+                dbh = DBH_matrix[x,y,ind]
+                crown_base = crown_base_matrix[x,y,ind]
+                species_code = species_code_matrix[x,y,ind]
+% for spp in range(0, len(make_id_to_name_lut(driver))):
+    % if spp==0:
+                if species_code == ${spp}:
+    % else:
+                elif species_code == ${spp}:
+    % endif
+                    tree_height = tree_height_numba_species_${spp}(dbh)
+                    total_leaf_area = total_leaf_area_numba_species_${spp}(dbh, tree_height, crown_base)
+                    biomass = tree_biomass_numba_species_${spp}(dbh)
+                    opt_inc = optimal_growth_increment_numba_species_${spp}(dbh)
+                    basal_area = basal_area_numba_species_${spp}(dbh)
+                    optimal_biovolume_increment = tree_biovolume_numba_species_${spp}(dbh + opt_inc) - tree_biovolume_numba_species_${spp}(dbh)
+% endfor
+                else:
+                    # no tree here (species code -1), all of its values are 0
+                    tree_height_matrix[x,y,ind] = 0.
+                    total_leaf_area_matrix[x,y,ind] = 0.
+                    opt_inc_matrix[x,y,ind] = 0.
+                    basal_area_matrix[x,y,ind] = 0.
+                    optimal_biovolume_increment_matrix[x,y,ind] = 0.
+                    continue
+                tree_height_matrix[x,y,ind] = tree_height
+                total_leaf_area_matrix[x,y,ind] = total_leaf_area
+                opt_inc_matrix[x,y,ind] = opt_inc
+                basal_area_matrix[x,y,ind] = basal_area
+                optimal_biovolume_increment_matrix[x,y,ind] = optimal_biovolume_increment
+                # sprouting only plants saplings where there is no tree (no basal area or biomass), so the sums by
+                # species are the same as when they are taken at the end of the year
+                grouped_basal_area_matrix[x,y,species_code] += basal_area
+                grouped_biomass_matrix[x,y,species_code] += biomass
+                # accumulate the foliage density popsicle for this plot (see compute_actual_leaf_area)
+                if dbh > 0.0:
+                    crown_length = tree_height - crown_base
+                    if crown_length > 0:
+                        fd = total_leaf_area / (crown_length * plot_area) #leaf area per crown volume, aka LAI/m
+                        for ht in range(crown_base, int(tree_height)):
+                            actual_leaf_area_mat[x,y,ht] += fd
+
+
+def grow_trees_fused(available_light_mat, DBH_matrix, species_code_matrix, crown_base_matrix, stress_flag_matrix,
+                     tree_height_matrix, opt_inc_matrix, optimal_biovolume_increment_matrix,
+                     GDD_3D_spp_factor_matrix, soil_moist_3D_spp_factor_matrix, plot_max_biovolume_increment_matrix,
+                     permafrost_matrix, number_of_species, keep_tree_factors=False, workspace=None):
+    '''
+    The fused version of compute_crown_base, light_factor_compute, compute_plot_likely_biovolume_increment,
+    biovolume_compute_relative_soil_fertility_matrix, compute_species_factors_soil and grow_trees (see TREE_KERNEL_FUSED
+    in the driver): each plot is visited once, the light factors of its column are computed for the species in a small
+    scratch matrix (instead of the nx,ny,nz,nspp matrix of compute_available_light_factors_by_species), and its trees
+    are grown right after the soil fertility of the plot is known. DBH_matrix, crown_base_matrix and stress_flag_matrix
+    are updated in place.
+
+    Parameters: available_light_mat -- the available light (0 to 1) at every location in the 3D grid, size : nx, ny, nz
+                DBH_matrix, species_code_matrix, crown_base_matrix, stress_flag_matrix -- the state of every tree,
+                                                                                         size : nx, ny, ntrees
+                tree_height_matrix, opt_inc_matrix,
+                optimal_biovolume_increment_matrix -- from compute_tree_values_and_leaf_area, size : nx, ny, ntrees
+                GDD_3D_spp_factor_matrix, soil_moist_3D_spp_factor_matrix -- the weather factors, size : nx, ny, nspp
+                plot_max_biovolume_increment_matrix -- the maximum biovolume increment each plot can support, size : nx, ny
+                permafrost_matrix -- the permafrost depth of each plot, size : nx, ny
+                number_of_species -- the number of species in the simulation
+                keep_tree_factors -- True to return the light factor and growth factor of every tree (e.g. for DEBUG),
+                                     False to return them for the last plot only (they are only scratch space then)
+                workspace -- the matrices re-used from year to year (see workspace.py), None to allocate new ones
+
+    Returns:    relative_soil_fertility_matrix -- size : nx, ny
+                soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix, ground_light_spp_factor_matrix,
+                partial_growth_factor_matrix, sprout_factor_matrix -- size : nx, ny, nspp
+                available_light_spp_factor_matrix, growth_factor_matrix -- size : nx, ny, ntrees (1, 1, ntrees when
+                                                                          keep_tree_factors is False)
+    '''
+    nx,ny,ntrees = DBH_matrix.shape
+    relative_soil_fertility_matrix = workspace_buffer(workspace, 'relative_soil_fertility', (nx,ny))
+    soil_fert_3D_spp_factor_matrix = workspace_buffer(workspace, 'soil_fertility_factor', (nx,ny,number_of_species))
+    permafrost_factor_matrix = workspace_buffer(workspace, 'permafrost_factor', (nx,ny,number_of_species))
+    ground_light_spp_factor_matrix = workspace_buffer(workspace, 'ground_light_factor', (nx,ny,number_of_species))
+    partial_growth_factor_matrix = workspace_buffer(workspace, 'partial_growth_factor', (nx,ny,number_of_species))
+    sprout_factor_matrix = workspace_buffer(workspace, 'sprout_factor', (nx,ny,number_of_species))
+    if keep_tree_factors:
+        available_light_spp_factor_matrix = workspace_buffer(workspace, 'tree_light_factor', (nx,ny,ntrees))
+        growth_factor_matrix = workspace_buffer(workspace, 'growth_factor', (nx,ny,ntrees))
+    else:
+        available_light_spp_factor_matrix = workspace_buffer(workspace, 'plot_tree_light_factor', (1,1,ntrees))
+        growth_factor_matrix = workspace_buffer(workspace, 'plot_growth_factor', (1,1,ntrees))
+    grow_trees_fused_numba(available_light_mat, DBH_matrix, species_code_matrix, crown_base_matrix, stress_flag_matrix,
+                           tree_height_matrix, opt_inc_matrix, optimal_biovolume_increment_matrix,
+                           GDD_3D_spp_factor_matrix, soil_moist_3D_spp_factor_matrix, plot_max_biovolume_increment_matrix,
+                           permafrost_matrix, np.array(species_code_to_stress_threshold, dtype=np.float64),
+                           relative_soil_fertility_matrix, soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix,
+                           ground_light_spp_factor_matrix, partial_growth_factor_matrix, sprout_factor_matrix,
+                           available_light_spp_factor_matrix, growth_factor_matrix)
+
+    return relative_soil_fertility_matrix, soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix, ground_light_spp_factor_matrix, \
+           partial_growth_factor_matrix, sprout_factor_matrix, available_light_spp_factor_matrix, growth_factor_matrix
+
+@numba.jit(nopython=True)
+def grow_trees_fused_numba(available_light_mat, DBH_matrix, species_code_matrix, crown_base_matrix, stress_flag_matrix,
+                           tree_height_matrix, opt_inc_matrix, optimal_biovolume_increment_matrix,
+                           GDD_3D_spp_factor_matrix, soil_moist_3D_spp_factor_matrix, plot_max_biovolume_increment_matrix,
+                           permafrost_matrix, stress_threshold_vec,
+                           relative_soil_fertility_matrix, soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix,
+                           ground_light_spp_factor_matrix, partial_growth_factor_matrix, sprout_factor_matrix,
+                           available_light_spp_factor_matrix, growth_factor_matrix):
+    nx,ny,ntrees = DBH_matrix.shape
+    nz = available_light_mat.shape[2]
+    number_of_species = partial_growth_factor_matrix.shape[2]
+    # the light factors by height and by species of one plot column, in the precision of available_light_mat
+    light_factor_column = np.zeros((nz,number_of_species), dtype=available_light_mat.dtype)
+    for x in range(nx):
+        for y in range(ny):
+            # the tree factors are kept for every plot, or overwritten for each plot
+            tx = x if available_light_spp_factor_matrix.shape[0] == nx else 0
+            ty = y if available_light_spp_factor_matrix.shape[1] == ny else 0
+
+            # compute crown base: the crown base is an integer height (see compute_crown_base)
+            top = 1  #the ground-level light factors are always needed (for sprouting)
+            for ind in range(ntrees):
+                crown_base_matrix[x,y,ind] = int(crown_base_matrix[x,y,ind])
+                if species_code_matrix[x,y,ind] >= 0:
+                    top = max(top, int(tree_height_matrix[x,y,ind]))
+            top = min(top, nz)
+
+            # the light factors of this column, only up to the tallest tree (see compute_available_light_factors_by_species)
+            for z in range(top):
+                al = available_light_mat[x,y,z]
+                for spp in range(number_of_species):
+                    if not (al > 0.):
+                        light_factor_column[z,spp] = 0.
+% for spp in range(0, len(make_id_to_name_lut(driver))):
+                    elif spp == ${spp}:
+                        light_factor_column[z,spp] = available_light_factor_numba_species_${spp}(al)
+% endfor
+
+            # the light factor of each tree is averaged over the length of its crown (see light_factor_compute), and
+            # the likely biovolume increment of the plot is summed (see compute_plot_likely_biovolume_increment)
+            plot_likely_biovolume_increment = 0.
+            for ind in range(ntrees):
+                height = tree_height_matrix[x,y,ind]
+                crown_base = numba.int_(crown_base_matrix[x,y,ind])
+                spp = species_code_matrix[x,y,ind]
+                crown_length = numba.int_(height) - crown_base
+                tree_light_factor = 0.
+                if spp >= 0 and crown_length > 0:
+                    for z in range(crown_base, int(height)):
+                        tree_light_factor += light_factor_column[z,spp]
+                    tree_light_factor /= float(crown_length)
+                available_light_spp_factor_matrix[tx,ty,ind] = tree_light_factor
+                plot_likely_biovolume_increment += optimal_biovolume_increment_matrix[x,y,ind] * (GDD_3D_spp_factor_matrix[x,y,spp] * tree_light_factor)
+
+            # the relative soil fertility of the plot (see biovolume_compute_relative_soil_fertility_matrix)
+            plot_max_biovolume_increment = plot_max_biovolume_increment_matrix[x,y]
+            if plot_likely_biovolume_increment <= plot_max_biovolume_increment:
+                relative_soil_fertility = 1.0
+            else:
+                relative_soil_fertility = plot_max_biovolume_increment / plot_likely_biovolume_increment  #this ratio is <1
+            relative_soil_fertility_matrix[x,y] = relative_soil_fertility
+
+            # the below ground factors of each species (see compute_species_factors_soil), the partial growth factor
+            # min(smf,sff,permafrost)*gddf and the sprout factor (ground light * partial growth factor)
+            for spp in range(number_of_species):
+                if spp == 0:
+                    soil_fert_factor = soil_fertility_factor_numba_species_0(relative_soil_fertility)
+                    permafrost_factor = permafrost_factor_numba_species_0(permafrost_matrix[x,y])
+% for spp in range(1, len(make_id_to_name_lut(driver))):
+                elif spp == ${spp}:
+                    soil_fert_factor = soil_fertility_factor_numba_species_${spp}(relative_soil_fertility)
+                    permafrost_factor = permafrost_factor_numba_species_${spp}(permafrost_matrix[x,y])
+% endfor
+                soil_fert_3D_spp_factor_matrix[x,y,spp] = soil_fert_factor
+                permafrost_factor_matrix[x,y,spp] = permafrost_factor
+                partial_growth_factor = np.minimum(np.minimum(soil_moist_3D_spp_factor_matrix[x,y,spp], soil_fert_3D_spp_factor_matrix[x,y,spp]),
+                                                   permafrost_factor_matrix[x,y,spp]) * GDD_3D_spp_factor_matrix[x,y,spp]
+                partial_growth_factor_matrix[x,y,spp] = partial_growth_factor
+                ground_light_spp_factor_matrix[x,y,spp] = light_factor_column[0,spp]
+                sprout_factor_matrix[x,y,spp] = ground_light_spp_factor_matrix[x,y,spp] * partial_growth_factor
+
+            # grow the trees of this plot (see grow_trees)
+            for ind in range(ntrees):
+                growth_factor_matrix[tx,ty,ind] = 0.
+                tree_DBH = DBH_matrix[x,y,ind]
+                if tree_DBH > 0:
+                    species_code = species_code_matrix[x,y,ind]
+                    optimal_growth_increment = opt_inc_matrix[x,y,ind]
+                    growth_factor = available_light_spp_factor_matrix[tx,ty,ind] * partial_growth_factor_matrix[x,y,species_code]
+                    actual_growth_increment = optimal_growth_increment * growth_factor
+                    if actual_growth_increment <= stress_threshold_vec[species_code]*optimal_growth_increment:
+                        stress_flag_matrix[x,y,ind] = stress_flag_matrix[x,y,ind] + 1
+                    else:
+                        stress_flag_matrix[x,y,ind] = 0   #stress flags erased in a good growth year ("release")
+                    DBH_matrix[x,y,ind] = tree_DBH + actual_growth_increment
+                    growth_factor_matrix[tx,ty,ind] = growth_factor
 
 
 # ********************************
@@ -496,6 +496,57 @@ This simulation contains all 10 boreal tree species.
 "sim_start_year":0,
 "sim_stop_year":200,
 "LIGHT_MODE":"3D",
+# number of threads used by the light computation: 1 runs the serial light code, 0 uses all available cores
+# (the parallel results are identical to the serial results)
+"LIGHT_THREADS":1,
+# how the light "arrows" are traced: "per_arrow" sweeps the whole grid once for each arrow (original light code),
+# "fused" visits each voxel once for all arrows (same results, less memory traffic),
+# "tables" is "fused" with the path of every arrow pre-computed at initialization (same results).
+# With LIGHT_MODE "1D" the "prefix_sum" engine (a cumulative sum down each plot column) is always used.
+"LIGHT_ENGINE":"fused",
+# with the "tables" engine, only trace the voxels below the highest canopy each arrow can reach; the voxels above it
+# get full light directly (same results, time spent on light scales with the height of the stand)
+"LIGHT_CANOPY_BOUND":False,
+# folder where the "tables" engine stores its pre-computed arrow paths for re-use by runs on the same DEM (None = do not store)
+"LIGHT_TABLES_CACHE_DIR":None,
+# with the "fused" and "tables" engines, stop tracing an arrow once the light it can still deliver is at most this value
+# (0.0 = trace every arrow to the end); the largest resulting error is printed every year
+"LIGHT_TOLERANCE":0.0,
+# with the "tables" engine, only re-compute the light of the voxels whose arrows pass through plots where the leaf area
+# changed by more than LIGHT_CHANGE_THRESHOLD since last computed (0.0 gives the same results as computing all of the light)
+"LIGHT_INCREMENTAL":False,
+"LIGHT_CHANGE_THRESHOLD":0.0,
+# with the "tables" engine, visit the grid in tiles of LIGHT_TILE_SIZE x LIGHT_TILE_SIZE plots so the leaf area stays in the
+# cache on large grids (0 = plot by plot, same results; see light_benchmark.py to pick a size for your machine)
+"LIGHT_TILE_SIZE":0,
+# with the "tables" engine, trace the light through the leaf area of each plot stored as runs of constant density (built
+# from the leaf area matrix every year the light is computed); arrows skip gaps and the air above and below the crowns
+# (same results, faster on young and patchy stands; LIGHT_TILE_SIZE is not used)
+"LIGHT_SPARSE":False,
+# for very large landscapes, split the grid into LIGHT_DOMAINS (along x, y) computed by LIGHT_PROCESSES worker processes
+# (0 = one per core); each domain only needs the leaf area of its plots plus a halo as wide as the longest arrow reach.
+# Same results as computing the whole grid at once; (1, 1) computes the whole grid with the LIGHT_ENGINE instead
+"LIGHT_DOMAINS":(1, 1),
+"LIGHT_PROCESSES":1,
+# compute the light every LIGHT_REFRESH_YEARS years (re-using the last computed light in between, e.g. for long spin-up runs),
+# or as soon as the total leaf area of any plot changes by more than the fraction LIGHT_REFRESH_DRIFT (0.0 = never)
+"LIGHT_REFRESH_YEARS":1,
+"LIGHT_REFRESH_DRIFT":0.1,
+# the precision of the leaf area, available light and light factor matrices: "float64", or "float32" to halve their memory
+# on large grids. With LIGHT_PRECISION_REPORT True the light is also computed in both precisions every year, and the
+# largest and mean differences in available light, tree light factors and growth factors are printed and stored
+# in the LightPrecisionReport table of the output file
+"LIGHT_PRECISION":"float64",
+"LIGHT_PRECISION_REPORT":False,
+# count the rays traced, the mean steps per ray, the rays ended by terrain and the wrap around crossings of each arrow,
+# every year the light is computed (stored in the LightCounters group of the output file). The "per_arrow", "fused" and
+# "tables" engines count while computing the light (same results, a little slower, LIGHT_TILE_SIZE is not used); only
+# "per_arrow" also times each arrow, the other engines trace all of the arrows of a voxel at once
+"LIGHT_COUNTERS":False,
+# visit the trees in two fused passes each year instead of one pass per step: before the light computation (tree values,
+# leaf area, basal area and biomass by species) and after it (crown base, light, soil fertility and permafrost factors and
+# growth). Same results, fewer full size matrices; a year with a light precision report uses the separate steps
+"TREE_KERNEL_FUSED":False,
 #DEBUG True saves the factors to see where things may have gone wrong
 "DEBUG":True,
 
@@ -511,6 +562,15 @@ This simulation contains all 10 boreal tree species.
 
 "CLIMATE_RANDOM_doc":"if true, then generate random climate; if false, then use climate record specified below",
 "CLIMATE_RANDOM":False,
+# generate the weather of all simulation years at the start from random numbers of its own (seeded by WEATHER_SEED), so the
+# weather does not change with the mortality and regeneration draws; with WEATHER_CACHE_DIR set, the weather is stored there
+# and re-used (memory-mapped) by later runs with the same weather function, seed and grid, e.g. replicates sharing a climate
+"WEATHER_STREAM":False,
+"WEATHER_SEED":0,
+"WEATHER_CACHE_DIR":None,
+# compute the weather and the degree day and soil moisture factors once for each group of plots with the same lapse rate
+# adjustment and monthly radiation, instead of for every plot (same results; much faster on flat or gently varying terrain)
+"WEATHER_PLOT_CLASSES":True,
 
 "TIMBER_HARVEST_doc":"if true, trees of specified spp and size are removed within one year of sim; if false, harvest not activated",
 "TIMBER_HARVEST":False,
@@ -552,6 +612,9 @@ This simulation contains all 10 boreal tree species.
 "monthly_radiation_files_path":"monthly_radiation",
 "Radiation_fraction_file_path":"rad_fraction.txt", 
 "Site_index_file_path":"siteindex.txt",
+# folder where the rasters above are kept as binary arrays after they are first read, so later runs (and ensemble members)
+# start faster by memory-mapping them; a raster is read again when its file changes (None = always read the ascii grids)
+"RASTER_CACHE_DIR":None,
 
 
 # function gets called once per year: inputs=year, outputs=boolean (True means write this years data to HDF, False no write)
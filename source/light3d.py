@@ -1,34 +1,261 @@
 import numpy as np
 import math
+import time
 import numba
 
+def set_light_threads(nthreads):
+    """
+    Set the number of threads used by the parallel light kernel.
+
+    Parameters: nthreads -- the number of threads to use; 0 means use all of the cores available to numba
+
+    Returns:    nthreads -- the number of threads the parallel light kernel will actually run with
+    """
+    max_threads = numba.config.NUMBA_NUM_THREADS
+    if nthreads <= 0 or nthreads > max_threads:
+        nthreads = max_threads
+    if hasattr(numba, 'set_num_threads'):
+        numba.set_num_threads(nthreads)
+    elif nthreads != max_threads:
+        # older numba versions fix the size of the thread pool when numba is first imported
+        print 'Info :: this numba version cannot change the thread count at runtime, set NUMBA_NUM_THREADS=%d in the environment instead' % nthreads
+        nthreads = max_threads
+    return nthreads
+
+
 @numba.jit
 def compute_3D_light_matrix(actual_leaf_area_3D_mat, 
                             dem_offset_index_mat,
                             radiation_fraction_mat,  
                             x_size_m, y_size_m, z_size_m,
-                            list_of_grid_steps_and_proportion_tuples):
+                            list_of_grid_steps_and_proportion_tuples,
+                            parallel=False, engine='per_arrow', ray_tables=None, canopy_bound=False,
+                            tolerance=0., light_stats=None, light_state=None, change_threshold=0., tile_size=0,
+                            leaf_area_segments=None, count=False, out=None):
     """
     Using the Beer-Lambert law to compute the proportion of light (0 to 1) that reaches each point in
     3D space (limited to input of actual leaf area matrix dimesions).
+
+    Set parallel to True to spread the plots across all of the threads set by set_light_threads();
+    every voxel is computed with exactly the same arithmetic as the serial version, so the results are identical.
+
+    The engine selects how the "arrows" are traced:
+        'per_arrow' -- sweep the whole grid once for each arrow (the original light code)
+        'fused'     -- visit every voxel once and shoot all of the arrows from it, so the leaf area and
+                       light matrices are streamed through once instead of once per arrow (identical results)
+        'tables'    -- like 'fused', but the path of every arrow is read from the ray_tables pre-computed by
+                       build_ray_tables() at initialization (identical results). The voxels below the terrain
+                       horizon of an arrow (see compute_ray_horizons_numba) are shaded from it without tracing.
+                       With canopy_bound set, the voxels above every canopy top (and terrain) an arrow can reach
+                       are given full light without tracing them (identical results, see compute_ray_clear_heights).
+        'prefix_sum' -- only for arrows straight up (LIGHT_MODE '1D', see compute_1D_light_matrix); the leaf area
+                       above every voxel comes from a reverse cumulative sum over each column
+
+    With a tolerance > 0, the 'fused' and 'tables' engines stop tracing an arrow as soon as the light it could still
+    deliver (proportion * exp(-XK * accumulated leaf area) * radiation fraction) is at most the tolerance. The light
+    is then over-estimated by at most that amount per arrow. If a light_stats dictionary is passed in, the largest
+    possible error of any voxel (summed over the arrows that stopped early) is stored as light_stats['max_light_error'].
+
+    Pass the same light_state dictionary every year to update the light incrementally with the 'tables' engine.
+    The plots whose leaf area changed by more than change_threshold in any voxel since the light was last computed
+    are found, and only the voxels with an arrow that can pass through one of those changes are traced again; every other
+    voxel keeps the available light of the previous call (identical results for a change_threshold of 0).
+    The number of voxels traced is stored as light_stats['voxels_refreshed'].
+
+    With a tile_size > 0, the 'tables' engine visits the grid in tiles of tile_size x tile_size plots, one arrow at a
+    time within each tile, so the leaf area columns stay in the cache (identical results, faster on large grids).
+
+    The available light matrix has the precision of actual_leaf_area_3D_mat, so a float32 leaf area halves the memory
+    of both matrices. The leaf area along each ray is still summed in a float64 scalar.
+
+    The 'tables' engine can read the leaf area from leaf_area_segments instead of actual_leaf_area_3D_mat: each plot
+    column stored as runs of constant leaf area (see build_leaf_area_segments_numba). The arrows skip the plots without
+    leaves and the air above and below the crowns without reading any leaf area, which pays off on young and patchy
+    stands (identical results).
+
+    With count set, the kernels of the 'per_arrow', 'fused' and 'tables' engines also count the rays traced, the steps,
+    the rays ended by terrain and the wrap around crossings of every arrow while computing the same light (see
+    count_ray_work), stored as light_stats['light_counters'] (see light_counters_table). Only the 'per_arrow' engine,
+    which sweeps the grid once per arrow, also times each arrow.
+
+    Pass a matrix of the size and precision of actual_leaf_area_3D_mat as out to have the light written into it
+    (e.g. a workspace matrix re-used every year, see workspace.py) instead of a new matrix.
     """
     # the size of the simulation grid
     nx, ny, nz = actual_leaf_area_3D_mat.shape
 
-    # initialize the proportional available light matrix
-    al_3D_mat = np.zeros( (nx, ny, nz) )
+    if out is None:
+        # initialize the proportional available light matrix, in the precision of the leaf area
+        al_3D_mat = np.zeros( (nx, ny, nz), dtype=actual_leaf_area_3D_mat.dtype )
+    else:
+        # every engine overwrites all of the voxels of out
+        al_3D_mat = out
+
+    if tolerance > 0. and engine not in ('fused', 'tables'):
+        raise ValueError('The light tolerance is only supported by the fused and tables light engines')
+    if light_state is not None and engine != 'tables':
+        raise ValueError('Incremental light updates are only supported by the tables light engine')
+    if tile_size > 0 and engine != 'tables':
+        raise ValueError('Tiled light traversal is only supported by the tables light engine')
+    if leaf_area_segments is not None and (engine != 'tables' or light_state is not None or tile_size > 0):
+        raise ValueError('Leaf area segments are only supported by the tables light engine, without incremental updates or tiling')
+    if count and (engine not in ('per_arrow', 'fused', 'tables') or tile_size > 0 or leaf_area_segments is not None or
+                  light_stats is None):
+        raise ValueError('The light counters are only counted by the per_arrow, fused and tables light engines, without '
+                         'tiling or leaf area segments, and are stored in light_stats')
+    # the largest possible error introduced by stopping arrows early, for every plot
+    light_error_vec = np.zeros(nx*ny)
+    # the number of voxels (from the ground up) to compute in every plot
+    refresh_height_vec = np.zeros(nx*ny, dtype=np.int64) + nz
+
+    if engine == 'tables':
+        if ray_tables is None or ray_tables['nz'] != nz:
+            raise ValueError('The ray tables were not built for a %d high leaf area matrix' % nz)
+        arrows_mat = arrows_list_to_array(list_of_grid_steps_and_proportion_tuples)
+        if canopy_bound and z_size_m == 1:
+            # only trace the voxels below the canopy tops each arrow can reach
+            ray_clear_height = compute_ray_clear_heights(actual_leaf_area_3D_mat, dem_offset_index_mat, arrows_mat,
+                                                         ray_tables['ray_start'], ray_tables['ray_column'],
+                                                         leaf_area_segments)
+        else:
+            # trace every voxel
+            ray_clear_height = np.zeros(len(ray_tables['ray_start'])-1, dtype=np.int64) + nz
+        if light_state is not None:
+            if 'leaf_area' in light_state and light_state['leaf_area'].shape == (nx, ny, nz) and \
+                    light_state['leaf_area'].dtype == actual_leaf_area_3D_mat.dtype and z_size_m == 1:
+                # only the voxels with an arrow passing at or below the highest changed voxel of a plot need tracing
+                # (plots without changes are far below any arrow, so they never need it)
+                changed_top_elevation = update_changed_leaf_area_numba(actual_leaf_area_3D_mat, light_state['leaf_area'],
+                                                                       dem_offset_index_mat, change_threshold, -2**40)
+                # arrows that leave the airspace (or hit the ground) at their first step never see the leaf area
+                ray_refresh_height = compute_ray_reach_heights_numba(changed_top_elevation, dem_offset_index_mat, arrows_mat,
+                                                                     ray_tables['ray_start'], ray_tables['ray_column'],
+                                                                     nz, 0)
+                refresh_height_vec = ray_refresh_height.reshape((len(arrows_mat), nx*ny)).max(axis=0)
+                # the voxels that are not computed keep the light and error of the last update
+                al_3D_mat[...] = light_state['available_light']
+                light_error_vec[...] = light_state['light_error']
+            else:
+                light_state['leaf_area'] = actual_leaf_area_3D_mat.copy()
+        counters_mat = make_light_counters(nx*ny, len(arrows_mat), count)
+        if leaf_area_segments is not None:
+            if parallel:
+                sparse_kernel = compute_3D_light_matrix_tables_sparse_numba_parallel
+            else:
+                sparse_kernel = compute_3D_light_matrix_tables_sparse_numba
+            al_3D_mat = sparse_kernel(leaf_area_segments['column_bounds'], leaf_area_segments['column_start'], leaf_area_segments['z_start'],
+                                      leaf_area_segments['z_end'], leaf_area_segments['density'],
+                                      radiation_fraction_mat, x_size_m, y_size_m, z_size_m, arrows_mat,
+                                      ray_tables['ray_start'], ray_tables['ray_column'],
+                                      ray_tables['ray_dem_delta'], ray_clear_height,
+                                      ray_tables['ray_horizon_height'], refresh_height_vec, tolerance, light_error_vec,
+                                      al_3D_mat)
+        elif tile_size > 0:
+            if parallel:
+                al_3D_mat = compute_3D_light_matrix_tables_tiled_numba_parallel(actual_leaf_area_3D_mat, radiation_fraction_mat,
+                                                                                x_size_m, y_size_m, z_size_m, arrows_mat,
+                                                                                ray_tables['ray_start'], ray_tables['ray_column'],
+                                                                                ray_tables['ray_dem_delta'], ray_clear_height,
+                                                                                ray_tables['ray_horizon_height'], refresh_height_vec, tolerance, light_error_vec,
+                                                                                tile_size, al_3D_mat)
+            else:
+                al_3D_mat = compute_3D_light_matrix_tables_tiled_numba(actual_leaf_area_3D_mat, radiation_fraction_mat,
+                                                                       x_size_m, y_size_m, z_size_m, arrows_mat,
+                                                                       ray_tables['ray_start'], ray_tables['ray_column'],
+                                                                       ray_tables['ray_dem_delta'], ray_clear_height,
+                                                                       ray_tables['ray_horizon_height'], refresh_height_vec, tolerance, light_error_vec,
+                                                                       tile_size, al_3D_mat)
+        elif parallel:
+            al_3D_mat = compute_3D_light_matrix_tables_numba_parallel(actual_leaf_area_3D_mat, radiation_fraction_mat,
+                                                                      x_size_m, y_size_m, z_size_m, arrows_mat,
+                                                                      ray_tables['ray_start'], ray_tables['ray_column'],
+                                                                      ray_tables['ray_dem_delta'], ray_clear_height,
+                                                                      ray_tables['ray_horizon_height'], refresh_height_vec, tolerance, light_error_vec,
+                                                                      counters_mat, al_3D_mat)
+        else:
+            al_3D_mat = compute_3D_light_matrix_tables_numba(actual_leaf_area_3D_mat, radiation_fraction_mat,
+                                                             x_size_m, y_size_m, z_size_m, arrows_mat,
+                                                             ray_tables['ray_start'], ray_tables['ray_column'],
+                                                             ray_tables['ray_dem_delta'], ray_clear_height,
+                                                             ray_tables['ray_horizon_height'], refresh_height_vec, tolerance, light_error_vec,
+                                                             counters_mat, al_3D_mat)
+        if count:
+            light_stats['light_counters'] = light_counters_table(arrows_mat, counters_mat, np.nan)
+        if light_state is not None:
+            if 'available_light' in light_state and light_state['available_light'].shape == al_3D_mat.shape and \
+                    light_state['available_light'].dtype == al_3D_mat.dtype:
+                # keep the light of this update in the matrices of the last one
+                light_state['available_light'][...] = al_3D_mat
+                light_state['light_error'][...] = light_error_vec
+            else:
+                light_state['available_light'] = al_3D_mat.copy()
+                light_state['light_error'] = light_error_vec.copy()
+        if light_stats is not None:
+            light_stats['voxels_refreshed'] = np.sum(refresh_height_vec)
+    elif engine == 'prefix_sum':
+        return compute_1D_light_matrix(actual_leaf_area_3D_mat, radiation_fraction_mat,
+                                       x_size_m, y_size_m, z_size_m,
+                                       list_of_grid_steps_and_proportion_tuples, out=out)
+    elif engine == 'fused':
+        arrows_mat = arrows_list_to_array(list_of_grid_steps_and_proportion_tuples)
+        counters_mat = make_light_counters(nx*ny, len(arrows_mat), count)
+        if parallel:
+            al_3D_mat = compute_3D_light_matrix_fused_numba_parallel(actual_leaf_area_3D_mat, dem_offset_index_mat,
+                                                                     radiation_fraction_mat, x_size_m, y_size_m, z_size_m,
+                                                                     arrows_mat, tolerance, light_error_vec,
+                                                                     counters_mat, al_3D_mat)
+        else:
+            al_3D_mat = compute_3D_light_matrix_fused_numba(actual_leaf_area_3D_mat, dem_offset_index_mat,
+                                                            radiation_fraction_mat, x_size_m, y_size_m, z_size_m,
+                                                            arrows_mat, tolerance, light_error_vec,
+                                                            counters_mat, al_3D_mat)
+        if count:
+            light_stats['light_counters'] = light_counters_table(arrows_mat, counters_mat, np.nan)
+    elif engine != 'per_arrow':
+        raise ValueError('Unknown light engine : %s' % engine)
+
+    if engine in ('fused', 'tables'):
+        if light_stats is not None:
+            light_stats['max_light_error'] = np.max(light_error_vec)
+        return al_3D_mat
+
+    if out is not None:
+        # the per arrow kernels add up the light of the arrows
+        al_3D_mat[...] = 0.
+
+    # the counts of every plot are kept apart, so the parallel sweep needs no locking (empty to count nothing)
+    counters_mat = np.zeros((nx*ny if count else 0, 1, 4), dtype=np.int64)
+    arrow_counters_mat = np.zeros((len(list_of_grid_steps_and_proportion_tuples), 4), dtype=np.int64)
+    seconds_vec = np.zeros(len(list_of_grid_steps_and_proportion_tuples))
 
     # iterate through all of the "arrows" shot through the "trees" to collect the
     # "number of leaves" the "arrow" passes through; these define each direction of a light
     # source as well as the proportion of light that comes from that direction
     # Note : dx, dy, dz are float values
-    for dx,dy,dz,proportion in list_of_grid_steps_and_proportion_tuples:
-        al_3D_mat = compute_3D_light_matrix_numba(actual_leaf_area_3D_mat, 
-                                    dem_offset_index_mat,
-                                    radiation_fraction_mat,  
-                                    x_size_m, y_size_m, z_size_m,
-                                    dx,dy,dz,proportion,
-                                    al_3D_mat) #updated
+    for a, (dx,dy,dz,proportion) in enumerate(list_of_grid_steps_and_proportion_tuples):
+        start_time = time.time()
+        if parallel:
+            al_3D_mat = compute_3D_light_matrix_numba_parallel(actual_leaf_area_3D_mat, 
+                                        dem_offset_index_mat,
+                                        radiation_fraction_mat,  
+                                        x_size_m, y_size_m, z_size_m,
+                                        dx,dy,dz,proportion,
+                                        counters_mat,
+                                        al_3D_mat) #updated
+        else:
+            al_3D_mat = compute_3D_light_matrix_numba(actual_leaf_area_3D_mat, 
+                                        dem_offset_index_mat,
+                                        radiation_fraction_mat,  
+                                        x_size_m, y_size_m, z_size_m,
+                                        dx,dy,dz,proportion,
+                                        counters_mat,
+                                        al_3D_mat) #updated
+        if count:
+            seconds_vec[a] = time.time() - start_time
+            arrow_counters_mat[a] = counters_mat.sum(axis=(0,1))
+    if count:
+        light_stats['light_counters'] = light_counters_table(arrows_list_to_array(list_of_grid_steps_and_proportion_tuples),
+                                                             arrow_counters_mat, seconds_vec)
     return al_3D_mat
 
 @numba.jit(nopython=True)
@@ -37,10 +264,8 @@ def compute_3D_light_matrix_numba(actual_leaf_area_3D_mat,
                                     radiation_fraction_mat,  
                                     x_size_m, y_size_m, z_size_m,
                                     dx,dy,dz,proportion,
+                                    counters_mat,
                                     al_3D_mat):
-    # the plot area (m2)
-    plot_area = (x_size_m * y_size_m)
-
     # Beer-Lambert's constant coefficient for light extinction
     XK = 0.4
 
@@ -54,67 +279,14 @@ def compute_3D_light_matrix_numba(actual_leaf_area_3D_mat,
     # the current "arrow" direction 
     for x in xrange(nx):   #boxes of the 3D grid that is comprised of plot grid & vertical airspace above the simulation domain
         for y in xrange(ny):   #boxes
+            if counters_mat.shape[0] > 0:
+                # count the work of this plot for this arrow (see count_ray_work)
+                counters_mat[x*ny + y,0,:] = 0
             for z in xrange(nz):   #boxes
                 # accumulate the leaf area that this "arrow" will shoot through; include wrap around
-                accumulated_leaf_area = 0
-                ## start accumulating 1 step away from our starting position
-                #ix, iy, iz = calculate_ala_index(x, y, z,     # the current index position
-                #                                 dx, dy, dz,  # the index step in each direction, one of these has been normalized and =1
-                #                                 nx, ny, nz,  # the maximum index for each location
-                #                                 dem_offset_index_mat) # tracks the dem offset index values under each x,y plot
-                # increment the x,y positions (include wrap around)
-                ax = float(x) + dx    #boxes
-                ay = float(y) + dy    #boxes
-                ix = int(round(ax) % nx)    #boxes, wrap-around
-                iy = int(round(ay) % ny)    #boxes, wrap-around
-                # For performance reasons, the leaf area columns are stored independant of the DEM.
-                # This means we have to do a little math to compute where the "arrow" will lie within
-                # the neighboring plot leaf area column, and then compute the z index within that column.
-                az = float(z) + dz   #boxes
-                iz = int(round(az)) + dem_offset_index_mat[x,y] - dem_offset_index_mat[ix,iy]  #boxes
-                az = az + z_size_m * (dem_offset_index_mat[x,y] - dem_offset_index_mat[ix,iy])   #boxes, TODO: come back to see if z_size_m here is a bug
-
-                # accumulate until hit the top of the airspace computed in the z direction
-                while iz < nz:
-                    # test if we hit ground
-                    if iz < 0:
-                        # The current arrow hit ground, so done tracing, and the actual leaf area is whatever
-                        # has been accumulated thus far. Note: This approach by itself does not cause
-                        # shading due to terrain (north vs south slopes), but that terrain shading will
-                        # be handled in the scaling below.
-                        ### Option 0: Pass through rock without ALA accumulation, but continue accumulating on the other side of the rock.
-                        #actual_leaf_area_val = 0.0 #comment out break to use this; 
-                        #               #rock doesn't accumulate actual leaf area, but ray wraps around and continues accumulating ALA until MH (sky)
-
-                        ## Option 1: ALA is very large when the light ray trace encounters terrain/ground. This works to stop light from traveling through a rock,
-                        ##            but causes valley shading when on the side of a mountain with wrap-around.
-                        accumulated_leaf_area = 10e20 #comment in break; terrain breaks the ray trace, no light passes through, so total shade along this ray
-                        break
-
-                        ## Option 2 : Ray stops when light ray trace hits a rock. This could lead to bright spots right next to the rock.
-                        #break #if above two lines commented out: accumulate actual leaf area along ray trace until hit terrain, but
-
-                    # accumulate the leaf area at this location and account for the ray path length
-                    actual_leaf_area_val = actual_leaf_area_3D_mat[ix,iy,iz] #this is now the LAI 3-D matrix
-                    accumulated_leaf_area = accumulated_leaf_area + (actual_leaf_area_val * path_length)
-                    # move to the next location in the ray path
-                    #ix, iy, iz = calculate_ala_index(ix, iy, iz,  # the current index position
-                    #                                 dx, dy, dz,  # the index step in each direction
-                    #                                 nx, ny, nz,  # the maximum index for each location
-                    #                                 dem_offset_index_mat) # tracks the dem offset index values under each x,y plot
-                    # increment the x,y positions (include wrap around)
-                    ax = ax + dx
-                    ay = ay + dy
-                    prev_ix = ix
-                    prev_iy = iy
-                    ix = int(round(ax) % nx)
-                    iy = int(round(ay) % ny)
-                    # For performance reasons, the leaf area columns are stored independant of the DEM.
-                    # This means we have to do a little math to compute where the "arrow" will lie within
-                    # the neighboring plot leaf area column, and then compute the z index within that column.
-                    az = az + dz
-                    iz = int(round(az)) + dem_offset_index_mat[prev_ix,prev_iy] - dem_offset_index_mat[ix,iy]
-                    az = az + z_size_m * (dem_offset_index_mat[prev_ix,prev_iy] - dem_offset_index_mat[ix,iy])
+                accumulated_leaf_area = trace_ray_leaf_area(actual_leaf_area_3D_mat, dem_offset_index_mat,
+                                                            x, y, z, dx, dy, dz, z_size_m, path_length, np.inf,
+                                                            counters_mat, x*ny + y, 0)
 
                 # normalize the accumulated leaf area (m^2) to plot area (m^2) (aka leaf area index)
                 #lai = accumulated_leaf_area / plot_area #no longer need to divide by plot area here, b/c do this in the compute_actual_leaf_area function
@@ -127,6 +299,1165 @@ def compute_3D_light_matrix_numba(actual_leaf_area_3D_mat,
     return al_3D_mat
 
 
+@numba.jit(nopython=True, parallel=True)
+def compute_3D_light_matrix_numba_parallel(actual_leaf_area_3D_mat, 
+                                           dem_offset_index_mat,
+                                           radiation_fraction_mat,  
+                                           x_size_m, y_size_m, z_size_m,
+                                           dx,dy,dz,proportion,
+                                           counters_mat,
+                                           al_3D_mat):
+    """
+    Same as compute_3D_light_matrix_numba, but the plots (x,y columns) are spread across threads.
+    Each thread only writes to the columns (and counters) it owns, so no locking is needed and the results are identical.
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+
+    # the size of the simulation grid
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+
+    # the leaf area accumulations will be scaled by the ray path length
+    path_length = math.sqrt((dx*x_size_m)**2 + (dy*y_size_m)**2 + (dz*z_size_m)**2)
+    # flatten the x,y plot loops so that small grids (such as 181x12) still keep every thread busy
+    for xy in numba.prange(nx*ny):
+        x = xy // ny
+        y = xy % ny
+        if counters_mat.shape[0] > 0:
+            counters_mat[xy,0,:] = 0
+        for z in xrange(nz):
+            accumulated_leaf_area = trace_ray_leaf_area(actual_leaf_area_3D_mat, dem_offset_index_mat,
+                                                        x, y, z, dx, dy, dz, z_size_m, path_length, np.inf,
+                                                        counters_mat, xy, 0)
+            al_3D_mat[x,y,z] = al_3D_mat[x,y,z] + proportion * math.exp(-XK * accumulated_leaf_area) * radiation_fraction_mat[x,y]
+
+    return al_3D_mat
+
+
+# the columns of the light counters table (see light_counters_table)
+LIGHT_COUNTER_COLUMNS = ('dx', 'dy', 'dz', 'proportion', 'rays_traced', 'mean_steps_per_ray',
+                         'rays_ended_by_terrain', 'wrap_crossings', 'seconds')
+
+
+def light_counters_table(arrows_mat, counters_mat, seconds_vec):
+    """
+    Sum the work counted by a light engine into one row per arrow.
+
+    Parameters: arrows_mat -- the arrows as rows of dx, dy, dz, proportion (see arrows_list_to_array)
+                counters_mat -- the counts of each arrow, size: ..., narrows, 4 (rays traced, steps, rays ended by
+                                terrain, wrap around crossings), summed over all of the leading axes
+                seconds_vec -- the time taken by each arrow, NaN for the engines that trace all of the arrows of a
+                               voxel at once (they do not spend their time one arrow after the other)
+
+    Returns: a table with one row per arrow and the columns LIGHT_COUNTER_COLUMNS:
+             dx, dy, dz, proportion  -- the arrow
+             rays_traced             -- the number of voxels whose ray takes at least one step
+             mean_steps_per_ray      -- the mean number of voxels each of these rays passes through
+             rays_ended_by_terrain   -- the number of rays that hit the ground
+             wrap_crossings          -- the number of times the rays cross the edge of the grid (wrap around)
+             seconds                 -- the time taken to sweep the grid with this arrow
+    """
+    narrows = arrows_mat.shape[0]
+    counts = counters_mat.reshape((-1, narrows, 4)).sum(axis=0)
+    counters_table = np.zeros((narrows, len(LIGHT_COUNTER_COLUMNS)))
+    counters_table[:,:4] = arrows_mat
+    counters_table[:,4] = counts[:,0]
+    counters_table[:,5] = counts[:,1] / np.maximum(counts[:,0], 1.)
+    counters_table[:,6] = counts[:,2]
+    counters_table[:,7] = counts[:,3]
+    counters_table[:,8] = seconds_vec
+    return counters_table
+
+
+# the number of blocks of plots the 'fused' and 'tables' kernels count their work in (see light_counter_blocks)
+LIGHT_COUNTER_BLOCKS = 256
+
+
+def make_light_counters(ncolumns, narrows, count):
+    """
+    Returns: the counters_mat to pass to the 'fused' and 'tables' kernels, size: nblocks, narrows, 4 (rays traced,
+             steps, rays ended by terrain, wrap around crossings), empty to count nothing if count is not set
+    """
+    if not count:
+        return np.zeros((0, narrows, 4), dtype=np.int64)
+    return np.zeros((min(ncolumns, LIGHT_COUNTER_BLOCKS), narrows, 4), dtype=np.int64)
+
+
+@numba.jit(nopython=True)
+def light_counter_blocks(ncolumns, counters_mat):
+    """
+    Split the plots (flat index x*ny + y) into the blocks the 'fused' and 'tables' kernels hand to the threads.
+    Each block counts its work in its own row of counters_mat, so no locking is needed; with an empty counters_mat
+    every plot is a block of its own.
+
+    Returns: nblocks    -- the number of blocks
+             block_size -- the number of plots in each block (the last one may have fewer)
+    """
+    nblocks = ncolumns
+    if counters_mat.shape[0] > 0:
+        nblocks = counters_mat.shape[0]
+    block_size = (ncolumns + nblocks - 1) // nblocks
+    return nblocks, block_size
+
+
+@numba.jit(nopython=True)
+def count_ray_work(counters_mat, block, a, steps, accumulated_leaf_area, wrap_crossings):
+    """
+    Add the work of one ray of arrow a to counters_mat[block,a]: rays traced (rays taking at least one step),
+    steps, rays ended by terrain and wrap around crossings.
+    """
+    if steps > 0:
+        counters_mat[block,a,0] += 1
+    counters_mat[block,a,1] += steps
+    if accumulated_leaf_area >= 10e20:
+        counters_mat[block,a,2] += 1
+    counters_mat[block,a,3] += wrap_crossings
+
+
+def compute_1D_light_matrix(actual_leaf_area_3D_mat, 
+                            radiation_fraction_mat,  
+                            x_size_m, y_size_m, z_size_m,
+                            list_of_grid_steps_and_proportion_tuples,
+                            out=None):
+    """
+    Compute the available light for "arrows" that all point straight up (independent plot mode, see
+    LightSubroutine.build_arrows_list_independent). A vertical arrow never leaves its own plot or hits the ground,
+    so the leaf area it passes through from height z is the sum of the column above z. This is computed for all
+    plots at once with a reverse cumulative sum, O(nz) per plot instead of O(nz^2) for the ray tracer.
+    The results match the ray tracer up to floating point rounding (the sums are accumulated from the top down).
+    The light is written into out if given (see compute_3D_light_matrix).
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+
+    # the size of the simulation grid
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+
+    # initialize the proportional available light matrix, in the precision of the leaf area
+    if out is None:
+        al_3D_mat = np.zeros( (nx, ny, nz), dtype=actual_leaf_area_3D_mat.dtype )
+    else:
+        al_3D_mat = out
+        al_3D_mat[...] = 0.
+    # the radiation fraction broadcast along every column
+    radiation_fraction_column_mat = radiation_fraction_mat.reshape((nx, ny, 1))
+    for dx,dy,dz,proportion in list_of_grid_steps_and_proportion_tuples:
+        if dx != 0 or dy != 0 or dz != 1:
+            raise ValueError('The 1D light engine only accepts arrows stepping straight up one voxel : received %s, %s, %s' % (dx, dy, dz))
+        # the leaf area accumulations will be scaled by the ray path length
+        path_length = dz * z_size_m
+        # reverse cumulative sum: sum of the leaf area from each height z to the top of the column,
+        # shifted by one so that the sum starts one step above z (the voxel itself is not included)
+        accumulated_leaf_area_mat = np.zeros( (nx, ny, nz), dtype=actual_leaf_area_3D_mat.dtype )
+        accumulated_leaf_area_mat[:,:,:-1] = np.cumsum((actual_leaf_area_3D_mat * path_length)[:,:,:0:-1], axis=2)[:,:,::-1]
+        al_3D_mat += proportion * np.exp(-XK * accumulated_leaf_area_mat) * radiation_fraction_column_mat
+
+    return al_3D_mat
+
+
+def arrows_list_to_array(list_of_grid_steps_and_proportion_tuples):
+    """
+    Convert the list of (dx, dy, dz, proportion) "arrows" into a float matrix that can be handed to nopython kernels.
+
+    Returns: arrows_mat -- size: number of arrows, 4
+    """
+    return np.array(list_of_grid_steps_and_proportion_tuples, dtype=np.float64).reshape(-1, 4)
+
+
+@numba.jit(nopython=True)
+def ray_cutoff_leaf_area(proportion, radiation_fraction, tolerance):
+    """
+    The accumulated leaf area beyond which an arrow can deliver at most tolerance light
+    (infinite if tolerance is 0, so the arrow is always traced to the end).
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+    if tolerance <= 0.:
+        return np.inf
+    full_light = proportion * radiation_fraction
+    if full_light <= tolerance:
+        # even without any leaves this arrow is within the tolerance
+        return 0.
+    return math.log(full_light / tolerance) / XK
+
+
+def compute_3D_light_matrix_fused(actual_leaf_area_3D_mat, 
+                                  dem_offset_index_mat,
+                                  radiation_fraction_mat,  
+                                  x_size_m, y_size_m, z_size_m,
+                                  arrows_mat,
+                                  tolerance, light_error_vec,
+                                  counters_mat,
+                                  al_3D_mat):
+    """
+    Compute the available light from every "arrow" direction in a single pass over the grid.
+    Each voxel sums the arrows in the same order as the per arrow sweep, so the results are identical.
+
+    Parameters: arrows_mat -- the arrows as rows of dx, dy, dz, proportion (see arrows_list_to_array)
+                tolerance  -- stop an arrow once the light it delivers is at most this value (0 to trace to the end)
+                light_error_vec -- for every plot (flat index x*ny + y), set to the largest possible light error
+                                   introduced by stopping arrows early
+                counters_mat -- the work of every block of plots and arrow (see make_light_counters and
+                                light_counter_blocks), empty to count nothing
+                al_3D_mat  -- the available light matrix, overwritten, size: nx, ny, nz
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+
+    # the size of the simulation grid
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    narrows = arrows_mat.shape[0]
+
+    # the leaf area accumulations will be scaled by the ray path length of each arrow
+    path_length_vec = np.zeros(narrows)
+    for a in range(narrows):
+        path_length_vec[a] = math.sqrt((arrows_mat[a,0]*x_size_m)**2 + (arrows_mat[a,1]*y_size_m)**2 + (arrows_mat[a,2]*z_size_m)**2)
+
+    nblocks, block_size = light_counter_blocks(nx*ny, counters_mat)
+    for block in numba.prange(nblocks):
+        if counters_mat.shape[0] > 0:
+            counters_mat[block,:,:] = 0
+        for xy in range(block*block_size, min((block+1)*block_size, nx*ny)):
+            x = xy // ny
+            y = xy % ny
+            radiation_fraction = radiation_fraction_mat[x,y]
+            cutoff_vec = np.zeros(narrows)
+            for a in range(narrows):
+                cutoff_vec[a] = ray_cutoff_leaf_area(arrows_mat[a,3], radiation_fraction, tolerance)
+            max_light_error = 0.
+            for z in range(nz):
+                al = 0.
+                light_error = 0.
+                for a in range(narrows):
+                    accumulated_leaf_area = trace_ray_leaf_area(actual_leaf_area_3D_mat, dem_offset_index_mat,
+                                                                x, y, z, arrows_mat[a,0], arrows_mat[a,1], arrows_mat[a,2],
+                                                                z_size_m, path_length_vec[a], cutoff_vec[a],
+                                                                counters_mat, block, a)
+                    light = arrows_mat[a,3] * math.exp(-XK * accumulated_leaf_area) * radiation_fraction
+                    if accumulated_leaf_area >= cutoff_vec[a]:
+                        # this arrow may have stopped early, the true light is between 0 and what was computed
+                        light_error = light_error + light
+                    al = al + light
+                al_3D_mat[x,y,z] = al
+                max_light_error = max(max_light_error, light_error)
+            light_error_vec[xy] = max_light_error
+
+    return al_3D_mat
+
+# the fused kernel is compiled twice: prange runs as a plain range loop in the serial version
+compute_3D_light_matrix_fused_numba = numba.jit(nopython=True)(compute_3D_light_matrix_fused)
+compute_3D_light_matrix_fused_numba_parallel = numba.jit(nopython=True, parallel=True)(compute_3D_light_matrix_fused)
+
+
+def compute_3D_light_matrix_tables(actual_leaf_area_3D_mat, 
+                                   radiation_fraction_mat,  
+                                   x_size_m, y_size_m, z_size_m,
+                                   arrows_mat,
+                                   ray_start, ray_column, ray_dem_delta,
+                                   ray_clear_height, ray_horizon_height,
+                                   refresh_height_vec,
+                                   tolerance, light_error_vec,
+                                   counters_mat,
+                                   al_3D_mat):
+    """
+    Compute the available light from every "arrow" direction in a single pass over the grid, reading the
+    plot each arrow steps into (and the DEM offset change) from the pre-computed ray tables.
+    The vertical position is stepped with exactly the same arithmetic as trace_ray_leaf_area, so the results are identical.
+
+    Parameters: arrows_mat -- the arrows as rows of dx, dy, dz, proportion (see arrows_list_to_array)
+                ray_start, ray_column, ray_dem_delta -- the ray tables (see build_ray_tables)
+                ray_clear_height -- for each ray in the tables, the height from which the arrow cannot pass through any
+                                    leaf area or hit the ground, so it is not traced (nz to trace every voxel)
+                ray_horizon_height -- for each ray in the tables, the height below which the arrow hits the terrain,
+                                      so it is not traced (see compute_ray_horizons_numba, 0 to trace every voxel)
+                refresh_height_vec -- for every plot (flat index x*ny + y), the number of voxels from the ground up
+                                      to compute (nz to compute every voxel), the voxels above it are left as they are
+                tolerance  -- stop an arrow once the light it delivers is at most this value (0 to trace to the end)
+                light_error_vec -- for every plot (flat index x*ny + y), the largest possible light error
+                                   introduced by stopping arrows early, updated for the computed voxels
+                counters_mat -- the work of every block of plots and arrow (see make_light_counters and
+                                light_counter_blocks), empty to count nothing. The rays that are not traced
+                                (below the terrain horizon, above the clear height, or not refreshed) take no steps.
+                al_3D_mat  -- the available light matrix, size: nx, ny, nz
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+
+    # the size of the simulation grid
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    ncolumns = nx*ny
+    narrows = arrows_mat.shape[0]
+    # view the leaf area as one column per plot, the ray tables store the flat plot index
+    leaf_area_columns = actual_leaf_area_3D_mat.reshape((ncolumns, nz))
+
+    # the leaf area accumulations will be scaled by the ray path length of each arrow
+    path_length_vec = np.zeros(narrows)
+    for a in range(narrows):
+        path_length_vec[a] = math.sqrt((arrows_mat[a,0]*x_size_m)**2 + (arrows_mat[a,1]*y_size_m)**2 + (arrows_mat[a,2]*z_size_m)**2)
+
+    nblocks, block_size = light_counter_blocks(ncolumns, counters_mat)
+    for block in numba.prange(nblocks):
+        if counters_mat.shape[0] > 0:
+            counters_mat[block,:,:] = 0
+        for xy in range(block*block_size, min((block+1)*block_size, ncolumns)):
+            x = xy // ny
+            y = xy % ny
+            radiation_fraction = radiation_fraction_mat[x,y]
+            cutoff_vec = np.zeros(narrows)
+            for a in range(narrows):
+                cutoff_vec[a] = ray_cutoff_leaf_area(arrows_mat[a,3], radiation_fraction, tolerance)
+            refresh_height = refresh_height_vec[xy]
+            max_light_error = 0.
+            if refresh_height < nz:
+                # the voxels that are not computed keep their error
+                max_light_error = light_error_vec[xy]
+            for z in range(refresh_height):
+                al = 0.
+                light_error = 0.
+                for a in range(narrows):
+                    cutoff = cutoff_vec[a]
+                    path_length = path_length_vec[a]
+                    ray = a*ncolumns + xy
+                    # above the clear height the arrow only passes through empty air
+                    last_step = ray_start[ray+1]
+                    if z >= ray_clear_height[ray]:
+                        last_step = ray_start[ray]
+                    if z < ray_horizon_height[ray]:
+                        # below the terrain horizon, total shade along this ray (see trace_ray_leaf_area)
+                        accumulated_leaf_area = 10e20
+                        if counters_mat.shape[0] > 0:
+                            count_ray_work(counters_mat, block, a, 0, accumulated_leaf_area, 0)
+                    else:
+                        accumulated_leaf_area = trace_table_ray_leaf_area(leaf_area_columns, ray_column, ray_dem_delta,
+                                                                          ray_start[ray], last_step,
+                                                                          x, y, z, arrows_mat[a,0], arrows_mat[a,1], arrows_mat[a,2],
+                                                                          nx, ny, z_size_m, path_length, cutoff,
+                                                                          counters_mat, block, a)
+                    light = arrows_mat[a,3] * math.exp(-XK * accumulated_leaf_area) * radiation_fraction
+                    if accumulated_leaf_area >= cutoff:
+                        # this arrow may have stopped early, the true light is between 0 and what was computed
+                        light_error = light_error + light
+                    al = al + light
+                al_3D_mat[x,y,z] = al
+                max_light_error = max(max_light_error, light_error)
+            light_error_vec[xy] = max_light_error
+
+    return al_3D_mat
+
+# the table kernel is compiled twice: prange runs as a plain range loop in the serial version
+compute_3D_light_matrix_tables_numba = numba.jit(nopython=True)(compute_3D_light_matrix_tables)
+compute_3D_light_matrix_tables_numba_parallel = numba.jit(nopython=True, parallel=True)(compute_3D_light_matrix_tables)
+
+
+def compute_3D_light_matrix_tables_tiled(actual_leaf_area_3D_mat, 
+                                         radiation_fraction_mat,  
+                                         x_size_m, y_size_m, z_size_m,
+                                         arrows_mat,
+                                         ray_start, ray_column, ray_dem_delta,
+                                         ray_clear_height, ray_horizon_height,
+                                         refresh_height_vec,
+                                         tolerance, light_error_vec,
+                                         tile_size,
+                                         al_3D_mat):
+    """
+    Same as compute_3D_light_matrix_tables, but the grid is visited in tiles of tile_size x tile_size plots, and
+    within a tile one arrow at a time. The arrows shot in the same direction from neighbouring plots and heights
+    pass through the same leaf area columns, so these stay in the cache instead of being read again for every
+    arrow direction of every voxel. The leaf area of each plot is already a contiguous column (C order, nx, ny, nz),
+    so the layout is kept and only the traversal order changes.
+    The light of every voxel is summed over the arrows in the same order, so the results are identical.
+
+    Parameters: see compute_3D_light_matrix_tables
+                tile_size -- the number of plots along each side of a tile
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+
+    # the size of the simulation grid
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    ncolumns = nx*ny
+    narrows = arrows_mat.shape[0]
+    # view the leaf area as one column per plot, the ray tables store the flat plot index
+    leaf_area_columns = actual_leaf_area_3D_mat.reshape((ncolumns, nz))
+
+    # the leaf area accumulations will be scaled by the ray path length of each arrow
+    path_length_vec = np.zeros(narrows)
+    for a in range(narrows):
+        path_length_vec[a] = math.sqrt((arrows_mat[a,0]*x_size_m)**2 + (arrows_mat[a,1]*y_size_m)**2 + (arrows_mat[a,2]*z_size_m)**2)
+
+    # the tiles are not counted (see compute_3D_light_matrix)
+    no_counters_mat = np.zeros((0, 1, 4), dtype=np.int64)
+    ntiles_x = (nx + tile_size - 1) // tile_size
+    ntiles_y = (ny + tile_size - 1) // tile_size
+    for tile in numba.prange(ntiles_x*ntiles_y):
+        x_start = (tile // ntiles_y) * tile_size
+        y_start = (tile % ntiles_y) * tile_size
+        tile_nx = min(tile_size, nx - x_start)
+        tile_ny = min(tile_size, ny - y_start)
+        # the light and light error of every voxel in the tile, summed one arrow at a time
+        al_tile = np.zeros((tile_nx*tile_ny, nz))
+        light_error_tile = np.zeros((tile_nx*tile_ny, nz))
+        for a in range(narrows):
+            path_length = path_length_vec[a]
+            for tx in range(tile_nx):
+                for ty in range(tile_ny):
+                    x = x_start + tx
+                    y = y_start + ty
+                    xy = x*ny + y
+                    t = tx*tile_ny + ty
+                    radiation_fraction = radiation_fraction_mat[x,y]
+                    cutoff = ray_cutoff_leaf_area(arrows_mat[a,3], radiation_fraction, tolerance)
+                    ray = a*ncolumns + xy
+                    for z in range(refresh_height_vec[xy]):
+                        # above the clear height the arrow only passes through empty air
+                        last_step = ray_start[ray+1]
+                        if z >= ray_clear_height[ray]:
+                            last_step = ray_start[ray]
+                        if z < ray_horizon_height[ray]:
+                            # below the terrain horizon, total shade along this ray (see trace_ray_leaf_area)
+                            accumulated_leaf_area = 10e20
+                        else:
+                            accumulated_leaf_area = trace_table_ray_leaf_area(leaf_area_columns, ray_column, ray_dem_delta,
+                                                                              ray_start[ray], last_step,
+                                                                              x, y, z, arrows_mat[a,0], arrows_mat[a,1], arrows_mat[a,2],
+                                                                              nx, ny, z_size_m, path_length, cutoff,
+                                                                              no_counters_mat, 0, a)
+                        light = arrows_mat[a,3] * math.exp(-XK * accumulated_leaf_area) * radiation_fraction
+                        if accumulated_leaf_area >= cutoff:
+                            # this arrow may have stopped early, the true light is between 0 and what was computed
+                            light_error_tile[t,z] = light_error_tile[t,z] + light
+                        al_tile[t,z] = al_tile[t,z] + light
+
+        # copy the tile back
+        for tx in range(tile_nx):
+            for ty in range(tile_ny):
+                x = x_start + tx
+                y = y_start + ty
+                xy = x*ny + y
+                t = tx*tile_ny + ty
+                refresh_height = refresh_height_vec[xy]
+                max_light_error = 0.
+                if refresh_height < nz:
+                    # the voxels that are not computed keep their error
+                    max_light_error = light_error_vec[xy]
+                for z in range(refresh_height):
+                    al_3D_mat[x,y,z] = al_tile[t,z]
+                    max_light_error = max(max_light_error, light_error_tile[t,z])
+                light_error_vec[xy] = max_light_error
+
+    return al_3D_mat
+
+# the tiled table kernel is compiled twice: prange runs as a plain range loop in the serial version
+compute_3D_light_matrix_tables_tiled_numba = numba.jit(nopython=True)(compute_3D_light_matrix_tables_tiled)
+compute_3D_light_matrix_tables_tiled_numba_parallel = numba.jit(nopython=True, parallel=True)(compute_3D_light_matrix_tables_tiled)
+
+
+@numba.jit(nopython=True)
+def trace_table_ray_leaf_area(leaf_area_columns, ray_column, ray_dem_delta, first_step, last_step,
+                              x, y, z, dx, dy, dz, nx, ny, z_size_m, path_length, cutoff_leaf_area,
+                              counters_mat, block, a):
+    """
+    Step an "arrow" shot from plot x,y at height z through the ray table steps first_step up to (not including)
+    last_step, and return the leaf area it passes through (scaled by the path length of each step). Returns 10e20
+    if the arrow hits the ground. The vertical position is stepped with exactly the same arithmetic as
+    trace_ray_leaf_area. Unless counters_mat is empty, the work along the ray is added to counters_mat[block,a]
+    (see count_table_ray_work).
+    """
+    nz = leaf_area_columns.shape[1]
+    accumulated_leaf_area = 0.
+    steps = 0
+    az = float(z) + dz
+    for step in range(first_step, last_step):
+        # the arrow can no longer deliver more than the tolerance
+        if accumulated_leaf_area >= cutoff_leaf_area:
+            break
+        dem_delta = ray_dem_delta[step]
+        iz = int(round(az)) + dem_delta
+        az = az + z_size_m * dem_delta
+        # left the top of the airspace
+        if iz >= nz:
+            break
+        # hit the ground, total shade along this ray (see trace_ray_leaf_area)
+        if iz < 0:
+            accumulated_leaf_area = 10e20
+            break
+        accumulated_leaf_area = accumulated_leaf_area + (leaf_area_columns[ray_column[step],iz] * path_length)
+        az = az + dz
+        steps += 1
+    if counters_mat.shape[0] > 0:
+        count_table_ray_work(counters_mat, block, a, x, y, dx, dy, nx, ny, steps, accumulated_leaf_area)
+    return accumulated_leaf_area
+
+
+@numba.jit(nopython=True)
+def count_table_ray_work(counters_mat, block, a, x, y, dx, dy, nx, ny, steps, accumulated_leaf_area):
+    """
+    Count the work of a ray traced by trace_table_ray_leaf_area (see count_ray_work). The ray tables do not keep
+    the horizontal position of the arrow, so it is stepped through the voxels passed through (as in
+    trace_ray_leaf_area) to count the wrap around crossings once the ray is traced, keeping the tracing loop as
+    tight as without counting.
+    """
+    wrap_crossings = 0
+    ax = float(x) + dx
+    ay = float(y) + dy
+    # the copy of the grid of the last voxel passed through (0 until the arrow wraps around)
+    last_tile_x = 0
+    last_tile_y = 0
+    for step in range(steps):
+        tile_x = int(round(ax) // nx)
+        tile_y = int(round(ay) // ny)
+        wrap_crossings += abs(tile_x - last_tile_x) + abs(tile_y - last_tile_y)
+        last_tile_x = tile_x
+        last_tile_y = tile_y
+        ax = ax + dx
+        ay = ay + dy
+    count_ray_work(counters_mat, block, a, steps, accumulated_leaf_area, wrap_crossings)
+
+
+def compute_3D_light_matrix_tables_sparse(column_bounds, column_segment_start, segment_z_start, segment_z_end, segment_density,
+                                          radiation_fraction_mat,
+                                          x_size_m, y_size_m, z_size_m,
+                                          arrows_mat,
+                                          ray_start, ray_column, ray_dem_delta,
+                                          ray_clear_height, ray_horizon_height,
+                                          refresh_height_vec,
+                                          tolerance, light_error_vec,
+                                          al_3D_mat):
+    """
+    Same as compute_3D_light_matrix_tables, with the leaf area read from the leaf area segments of each plot
+    (see build_leaf_area_segments_numba) instead of the dense leaf area matrix.
+
+    Parameters: column_bounds, column_segment_start, segment_z_start, segment_z_end, segment_density -- the leaf area
+                segments (see build_leaf_area_segments)
+                see compute_3D_light_matrix_tables for the others
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+
+    # the size of the simulation grid
+    nx, ny, nz = al_3D_mat.shape
+    ncolumns = nx*ny
+    narrows = arrows_mat.shape[0]
+
+    # the leaf area accumulations will be scaled by the ray path length of each arrow
+    path_length_vec = np.zeros(narrows)
+    for a in range(narrows):
+        path_length_vec[a] = math.sqrt((arrows_mat[a,0]*x_size_m)**2 + (arrows_mat[a,1]*y_size_m)**2 + (arrows_mat[a,2]*z_size_m)**2)
+
+    for xy in numba.prange(ncolumns):
+        x = xy // ny
+        y = xy % ny
+        radiation_fraction = radiation_fraction_mat[x,y]
+        cutoff_vec = np.zeros(narrows)
+        for a in range(narrows):
+            cutoff_vec[a] = ray_cutoff_leaf_area(arrows_mat[a,3], radiation_fraction, tolerance)
+        refresh_height = refresh_height_vec[xy]
+        max_light_error = 0.
+        if refresh_height < nz:
+            # the voxels that are not computed keep their error
+            max_light_error = light_error_vec[xy]
+        for z in range(refresh_height):
+            al = 0.
+            light_error = 0.
+            for a in range(narrows):
+                cutoff = cutoff_vec[a]
+                ray = a*ncolumns + xy
+                # above the clear height the arrow only passes through empty air
+                last_step = ray_start[ray+1]
+                if z >= ray_clear_height[ray]:
+                    last_step = ray_start[ray]
+                if z < ray_horizon_height[ray]:
+                    # below the terrain horizon, total shade along this ray (see trace_ray_leaf_area)
+                    accumulated_leaf_area = 10e20
+                else:
+                    accumulated_leaf_area = trace_segment_ray_leaf_area(column_bounds, column_segment_start, segment_z_start, segment_z_end,
+                                                                        segment_density, nz, ray_column, ray_dem_delta,
+                                                                        ray_start[ray], last_step, z, arrows_mat[a,2],
+                                                                        z_size_m, path_length_vec[a], cutoff)
+                light = arrows_mat[a,3] * math.exp(-XK * accumulated_leaf_area) * radiation_fraction
+                if accumulated_leaf_area >= cutoff:
+                    # this arrow may have stopped early, the true light is between 0 and what was computed
+                    light_error = light_error + light
+                al = al + light
+            al_3D_mat[x,y,z] = al
+            max_light_error = max(max_light_error, light_error)
+        light_error_vec[xy] = max_light_error
+
+    return al_3D_mat
+
+# the sparse table kernel is compiled twice: prange runs as a plain range loop in the serial version
+compute_3D_light_matrix_tables_sparse_numba = numba.jit(nopython=True)(compute_3D_light_matrix_tables_sparse)
+compute_3D_light_matrix_tables_sparse_numba_parallel = numba.jit(nopython=True, parallel=True)(compute_3D_light_matrix_tables_sparse)
+
+
+@numba.jit(nopython=True)
+def trace_segment_ray_leaf_area(column_bounds, column_segment_start, segment_z_start, segment_z_end, segment_density, nz,
+                                ray_column, ray_dem_delta, first_step, last_step,
+                                z, dz, z_size_m, path_length, cutoff_leaf_area):
+    """
+    Same as trace_table_ray_leaf_area, with the leaf area of each plot read from its leaf area segments.
+    A step into a plot without leaves, or below or above its crowns, adds nothing and only reads the bounds
+    of the plot (column_bounds, see build_leaf_area_segments).
+    """
+    accumulated_leaf_area = 0.
+    az = float(z) + dz
+    for step in range(first_step, last_step):
+        # the arrow can no longer deliver more than the tolerance
+        if accumulated_leaf_area >= cutoff_leaf_area:
+            break
+        dem_delta = ray_dem_delta[step]
+        iz = int(round(az)) + dem_delta
+        az = az + z_size_m * dem_delta
+        # left the top of the airspace
+        if iz >= nz:
+            break
+        # hit the ground, total shade along this ray (see trace_ray_leaf_area)
+        if iz < 0:
+            accumulated_leaf_area = 10e20
+            break
+        az = az + dz
+        column = ray_column[step]
+        # empty air: no leaves in this plot, or below or above all of its segments
+        if iz < column_bounds[column,0] or iz >= column_bounds[column,1]:
+            continue
+        segment = column_segment_start[column]
+        while segment_z_end[segment] <= iz:
+            segment += 1
+        if iz >= segment_z_start[segment]:
+            accumulated_leaf_area = accumulated_leaf_area + (segment_density[segment] * path_length)
+    return accumulated_leaf_area
+
+
+@numba.jit(nopython=True)
+def store_column_segments(column, segment, segment_z_start, segment_z_end, segment_density):
+    """
+    Split a leaf area column into segments of constant, non-zero leaf area, stored from index segment on
+    (the segments are only counted if segment_density is empty).
+
+    Returns: the index after the last segment of the column
+    """
+    nz = column.shape[0]
+    z = 0
+    while z < nz:
+        if column[z] == 0.:
+            z += 1
+            continue
+        z_end = z + 1
+        while z_end < nz and column[z_end] == column[z]:
+            z_end += 1
+        if segment_density.shape[0] > 0:
+            segment_z_start[segment] = z
+            segment_z_end[segment] = z_end
+            segment_density[segment] = column[z]
+        segment += 1
+        z = z_end
+    return segment
+
+
+@numba.jit(nopython=True)
+def build_leaf_area_segments_numba(actual_leaf_area_3D_mat):
+    """
+    Store the leaf area matrix as segments of constant leaf area in every plot column (run length encoding), in the
+    same precision. The segments of plot x,y (flat index x*ny + y) are segment_z_start[s], segment_z_end[s] (excluded)
+    and segment_density[s] for s from column_segment_start[x*ny + y] up to column_segment_start[x*ny + y + 1].
+
+    Returns: column_segment_start, segment_z_start, segment_z_end, segment_density
+    """
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    column_segment_start = np.zeros(nx*ny+1, dtype=np.int64)
+    no_z = np.zeros(0, dtype=np.int32)
+    no_density = np.zeros(0, dtype=actual_leaf_area_3D_mat.dtype)
+    # count the segments of each column, then store them
+    for x in range(nx):
+        for y in range(ny):
+            xy = x*ny + y
+            column_segment_start[xy+1] = store_column_segments(actual_leaf_area_3D_mat[x,y], column_segment_start[xy],
+                                                               no_z, no_z, no_density)
+    nsegments = column_segment_start[nx*ny]
+    segment_z_start = np.zeros(nsegments, dtype=np.int32)
+    segment_z_end = np.zeros(nsegments, dtype=np.int32)
+    segment_density = np.zeros(nsegments, dtype=actual_leaf_area_3D_mat.dtype)
+    for x in range(nx):
+        for y in range(ny):
+            store_column_segments(actual_leaf_area_3D_mat[x,y], column_segment_start[x*ny + y],
+                                  segment_z_start, segment_z_end, segment_density)
+    return column_segment_start, segment_z_start, segment_z_end, segment_density
+
+
+def leaf_area_segments_dict(column_start, z_start, z_end, density):
+    """
+    Returns: the leaf area segments as the dictionary passed to compute_3D_light_matrix, with the bottom of the lowest
+             and the top of the highest segment of every plot column added as 'column_bounds' (0, 0 without leaves),
+             size: nx*ny, 2
+    """
+    has_leaves = column_start[1:] > column_start[:-1]
+    column_bounds = np.zeros((len(has_leaves), 2), dtype=np.int32)
+    column_bounds[has_leaves,0] = z_start[column_start[:-1][has_leaves]]
+    column_bounds[has_leaves,1] = z_end[column_start[1:][has_leaves] - 1]
+    return dict(column_bounds=column_bounds, column_start=column_start, z_start=z_start, z_end=z_end, density=density)
+
+
+def build_leaf_area_segments(actual_leaf_area_3D_mat):
+    """
+    Returns: the leaf area segments of every plot column (see build_leaf_area_segments_numba and leaf_area_segments_dict)
+    """
+    return leaf_area_segments_dict(*build_leaf_area_segments_numba(np.ascontiguousarray(actual_leaf_area_3D_mat)))
+
+
+@numba.jit(nopython=True)
+def compute_ray_reach_heights_numba(top_elevation_vec, dem_offset_index_mat, arrows_mat, ray_start, ray_column, nz,
+                                    steep_reach_height):
+    """
+    For every ray in the ray tables, compute the height below which the arrow can pass through a plot at or below
+    the given top elevation (DEM offset index) of that plot.
+
+    Every arrow rises at least one voxel per step (dz >= 1), so an arrow shot from height z of plot x,y is at
+    least k voxels above DEM offset + z at step k (counting from 1). An arrow shot from height
+    top elevation - DEM offset - k + 1 or higher therefore passes above the top elevation of the plot at step k.
+    The plots of the ray shot from the ground are a superset of all of the rays shot from the same plot.
+    Arrows with a vertical step larger than the airspace (build_arrows_list can return steps of ~1e16 and more)
+    leave the top of the airspace, or hit the ground when the step is too large to round to an integer index, at their
+    first step whatever the leaf area is; they return steep_reach_height. Other arrows with unusual steps return nz.
+
+    Parameters: top_elevation_vec -- the top elevation for every plot (flat index x*ny + y)
+                steep_reach_height -- the reach height returned for arrows with a vertical step larger than the airspace
+
+    Returns: ray_reach_height -- the reach height for each ray, between 0 and nz
+    """
+    nx, ny = dem_offset_index_mat.shape
+    ncolumns = nx*ny
+    nrays = len(ray_start) - 1
+    # the largest step that still rounds to a valid integer index all the way through the airspace
+    MAX_STEP = 2.**31
+    ray_reach_height = np.zeros(nrays, dtype=np.int64)
+    for ray in range(nrays):
+        a = ray // ncolumns
+        xy = ray % ncolumns
+        if arrows_mat[a,2] > MAX_STEP:
+            ray_reach_height[ray] = steep_reach_height
+            continue
+        if arrows_mat[a,2] < 1. or abs(arrows_mat[a,0]) > MAX_STEP or abs(arrows_mat[a,1]) > MAX_STEP:
+            ray_reach_height[ray] = nz
+            continue
+        # the plot itself is included in case the arrow does not move sideways
+        highest_elevation = top_elevation_vec[xy]
+        for step in range(ray_start[ray], ray_start[ray+1]):
+            highest_elevation = max(highest_elevation, top_elevation_vec[ray_column[step]] - (step - ray_start[ray]))
+        reach_height = highest_elevation - dem_offset_index_mat[xy // ny, xy % ny]
+        ray_reach_height[ray] = min(max(reach_height, 0), nz)
+
+    return ray_reach_height
+
+
+def compute_ray_clear_heights(actual_leaf_area_3D_mat, dem_offset_index_mat, arrows_mat, ray_start, ray_column,
+                              leaf_area_segments=None):
+    """
+    For every ray in the ray tables, compute the height from which the arrow cannot pass through any leaf area
+    or hit the ground (see compute_ray_reach_heights_numba). These voxels get full light from the arrow without
+    tracing it, so the time spent on light scales with the height of the canopy instead of the height of the airspace.
+    With leaf_area_segments, the canopy tops are read from the segments instead of the leaf area matrix.
+
+    Returns: ray_clear_height -- the clear height for each ray, between 0 and nz
+    """
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    # the elevation (DEM offset index) of the highest leaf in every plot, the ground level - 1 for plots without leaves
+    if leaf_area_segments is not None:
+        canopy_top = (leaf_area_segments['column_bounds'][:,1] - 1).reshape(nx, ny)
+    else:
+        has_leaves = actual_leaf_area_3D_mat != 0.
+        canopy_top = np.where(np.any(has_leaves, axis=2), nz - 1 - np.argmax(has_leaves[:,:,::-1], axis=2), -1)
+    canopy_top_elevation = (dem_offset_index_mat + canopy_top).astype(np.int64).reshape(nx*ny)
+    # arrows that may hit the ground at their first step are always traced
+    return compute_ray_reach_heights_numba(canopy_top_elevation, dem_offset_index_mat, arrows_mat, ray_start, ray_column,
+                                           nz, nz)
+
+
+@numba.jit(nopython=True)
+def update_changed_leaf_area_numba(actual_leaf_area_3D_mat, reference_leaf_area_3D_mat, dem_offset_index_mat,
+                                   change_threshold, unchanged_elevation):
+    """
+    Find the highest voxel in every plot where the leaf area changed by more than change_threshold from the
+    reference leaf area (the leaf area the available light was last computed with), and copy the leaf area of
+    that voxel and every voxel below it into the reference. Smaller changes stay out of the reference, so they add up
+    from year to year until they pass the threshold.
+
+    Returns: changed_top_elevation -- the elevation (DEM offset index) of the highest changed voxel of every plot
+                                      (flat index x*ny + y), unchanged_elevation for plots that did not change
+    """
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    changed_top_elevation = np.zeros(nx*ny, dtype=np.int64) + unchanged_elevation
+    for x in range(nx):
+        for y in range(ny):
+            for z in range(nz-1, -1, -1):
+                if abs(actual_leaf_area_3D_mat[x,y,z] - reference_leaf_area_3D_mat[x,y,z]) > change_threshold:
+                    changed_top_elevation[x*ny + y] = dem_offset_index_mat[x,y] + z
+                    for zz in range(z+1):
+                        reference_leaf_area_3D_mat[x,y,zz] = actual_leaf_area_3D_mat[x,y,zz]
+                    break
+    return changed_top_elevation
+
+
+@numba.jit(nopython=True)
+def compute_ray_horizons_numba(arrows_mat, ray_start, ray_dem_delta, nz, z_size_m):
+    """
+    For every ray in the ray tables, find the terrain horizon: the height below which the arrow hits the terrain
+    (the DEM of a plot it passes through) before it leaves the top of the airspace, and the step at which it does.
+    This only depends on the DEM, so it is computed once with the ray tables. Every height is stepped with exactly the
+    same arithmetic as trace_table_ray_leaf_area, from the ground up until an arrow leaves the airspace.
+
+    Returns: ray_horizon_height -- for each ray, the number of heights from the ground up where the arrow hits the terrain
+             ray_horizon_step   -- for each ray, the step (counted from the start of the ray) at which the arrow shot
+                                   from just below the horizon height hits the terrain, -1 for rays that never do
+    """
+    nrays = len(ray_start) - 1
+    ncolumns = nrays // arrows_mat.shape[0]
+    ray_horizon_height = np.zeros(nrays, dtype=np.int32)
+    ray_horizon_step = np.zeros(nrays, dtype=np.int32) - 1
+    for ray in range(nrays):
+        dz = arrows_mat[ray // ncolumns, 2]
+        for z in range(nz):
+            terrain_step = -1
+            az = float(z) + dz
+            for step in range(ray_start[ray], ray_start[ray+1]):
+                dem_delta = ray_dem_delta[step]
+                iz = int(round(az)) + dem_delta
+                az = az + z_size_m * dem_delta
+                # left the top of the airspace
+                if iz >= nz:
+                    break
+                # hit the terrain
+                if iz < 0:
+                    terrain_step = step - ray_start[ray]
+                    break
+                az = az + dz
+            if terrain_step < 0:
+                break
+            ray_horizon_height[ray] = z + 1
+            ray_horizon_step[ray] = terrain_step
+    return ray_horizon_height, ray_horizon_step
+
+
+# the layout of the ray tables built by build_ray_tables, part of the key of the tables cached by
+# LightSubroutine.load_or_build_ray_tables: change it whenever the tables change, so older cache files are not read
+RAY_TABLES_FORMAT = 'ray_tables_2'
+
+
+def build_ray_tables(arrows_mat, dem_offset_index_mat, nz, z_size_m):
+    """
+    Pre-compute the path of every "arrow" shot from every plot. The plots an arrow steps through (including wrap around)
+    and the DEM offset change at each step only depend on the arrow, the grid shape and the DEM, so they
+    can be computed once at initialization instead of every year.
+
+    The tables are stored compressed row style: the steps of the arrow a shot from flat plot index xy are
+    ray_start[a*nx*ny + xy] up to (not including) ray_start[a*nx*ny + xy + 1]. Each ray is long enough to
+    leave the top of the airspace when shot from the ground (z = 0), which is the longest possible ray.
+
+    Parameters: arrows_mat -- the arrows as rows of dx, dy, dz, proportion (see arrows_list_to_array)
+                dem_offset_index_mat -- tracks the dem offset index values under each x,y plot
+                nz -- the number of vertical steps in the leaf area matrix the light is computed on
+                z_size_m -- the vertical step size in meters
+
+    Returns: ray_tables -- a dictionary of ray_start, ray_column (flat plot index, x*ny + y),
+                           ray_dem_delta (change in DEM offset index), the terrain horizon of each ray
+                           (ray_horizon_height and ray_horizon_step, see compute_ray_horizons_numba) along with nz
+    """
+    arrows_mat = np.ascontiguousarray(arrows_mat, dtype=np.float64)
+    dem_offset_index_mat = np.ascontiguousarray(dem_offset_index_mat, dtype=np.int64)
+    ray_length = count_ray_steps_numba(arrows_mat, dem_offset_index_mat, nz, z_size_m)
+    ray_start = np.zeros(len(ray_length)+1, dtype=np.int64)
+    ray_start[1:] = np.cumsum(ray_length)
+    ray_column = np.zeros(ray_start[-1], dtype=np.int32)
+    ray_dem_delta = np.zeros(ray_start[-1], dtype=np.int32)
+    fill_ray_tables_numba(arrows_mat, dem_offset_index_mat, nz, z_size_m, ray_start, ray_column, ray_dem_delta)
+    ray_horizon_height, ray_horizon_step = compute_ray_horizons_numba(arrows_mat, ray_start, ray_dem_delta, nz, z_size_m)
+    return {'nz':nz, 'ray_start':ray_start, 'ray_column':ray_column, 'ray_dem_delta':ray_dem_delta,
+            'ray_horizon_height':ray_horizon_height, 'ray_horizon_step':ray_horizon_step}
+
+
+@numba.jit(nopython=True)
+def walk_ground_ray_numba(arrows_mat, dem_offset_index_mat, nz, z_size_m, a, x, y, ray_column, ray_dem_delta, first_step):
+    """
+    Walk the arrow a from the ground of plot x,y (ignoring terrain hits) until it leaves the top of the airspace.
+    If first_step >= 0 the steps are written into the ray tables starting at first_step.
+
+    Returns: the number of steps, including the step that leaves the airspace
+    """
+    nx, ny = dem_offset_index_mat.shape
+    dx = arrows_mat[a,0]
+    dy = arrows_mat[a,1]
+    dz = arrows_mat[a,2]
+    ax = float(x)
+    ay = float(y)
+    az = 0.
+    ix = x
+    iy = y
+    nsteps = 0
+    while True:
+        ax = ax + dx
+        ay = ay + dy
+        az = az + dz
+        prev_ix = ix
+        prev_iy = iy
+        ix = int(round(ax) % nx)
+        iy = int(round(ay) % ny)
+        dem_delta = dem_offset_index_mat[prev_ix,prev_iy] - dem_offset_index_mat[ix,iy]
+        iz = int(round(az)) + dem_delta
+        az = az + z_size_m * dem_delta
+        if first_step >= 0:
+            ray_column[first_step+nsteps] = ix*ny + iy
+            ray_dem_delta[first_step+nsteps] = dem_delta
+        nsteps += 1
+        # a height too large to round to an integer index ends the arrow too (the ray tracer treats it as hitting the ground)
+        if iz >= nz or az > 2.**62:
+            return nsteps
+
+
+@numba.jit(nopython=True)
+def count_ray_steps_numba(arrows_mat, dem_offset_index_mat, nz, z_size_m):
+    nx, ny = dem_offset_index_mat.shape
+    narrows = arrows_mat.shape[0]
+    ray_length = np.zeros(narrows*nx*ny, dtype=np.int64)
+    no_table = np.zeros(0, dtype=np.int32)
+    for a in range(narrows):
+        for x in range(nx):
+            for y in range(ny):
+                ray_length[a*nx*ny + x*ny + y] = walk_ground_ray_numba(arrows_mat, dem_offset_index_mat, nz, z_size_m,
+                                                                       a, x, y, no_table, no_table, -1)
+    return ray_length
+
+
+@numba.jit(nopython=True)
+def fill_ray_tables_numba(arrows_mat, dem_offset_index_mat, nz, z_size_m, ray_start, ray_column, ray_dem_delta):
+    nx, ny = dem_offset_index_mat.shape
+    narrows = arrows_mat.shape[0]
+    for a in range(narrows):
+        for x in range(nx):
+            for y in range(ny):
+                walk_ground_ray_numba(arrows_mat, dem_offset_index_mat, nz, z_size_m,
+                                      a, x, y, ray_column, ray_dem_delta, ray_start[a*nx*ny + x*ny + y])
+
+
+@numba.jit(nopython=True)
+def trace_ray_leaf_area(actual_leaf_area_3D_mat, dem_offset_index_mat,
+                        x, y, z,      # the voxel the "arrow" is shot from
+                        dx, dy, dz,   # the index step in each direction, one of these has been normalized and =1
+                        z_size_m, path_length,
+                        cutoff_leaf_area,    # stop once this much leaf area is accumulated (np.inf to trace to the end)
+                        counters_mat, block, a):   # add the work along the ray to counters_mat[block,a] (empty to count nothing)
+    """
+    Shoot a single "arrow" from voxel x,y,z towards the light source and return the leaf area it passes through
+    (scaled by the path length of each step). Returns 10e20 if the arrow hits the ground.
+    Unless counters_mat is empty, the work along the ray is counted (see count_ray_work).
+    """
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    accumulated_leaf_area = 0.
+    counting = counters_mat.shape[0] > 0
+    steps = 0
+    wrap_crossings = 0
+    # the copy of the grid of the last voxel passed through (0 until the arrow wraps around)
+    last_tile_x = 0
+    last_tile_y = 0
+    ## start accumulating 1 step away from our starting position
+    #ix, iy, iz = calculate_ala_index(x, y, z,     # the current index position
+    #                                 dx, dy, dz,  # the index step in each direction, one of these has been normalized and =1
+    #                                 nx, ny, nz,  # the maximum index for each location
+    #                                 dem_offset_index_mat) # tracks the dem offset index values under each x,y plot
+    # increment the x,y positions (include wrap around)
+    ax = float(x) + dx    #boxes
+    ay = float(y) + dy    #boxes
+    ix = int(round(ax) % nx)    #boxes, wrap-around
+    iy = int(round(ay) % ny)    #boxes, wrap-around
+    # For performance reasons, the leaf area columns are stored independant of the DEM.
+    # This means we have to do a little math to compute where the "arrow" will lie within
+    # the neighboring plot leaf area column, and then compute the z index within that column.
+    az = float(z) + dz   #boxes
+    iz = int(round(az)) + dem_offset_index_mat[x,y] - dem_offset_index_mat[ix,iy]  #boxes
+    az = az + z_size_m * (dem_offset_index_mat[x,y] - dem_offset_index_mat[ix,iy])   #boxes, TODO: come back to see if z_size_m here is a bug
+
+    # accumulate until hit the top of the airspace computed in the z direction
+    while iz < nz:
+        # stop early once the arrow can no longer deliver a meaningful amount of light (see ray_cutoff_leaf_area)
+        if accumulated_leaf_area >= cutoff_leaf_area:
+            break
+        # test if we hit ground
+        if iz < 0:
+            # The current arrow hit ground, so done tracing, and the actual leaf area is whatever
+            # has been accumulated thus far. Note: This approach by itself does not cause
+            # shading due to terrain (north vs south slopes), but that terrain shading will
+            # be handled in the scaling below.
+            ### Option 0: Pass through rock without ALA accumulation, but continue accumulating on the other side of the rock.
+            #actual_leaf_area_val = 0.0 #comment out break to use this; 
+            #               #rock doesn't accumulate actual leaf area, but ray wraps around and continues accumulating ALA until MH (sky)
+
+            ## Option 1: ALA is very large when the light ray trace encounters terrain/ground. This works to stop light from traveling through a rock,
+            ##            but causes valley shading when on the side of a mountain with wrap-around.
+            accumulated_leaf_area = 10e20 #comment in break; terrain breaks the ray trace, no light passes through, so total shade along this ray
+            break
+
+            ## Option 2 : Ray stops when light ray trace hits a rock. This could lead to bright spots right next to the rock.
+            #break #if above two lines commented out: accumulate actual leaf area along ray trace until hit terrain, but
+
+        if counting:
+            steps += 1
+            tile_x = int(round(ax) // nx)
+            tile_y = int(round(ay) // ny)
+            wrap_crossings += abs(tile_x - last_tile_x) + abs(tile_y - last_tile_y)
+            last_tile_x = tile_x
+            last_tile_y = tile_y
+
+        # accumulate the leaf area at this location and account for the ray path length
+        actual_leaf_area_val = actual_leaf_area_3D_mat[ix,iy,iz] #this is now the LAI 3-D matrix
+        accumulated_leaf_area = accumulated_leaf_area + (actual_leaf_area_val * path_length)
+        # move to the next location in the ray path
+        #ix, iy, iz = calculate_ala_index(ix, iy, iz,  # the current index position
+        #                                 dx, dy, dz,  # the index step in each direction
+        #                                 nx, ny, nz,  # the maximum index for each location
+        #                                 dem_offset_index_mat) # tracks the dem offset index values under each x,y plot
+        # increment the x,y positions (include wrap around)
+        ax = ax + dx
+        ay = ay + dy
+        prev_ix = ix
+        prev_iy = iy
+        ix = int(round(ax) % nx)
+        iy = int(round(ay) % ny)
+        # For performance reasons, the leaf area columns are stored independant of the DEM.
+        # This means we have to do a little math to compute where the "arrow" will lie within
+        # the neighboring plot leaf area column, and then compute the z index within that column.
+        az = az + dz
+        iz = int(round(az)) + dem_offset_index_mat[prev_ix,prev_iy] - dem_offset_index_mat[ix,iy]
+        az = az + z_size_m * (dem_offset_index_mat[prev_ix,prev_iy] - dem_offset_index_mat[ix,iy])
+
+    if counting:
+        count_ray_work(counters_mat, block, a, steps, accumulated_leaf_area, wrap_crossings)
+    return accumulated_leaf_area
+
+
+def compute_3D_light_matrix_window(window_leaf_area_3D_mat,
+                                   dem_offset_index_mat,
+                                   radiation_fraction_mat,
+                                   x_size_m, y_size_m, z_size_m,
+                                   arrows_mat,
+                                   window_x_start, window_y_start,
+                                   x_start, y_start,
+                                   tolerance, light_error_mat,
+                                   al_3D_mat):
+    """
+    Compute the available light of one domain of the grid (see light_domains.py) from a window of the leaf area
+    around it. Every arrow is traced in the coordinates of the whole grid with exactly the same arithmetic as
+    trace_ray_leaf_area (including the wrap around at the edges of the whole grid), so the results are identical.
+
+    Parameters: window_leaf_area_3D_mat -- the leaf area of the plots window_x_start, window_y_start and up (with wrap
+                                           around), size: window nx, window ny, nz
+                dem_offset_index_mat    -- the dem offset index values of the whole grid
+                radiation_fraction_mat  -- the radiation fraction of the plots of the domain
+                arrows_mat              -- the arrows as rows of dx, dy, dz, proportion (see arrows_list_to_array)
+                x_start, y_start        -- the first plot of the domain in the whole grid
+                tolerance               -- stop an arrow once the light it delivers is at most this value (0 to trace to the end)
+                light_error_mat         -- the largest possible light error of every plot of the domain, size: domain nx, domain ny
+                al_3D_mat               -- the available light of the domain, size: domain nx, domain ny, nz
+
+    Returns: the number of arrows that left the window (0 if the window is wide enough, the light of those is wrong)
+    """
+    # Beer-Lambert's constant coefficient for light extinction
+    XK = 0.4
+
+    domain_nx, domain_ny, nz = al_3D_mat.shape
+    narrows = arrows_mat.shape[0]
+
+    # the leaf area accumulations will be scaled by the ray path length of each arrow
+    path_length_vec = np.zeros(narrows)
+    for a in range(narrows):
+        path_length_vec[a] = math.sqrt((arrows_mat[a,0]*x_size_m)**2 + (arrows_mat[a,1]*y_size_m)**2 + (arrows_mat[a,2]*z_size_m)**2)
+
+    arrows_outside = 0
+    for xy in numba.prange(domain_nx*domain_ny):
+        domain_x = xy // domain_ny
+        domain_y = xy % domain_ny
+        radiation_fraction = radiation_fraction_mat[domain_x,domain_y]
+        cutoff_vec = np.zeros(narrows)
+        for a in range(narrows):
+            cutoff_vec[a] = ray_cutoff_leaf_area(arrows_mat[a,3], radiation_fraction, tolerance)
+        max_light_error = 0.
+        for z in range(nz):
+            al = 0.
+            light_error = 0.
+            for a in range(narrows):
+                cutoff = cutoff_vec[a]
+                accumulated_leaf_area = trace_window_ray_leaf_area(window_leaf_area_3D_mat, dem_offset_index_mat,
+                                                                   window_x_start, window_y_start,
+                                                                   x_start + domain_x, y_start + domain_y, z,
+                                                                   arrows_mat[a,0], arrows_mat[a,1], arrows_mat[a,2],
+                                                                   z_size_m, path_length_vec[a], cutoff)
+                if accumulated_leaf_area < 0.:
+                    arrows_outside += 1
+                light = arrows_mat[a,3] * math.exp(-XK * accumulated_leaf_area) * radiation_fraction
+                if accumulated_leaf_area >= cutoff:
+                    # this arrow may have stopped early, the true light is between 0 and what was computed
+                    light_error = light_error + light
+                al = al + light
+            al_3D_mat[domain_x,domain_y,z] = al
+            max_light_error = max(max_light_error, light_error)
+        light_error_mat[domain_x,domain_y] = max_light_error
+
+    return arrows_outside
+
+# the window kernel is compiled twice: prange runs as a plain range loop in the serial version
+compute_3D_light_matrix_window_numba = numba.jit(nopython=True)(compute_3D_light_matrix_window)
+compute_3D_light_matrix_window_numba_parallel = numba.jit(nopython=True, parallel=True)(compute_3D_light_matrix_window)
+
+
+@numba.jit(nopython=True)
+def trace_window_ray_leaf_area(window_leaf_area_3D_mat, dem_offset_index_mat,
+                               window_x_start, window_y_start,
+                               x, y, z,      # the voxel the "arrow" is shot from, in the coordinates of the whole grid
+                               dx, dy, dz,
+                               z_size_m, path_length,
+                               cutoff_leaf_area):
+    """
+    Same as trace_ray_leaf_area, with the leaf area only known in a window of the grid starting at plot
+    window_x_start, window_y_start (with wrap around). Returns -1 if the arrow passes through leaf area outside the window.
+    """
+    nx, ny = dem_offset_index_mat.shape
+    window_nx, window_ny, nz = window_leaf_area_3D_mat.shape
+    accumulated_leaf_area = 0.
+    # increment the x,y positions (include wrap around)
+    ax = float(x) + dx
+    ay = float(y) + dy
+    ix = int(round(ax) % nx)
+    iy = int(round(ay) % ny)
+    az = float(z) + dz
+    iz = int(round(az)) + dem_offset_index_mat[x,y] - dem_offset_index_mat[ix,iy]
+    az = az + z_size_m * (dem_offset_index_mat[x,y] - dem_offset_index_mat[ix,iy])
+
+    # accumulate until hit the top of the airspace computed in the z direction
+    while iz < nz:
+        # stop early once the arrow can no longer deliver a meaningful amount of light (see ray_cutoff_leaf_area)
+        if accumulated_leaf_area >= cutoff_leaf_area:
+            break
+        # hit the ground, total shade along this ray (see trace_ray_leaf_area)
+        if iz < 0:
+            accumulated_leaf_area = 10e20
+            break
+        # the position of the plot in the window
+        wx = (ix - window_x_start) % nx
+        wy = (iy - window_y_start) % ny
+        if wx >= window_nx or wy >= window_ny:
+            return -1.
+        accumulated_leaf_area = accumulated_leaf_area + (window_leaf_area_3D_mat[wx,wy,iz] * path_length)
+        # move to the next location in the ray path
+        ax = ax + dx
+        ay = ay + dy
+        prev_ix = ix
+        prev_iy = iy
+        ix = int(round(ax) % nx)
+        iy = int(round(ay) % ny)
+        az = az + dz
+        iz = int(round(az)) + dem_offset_index_mat[prev_ix,prev_iy] - dem_offset_index_mat[ix,iy]
+        az = az + z_size_m * (dem_offset_index_mat[prev_ix,prev_iy] - dem_offset_index_mat[ix,iy])
+
+    return accumulated_leaf_area
+
+
 @numba.jit(nopython=True) #, inline=True)
 def calculate_ala_index(x, y, z,               # the current index position
                         dx, dy, dz,            # the index step in each direction
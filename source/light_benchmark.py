@@ -0,0 +1,246 @@
+"""
+Benchmark the 3D light engines on synthetic plot grids, without any GIS inputs.
+
+The stands are built from a synthetic DEM ('flat', 'ridge', 'valley', 'fractal' or 'rolling', see make_synthetic_dem)
+and a random canopy of configurable leaf area density and gap fraction (see make_synthetic_canopy).
+
+'engines' times each light engine on every combination of grid size, terrain and leaf area density, and compares
+its light to the 'fused' engine (identical to the original 'per_arrow' sweep). 'tiling' compares the 'tables'
+engine visiting the grid plot by plot against the tiled traversal (see light3d.compute_3D_light_matrix_tables_tiled).
+With --report, the results are also written to a JSON file so runs on different machines or versions can be compared.
+
+    python light_benchmark.py                      # all engines on 50x50 and 100x100 plot grids, every terrain
+    python light_benchmark.py --grids 100 250 --terrains flat fractal --engines fused tables --report light.json
+    python light_benchmark.py --benchmark tiling --grids 100 500 --tile_sizes 8 16 32 --threads 4
+"""
+import json
+import platform
+import time
+import numpy as np
+import numba
+from light3d import compute_3D_light_matrix, set_light_threads
+from LightSubroutine import build_arrows_list, load_or_build_ray_tables
+
+TERRAINS = ('flat', 'ridge', 'valley', 'fractal', 'rolling')
+ENGINES = ('per_arrow', 'fused', 'tables')
+
+
+def make_synthetic_dem(nx, ny, terrain='rolling', relief=15., seed=0):
+    """
+    Build a DEM for a grid of plots. Every terrain except 'rolling' joins up across the edges of the grid,
+    like the wrap around of the light arrows.
+
+    Parameters: nx, ny  -- the number of plots along each side of the grid
+                terrain -- 'flat', 'ridge' (running along y in the middle of the grid), 'valley' (the same, upside down),
+                           'fractal' (random terrain with detail at every scale) or 'rolling' (gentle hills with noise)
+                relief  -- the height difference (m) between the lowest and the highest plot
+                seed    -- random number seed
+
+    Returns:    dem_mat -- the elevation (m) of each plot, size: nx, ny
+    """
+    rs = np.random.RandomState(seed)
+    xs = np.arange(nx).reshape(nx, 1)
+    ys = np.arange(ny).reshape(1, ny)
+    if terrain == 'flat':
+        return np.zeros((nx, ny))
+    elif terrain == 'ridge':
+        dem_mat = 0.5 * (1. - np.cos(2. * np.pi * xs / nx)) + np.zeros((1, ny))
+    elif terrain == 'valley':
+        dem_mat = 0.5 * (1. + np.cos(2. * np.pi * xs / nx)) + np.zeros((1, ny))
+    elif terrain == 'fractal':
+        # spectral synthesis: random phases with an amplitude falling off as 1/f^1.5 (a Brownian surface)
+        frequency = np.sqrt(np.fft.fftfreq(nx).reshape(nx, 1)**2 + np.fft.fftfreq(ny).reshape(1, ny)**2)
+        frequency[0,0] = 1.
+        spectrum = (rs.normal(size=(nx, ny)) + 1j * rs.normal(size=(nx, ny))) / frequency**1.5
+        spectrum[0,0] = 0.
+        dem_mat = np.real(np.fft.ifft2(spectrum))
+    elif terrain == 'rolling':
+        dem_mat = 0.5 + 0.5 * np.sin(xs / 7.) * np.cos(ys / 9.) + (2. / relief) * rs.rand(nx, ny)
+    else:
+        raise ValueError('Unknown synthetic terrain : %s' % terrain)
+    dem_range = np.max(dem_mat) - np.min(dem_mat)
+    if dem_range == 0.:
+        return np.zeros((nx, ny))
+    return relief * (dem_mat - np.min(dem_mat)) / dem_range
+
+
+def make_synthetic_canopy(nx, ny, nz, density=0.3, gap_fraction=0., seed=0):
+    """
+    Build a random canopy: every plot has trees up to a random height (at most 3/4 of the airspace) with the
+    crown base at 1/3 of that height, and a random leaf area in each voxel of the crowns.
+
+    Parameters: nx, ny       -- the number of plots along each side of the grid
+                nz           -- the height of the leaf area matrix (MAX_TREE_HEIGHT in the driver)
+                density      -- the largest leaf area (m^2/m^2) in a voxel, the mean is half of it
+                gap_fraction -- the fraction of the plots without trees
+                seed         -- random number seed
+
+    Returns:    actual_leaf_area_mat -- size: nx, ny, nz
+    """
+    rs = np.random.RandomState(seed)
+    tree_height = rs.randint(0, 3*nz//4, size=(nx, ny))
+    tree_height[rs.rand(nx, ny) < gap_fraction] = 0
+    z = np.arange(nz).reshape(1, 1, nz)
+    in_crown = (z < tree_height.reshape(nx, ny, 1)) & (z >= tree_height.reshape(nx, ny, 1) // 3)
+    return np.where(in_crown, density * rs.rand(nx, ny, nz), 0.)
+
+
+def make_synthetic_stand(nx, ny, nz, seed=0, terrain='rolling', relief=15., density=0.3, gap_fraction=0.):
+    """
+    Build a synthetic DEM and a random canopy on it (see make_synthetic_dem and make_synthetic_canopy).
+
+    Returns:    actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat
+    """
+    dem_mat = make_synthetic_dem(nx, ny, terrain=terrain, relief=relief, seed=seed)
+    dem_offset_index_mat = np.array(np.round(dem_mat - dem_mat.min()), dtype=np.int64)
+    actual_leaf_area_mat = make_synthetic_canopy(nx, ny, nz, density=density, gap_fraction=gap_fraction, seed=seed)
+    radiation_fraction_mat = 0.8 + 0.2 * np.random.RandomState(seed).rand(nx, ny)
+    return actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat
+
+
+def time_light(repeats, *args, **kwargs):
+    """
+    Returns: the available light matrix and the best time (in seconds) of repeats calls to compute_3D_light_matrix
+    """
+    best_time = np.inf
+    for repeat in range(repeats):
+        start_time = time.time()
+        available_light_mat = compute_3D_light_matrix(*args, **kwargs)
+        best_time = min(best_time, time.time() - start_time)
+    return available_light_mat, best_time
+
+
+def engine_kwargs(engine, arrows_list, dem_offset_index_mat, nz, zsize, parallel, tile_size):
+    """
+    Returns: the keyword arguments of compute_3D_light_matrix that run the light engine the way the simulation does
+    """
+    kwargs = dict(parallel=parallel, engine=engine)
+    if engine == 'tables':
+        kwargs.update(ray_tables=load_or_build_ray_tables(arrows_list, dem_offset_index_mat, nz, zsize),
+                      canopy_bound=True, tile_size=tile_size)
+    return kwargs
+
+
+def benchmark_engines(grid_sizes, terrains=TERRAINS, densities=(0.3,), engines=ENGINES, nz=50, relief=15.,
+                      gap_fraction=0.2, parallel=False, repeats=3, tile_size=8):
+    """
+    Time the light engines on square plot grids of each size, for each synthetic terrain and leaf area density.
+
+    Returns: list of dictionaries, one per case: the grid size, terrain, density, engine, the best time (s), the voxels
+             computed per second, the largest difference from the light of the 'fused' engine, and the number of
+             arrows and the time (s) build_arrows_list took to make them
+    """
+    xsize, ysize, zsize = 10., 10., 1.
+    start_time = time.time()
+    arrows_list = build_arrows_list(xsize=xsize, ysize=ysize, zsize=zsize, PHIB=0.45, PHID=0.55)
+    build_arrows_seconds = time.time() - start_time
+    print 'build_arrows_list : %d arrows in %.3f s' % (len(arrows_list), build_arrows_seconds)
+    # compile the kernels on a small grid first, so compile time is not counted
+    small_args = make_synthetic_stand(4, 4, nz) + (xsize, ysize, zsize, arrows_list)
+    for engine in set(engines) | set(['fused']):
+        compute_3D_light_matrix(*small_args, **engine_kwargs(engine, arrows_list, small_args[1], nz, zsize, parallel, tile_size))
+
+    results = []
+    for n in grid_sizes:
+        for terrain in terrains:
+            for density in densities:
+                actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat = \
+                    make_synthetic_stand(n, n, nz, terrain=terrain, relief=relief, density=density, gap_fraction=gap_fraction)
+                light_args = (actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat,
+                              xsize, ysize, zsize, arrows_list)
+                reference_light_mat = compute_3D_light_matrix(*light_args, parallel=parallel, engine='fused')
+                for engine in engines:
+                    available_light_mat, seconds = time_light(repeats, *light_args,
+                                                              **engine_kwargs(engine, arrows_list, dem_offset_index_mat,
+                                                                              nz, zsize, parallel, tile_size))
+                    max_difference = float(np.max(np.abs(available_light_mat - reference_light_mat)))
+                    results.append(dict(grid=n, terrain=terrain, density=density, engine=engine, seconds=seconds,
+                                        voxels_per_second=available_light_mat.size / seconds,
+                                        max_difference_from_fused=max_difference, narrows=len(arrows_list),
+                                        build_arrows_seconds=build_arrows_seconds))
+                    print '%4d x %-4d  %-8s density %.2f  %-10s : %8.3f s  (%.3g voxels/s)  max difference %.3g' % \
+                        (n, n, terrain, density, engine, seconds, available_light_mat.size / seconds, max_difference)
+    return results
+
+
+def benchmark_tiling(grid_sizes, tile_sizes, nz=50, parallel=False, repeats=3):
+    """
+    Time the 'tables' light engine with and without tiling on square plot grids of each size.
+
+    Returns: list of dictionaries, one per case: the grid size, tile size (0 is untiled), the best time (s),
+             and whether the light is identical to the untiled light
+    """
+    xsize, ysize, zsize = 10., 10., 1.
+    arrows_list = build_arrows_list(xsize=xsize, ysize=ysize, zsize=zsize, PHIB=0.45, PHID=0.55)
+    results = []
+    for n in grid_sizes:
+        actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat = make_synthetic_stand(n, n, nz)
+        ray_tables = load_or_build_ray_tables(arrows_list, dem_offset_index_mat, nz, zsize)
+        light_args = (actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, xsize, ysize, zsize, arrows_list)
+        # compile the kernels on a small grid first, so compile time is not counted
+        small_args = tuple(np.ascontiguousarray(arg[:2,:2]) for arg in light_args[:3]) + light_args[3:]
+        small_tables = load_or_build_ray_tables(arrows_list, small_args[1], nz, zsize)
+        for tile_size in [0] + list(tile_sizes):
+            compute_3D_light_matrix(*small_args, parallel=parallel, engine='tables', ray_tables=small_tables, tile_size=tile_size)
+
+        untiled_light_mat, untiled_seconds = None, None
+        for tile_size in [0] + list(tile_sizes):
+            available_light_mat, seconds = time_light(repeats, *light_args, parallel=parallel, engine='tables',
+                                                      ray_tables=ray_tables, tile_size=tile_size)
+            if untiled_light_mat is None:
+                untiled_light_mat, untiled_seconds = available_light_mat, seconds
+            identical = bool(np.array_equal(available_light_mat, untiled_light_mat))
+            results.append(dict(grid=n, tile_size=tile_size, seconds=seconds, identical=identical))
+            print '%4d x %-4d  tile %3d : %8.3f s  (speedup %.2fx)  identical: %s' % (n, n, tile_size, seconds,
+                                                                                   untiled_seconds / seconds, identical)
+    return results
+
+
+def write_report(report_filename, benchmark, settings, results):
+    """
+    Write the benchmark results to a JSON file, with the settings and the machine they were measured on.
+    """
+    report = dict(benchmark=benchmark, settings=settings, results=results,
+                  date=time.strftime('%Y-%m-%d %H:%M:%S'), machine=platform.machine(), python=platform.python_version(),
+                  numpy=np.__version__, numba=numba.__version__, threads=numba.config.NUMBA_NUM_THREADS)
+    with open(report_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=1, sort_keys=True)
+    print 'Info :: light benchmark report written to %s' % report_filename
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", help="time the light engines, or the tiling of the tables engine", choices=['engines', 'tiling'], default='engines')
+    parser.add_argument("--grids", help="the number of plots along each side of the square grids", type=int, nargs='+', default=None)
+    parser.add_argument("--terrains", help="the synthetic terrains", choices=TERRAINS, nargs='+', default=list(TERRAINS[:4]))
+    parser.add_argument("--densities", help="the largest leaf area in a voxel of the synthetic canopies", type=float, nargs='+', default=[0.3])
+    parser.add_argument("--gap_fraction", help="the fraction of plots without trees", type=float, default=0.2)
+    parser.add_argument("--relief", help="the height difference (m) of the synthetic terrains", type=float, default=15.)
+    parser.add_argument("--engines", help="the light engines to time", choices=ENGINES, nargs='+', default=list(ENGINES))
+    parser.add_argument("--tile_sizes", help="the tile sizes to compare against no tiling", type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument("--nz", help="the height of the leaf area matrix", type=int, default=50)
+    parser.add_argument("--threads", help="the number of light threads (0 = all cores)", type=int, default=1)
+    parser.add_argument("--repeats", help="the number of times each case is timed (the best time is reported)", type=int, default=3)
+    parser.add_argument("--report", help="write the results to this JSON file", default=None)
+    args = parser.parse_args()
+    if args.threads != 1:
+        set_light_threads(args.threads)
+    parallel = (args.threads != 1)
+    if args.benchmark == 'engines':
+        grids = args.grids or [50, 100]
+        results = benchmark_engines(grids, terrains=args.terrains, densities=args.densities, engines=args.engines,
+                                    nz=args.nz, relief=args.relief, gap_fraction=args.gap_fraction,
+                                    parallel=parallel, repeats=args.repeats)
+        settings = dict(grids=grids, terrains=args.terrains, densities=args.densities, engines=args.engines, nz=args.nz,
+                        relief=args.relief, gap_fraction=args.gap_fraction, parallel=parallel, repeats=args.repeats)
+    else:
+        grids = args.grids or [100, 500]
+        results = benchmark_tiling(grids, args.tile_sizes, nz=args.nz, parallel=parallel, repeats=args.repeats)
+        settings = dict(grids=grids, tile_sizes=args.tile_sizes, nz=args.nz, parallel=parallel, repeats=args.repeats)
+    if args.report is not None:
+        write_report(args.report, args.benchmark, settings, results)
+
+
+if __name__ == '__main__':
+    main()
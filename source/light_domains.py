@@ -0,0 +1,158 @@
+"""
+Domain decomposition of the 3D light computation for very large landscapes.
+
+The grid is split into ndomains_x x ndomains_y rectangular domains, and the light of each domain is computed
+by a separate worker process from a window of the leaf area: the domain plus halo columns on every side, wide enough
+for the longest reach of any arrow (see compute_halo_width). The windows are taken with wrap around at the edges
+of the whole grid and the arrows are traced in the coordinates of the whole grid (see
+light3d.compute_3D_light_matrix_window), so the toroidal wrap around is kept and the light is identical to
+light3d.compute_3D_light_matrix. Each worker only holds the leaf area of its window.
+"""
+import math
+import multiprocessing
+import numpy as np
+from light3d import arrows_list_to_array, compute_3D_light_matrix_window_numba
+
+
+def compute_halo_width(arrows_mat, nz, max_dem_offset, axis):
+    """
+    Compute the number of plots along an axis that an arrow can travel through leaf area.
+
+    An arrow shot from the ground of the lowest plot rises dz voxels per step, so it is above the top of the airspace
+    of every plot (nz + the highest DEM offset) after at most (nz + max_dem_offset + 1/2) / dz steps, and it moves
+    |d| plots along the axis at each of these steps.
+    Arrows with a vertical step larger than the airspace leave it (or hit the ground) at their first step, so they
+    never need a halo. Arrows that rise less than a voxel per step could travel around the whole grid.
+
+    Parameters: arrows_mat     -- the arrows as rows of dx, dy, dz, proportion (see arrows_list_to_array)
+                nz             -- the height of the leaf area matrix
+                max_dem_offset -- the highest DEM offset index of the grid
+                axis           -- 0 for the x (first) axis, 1 for the y (second) axis
+
+    Returns: the halo width in plots, None if an arrow can travel around the whole grid
+    """
+    # the largest step that still rounds to a valid integer index all the way through the airspace
+    MAX_STEP = 2.**31
+    halo_width = 0
+    for arrow in arrows_mat:
+        step, dz = abs(arrow[axis]), arrow[2]
+        if dz > MAX_STEP:
+            continue
+        if dz < 1.:
+            return None
+        # one more step than needed to leave the airspace, in case of rounding
+        max_steps = int(math.ceil((nz + max_dem_offset + 0.5) / dz)) + 1
+        halo_width = max(halo_width, int(math.ceil(max_steps * step + 0.5)))
+    return halo_width
+
+
+def split_axis(n, ndomains, halo_width):
+    """
+    Split the n plots along an axis into ndomains nearly equal domains, each with a window of halo_width plots on
+    either side. The window is the whole axis if it would wrap onto itself.
+
+    Returns: list of (start, end, window start, window length) tuples, the window starts with wrap around
+    """
+    domains = []
+    for d in range(ndomains):
+        start = d * n // ndomains
+        end = (d + 1) * n // ndomains
+        if halo_width is None or (end - start) + 2 * halo_width >= n:
+            domains.append((start, end, 0, n))
+        else:
+            domains.append((start, end, (start - halo_width) % n, (end - start) + 2 * halo_width))
+    return domains
+
+
+def compute_light_domain(domain_args):
+    """
+    Compute the available light of one domain (run by the worker processes).
+
+    Parameters: domain_args -- tuple of the window leaf area, the DEM offset index of the whole grid, the radiation
+                               fraction of the domain, the plot sizes, the arrows matrix, the window start, the domain
+                               start and the tolerance (see light3d.compute_3D_light_matrix_window)
+
+    Returns: the available light of the domain, the light error of each plot and the number of arrows that left the window
+    """
+    window_leaf_area_3D_mat, dem_offset_index_mat, radiation_fraction_mat, \
+        x_size_m, y_size_m, z_size_m, arrows_mat, \
+        window_x_start, window_y_start, x_start, y_start, tolerance = domain_args
+    domain_nx, domain_ny = radiation_fraction_mat.shape
+    nz = window_leaf_area_3D_mat.shape[2]
+    al_3D_mat = np.zeros((domain_nx, domain_ny, nz), dtype=window_leaf_area_3D_mat.dtype)
+    light_error_mat = np.zeros((domain_nx, domain_ny))
+    arrows_outside = compute_3D_light_matrix_window_numba(window_leaf_area_3D_mat, dem_offset_index_mat,
+                                                          radiation_fraction_mat, x_size_m, y_size_m, z_size_m,
+                                                          arrows_mat, window_x_start, window_y_start, x_start, y_start,
+                                                          tolerance, light_error_mat, al_3D_mat)
+    return al_3D_mat, light_error_mat, arrows_outside
+
+
+def compute_3D_light_matrix_domains(actual_leaf_area_3D_mat,
+                                    dem_offset_index_mat,
+                                    radiation_fraction_mat,
+                                    x_size_m, y_size_m, z_size_m,
+                                    list_of_grid_steps_and_proportion_tuples,
+                                    ndomains_x, ndomains_y, pool=None,
+                                    tolerance=0., light_stats=None):
+    """
+    Compute the available light matrix (same as light3d.compute_3D_light_matrix) one domain at a time.
+
+    Parameters: ndomains_x, ndomains_y -- the number of domains along the x and y axis of the grid
+                pool                   -- a multiprocessing.Pool to compute the domains with, None to compute them one
+                                          after the other in this process
+                tolerance              -- stop an arrow once the light it delivers is at most this value (0 to trace to the end)
+                light_stats            -- optional dictionary, filled with 'max_light_error' (see light3d.compute_3D_light_matrix)
+
+    Returns: available light matrix, size: nx, ny, nz
+    """
+    nx, ny, nz = actual_leaf_area_3D_mat.shape
+    arrows_mat = arrows_list_to_array(list_of_grid_steps_and_proportion_tuples)
+    dem_offset_index_mat = np.ascontiguousarray(dem_offset_index_mat)
+    max_dem_offset = np.max(dem_offset_index_mat)
+    x_domains = split_axis(nx, ndomains_x, compute_halo_width(arrows_mat, nz, max_dem_offset, 0))
+    y_domains = split_axis(ny, ndomains_y, compute_halo_width(arrows_mat, nz, max_dem_offset, 1))
+
+    def domain_args_iter():
+        # the windows are cut out one at a time, as the workers ask for them
+        for x_start, x_end, window_x_start, window_nx in x_domains:
+            window_x = np.arange(window_x_start, window_x_start + window_nx) % nx
+            for y_start, y_end, window_y_start, window_ny in y_domains:
+                window_y = np.arange(window_y_start, window_y_start + window_ny) % ny
+                window_leaf_area_3D_mat = actual_leaf_area_3D_mat.take(window_x, axis=0).take(window_y, axis=1)
+                yield (window_leaf_area_3D_mat, dem_offset_index_mat,
+                       np.ascontiguousarray(radiation_fraction_mat[x_start:x_end, y_start:y_end]),
+                       x_size_m, y_size_m, z_size_m, arrows_mat,
+                       window_x_start, window_y_start, x_start, y_start, tolerance)
+
+    if pool is None:
+        domain_results = map(compute_light_domain, domain_args_iter())
+    else:
+        domain_results = pool.imap(compute_light_domain, domain_args_iter())
+
+    # put the domains back together, in the same order as they were handed out
+    al_3D_mat = np.zeros((nx, ny, nz), dtype=actual_leaf_area_3D_mat.dtype)
+    light_error_mat = np.zeros((nx, ny))
+    domain_bounds = [(x_domain[:2], y_domain[:2]) for x_domain in x_domains for y_domain in y_domains]
+    for ((x_start, x_end), (y_start, y_end)), (domain_al_3D_mat, domain_light_error_mat, arrows_outside) in zip(domain_bounds, domain_results):
+        if arrows_outside > 0:
+            raise RuntimeError('%d arrows left the halo of the light domain x %d:%d, y %d:%d' % (arrows_outside, x_start, x_end, y_start, y_end))
+        al_3D_mat[x_start:x_end, y_start:y_end] = domain_al_3D_mat
+        light_error_mat[x_start:x_end, y_start:y_end] = domain_light_error_mat
+
+    if light_stats is not None:
+        light_stats['max_light_error'] = np.max(light_error_mat)
+    return al_3D_mat
+
+
+def create_light_pool(processes):
+    """
+    Start the worker processes for the light domains.
+
+    Parameters: processes -- the number of worker processes, 0 for one per core
+
+    Returns: multiprocessing.Pool
+    """
+    if processes == 0:
+        processes = multiprocessing.cpu_count()
+    return multiprocessing.Pool(processes)
@@ -1,6 +1,58 @@
 from osgeo import gdal
+import hashlib
+import json
+import os
 import numpy as np
 
+# folder in which the rasters read by read_in_ascii and read_in_ascii_attributes are kept as binary arrays, so later runs
+# (and ensemble members) memory-map them instead of parsing the ascii grids again; None means do not cache (see set_raster_cache_dir)
+raster_cache_dir = None
+
+
+def set_raster_cache_dir(cache_dir):
+    """
+    Set the folder of the binary raster cache (RASTER_CACHE_DIR in the driver), None to read every raster with GDAL.
+    """
+    global raster_cache_dir
+    raster_cache_dir = cache_dir
+
+
+def read_raster(filename):
+    """
+    Read a raster and its georeferencing, through the binary raster cache when one is set. A cached raster is stored as
+    an .npy array next to a .json file with its geotransform, under a checksum of the path, size and modification time of
+    the raster file (so an edited raster is read again), and is memory-mapped copy-on-write (changes are never written back).
+
+    Returns: raster_data -- the raster data as a numpy matrix (float)
+             geotransform -- the GDAL geotransform (top left x, W-E pixel resolution, 0, top left y, 0, N-S pixel resolution)
+    """
+    if raster_cache_dir is None:
+        dataset = gdal.Open(filename)
+        return np.array(dataset.ReadAsArray(), dtype=np.float), tuple(dataset.GetGeoTransform())
+
+    file_stat = os.stat(filename)
+    key = hashlib.sha1(str((os.path.abspath(filename), file_stat.st_size, file_stat.st_mtime))).hexdigest()
+    cache_file = os.path.join(raster_cache_dir, 'raster_%s' % key)
+    # the array is written last, so a raster with an array is complete
+    if os.access(cache_file + '.npy', os.F_OK):
+        with open(cache_file + '.json') as geotransform_file:
+            geotransform = tuple(json.load(geotransform_file)['geotransform'])
+        return np.load(cache_file + '.npy', mmap_mode='c'), geotransform
+
+    dataset = gdal.Open(filename)
+    raster_data = np.array(dataset.ReadAsArray(), dtype=np.float)
+    geotransform = tuple(dataset.GetGeoTransform())
+    if not os.path.isdir(raster_cache_dir):
+        os.makedirs(raster_cache_dir)
+    # write to temporary files first, so a run starting at the same time never reads a partial file
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file + '.json', 'w') as geotransform_file:
+        json.dump({'filename': os.path.abspath(filename), 'geotransform': geotransform}, geotransform_file)
+    os.rename(tmp_file + '.json', cache_file + '.json')
+    np.save(tmp_file + '.npy', raster_data)
+    os.rename(tmp_file + '.npy', cache_file + '.npy')
+    return raster_data, geotransform
+
 
 def read_in_ascii(filename):
     """
@@ -12,8 +64,7 @@ def read_in_ascii(filename):
 	         the growing degree days for that area over the course of 
 			 one year (numpy array)
     """
-    dataset = gdal.Open(filename)
-    raster_data = np.array(dataset.ReadAsArray(), dtype=np.float)
+    raster_data, geotransform = read_raster(filename)
 
     return raster_data
 
@@ -31,10 +82,9 @@ def read_in_ascii_attributes(filename):
              top_left_x -- longitude coordinate in UTM of NW corner of the simulation area
              top_left_y -- latitude coordinate in UTM of NW corner of the simulation area
     """
-    dataset = gdal.Open(filename)
-    raster_data = np.array(dataset.ReadAsArray(), dtype=np.float)
+    raster_data, geotransform = read_raster(filename)
     # (top left for X, W-E pixel resolution, ?, top left for Y, 0, N-S pixel resolution)
-    NWx, x_size, blah, NWy, blah2, y_size = dataset.GetGeoTransform()  #y-size negative if heading south, so abs it later
+    NWx, x_size, blah, NWy, blah2, y_size = geotransform  #y-size negative if heading south, so abs it later
     y_size = abs(y_size)
 #	if not geotransform is None:
 #	    print 'Origin = (',geotransform[0], ',',geotransform[3],')'
@@ -3,12 +3,19 @@ Import all the necessary libraries and tools for the model.
 """
 import numpy as np
 import random
+import math
 from math import pi
-from weather import GrowingDegreeDays_calc, rain_sim, drydays, one_time_radiation_readin
+from weather import GrowingDegreeDays_calc, rain_sim, drydays, one_time_radiation_readin, \
+                    load_or_generate_weather_stream, weather_stream_year, \
+                    find_weather_plot_classes, compress_plots, expand_plots
 from load_driver import load_driver_py
-from LightSubroutine import build_arrows_list, prepare_actual_leaf_area_mat_from_dem, build_arrows_list_independent
-from read_in_ascii import read_in_ascii, read_in_ascii_attributes
-from light3d import compute_3D_light_matrix
+from LightSubroutine import build_arrows_list, prepare_actual_leaf_area_mat_from_dem, build_arrows_list_independent, \
+                            load_or_build_ray_tables
+from read_in_ascii import read_in_ascii, read_in_ascii_attributes, set_raster_cache_dir
+from workspace import create_workspace, workspace_buffer
+from light3d import compute_3D_light_matrix, set_light_threads, LIGHT_COUNTER_COLUMNS, \
+                    build_leaf_area_segments
+from light_domains import compute_3D_light_matrix_domains, create_light_pool
 import pandas as pd
 import h5py
 import dill
@@ -41,9 +48,9 @@ def StartSimulation(driver_filename, output_filename, driver):
 
     # initialize the matrices, state variables and constants that will be passed down from year to year
     driver, initial_soil_water_mat, \
-    arrows_list, actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, plot_area, \
+    arrows_list, ray_tables, actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, plot_area, \
     DBH_matrix, crown_base_matrix, species_code_matrix, \
-                stress_flag_matrix, seed_bank_matrix, hdf_file = initialization(driver_filename, output_filename, driver)
+                stress_flag_matrix, seed_bank_matrix, hdf_file, workspace, weather_stream = initialization(driver_filename, output_filename, driver)
     # get the dimension of each plot from the driver (this is specified in the DEM file; the path to the DEM file is specified in the driver
     # the z_size_m is the resolution with which we track the vertical dimension of the trees (at this point, 1m)
     x_size_m = int( driver['EW_plot_length_m'] )  #plot width in meters
@@ -56,6 +63,8 @@ def StartSimulation(driver_filename, output_filename, driver):
     BasalArea_group = hdf_file["BasalArea"]
     Biomass_group = hdf_file["Biomass"]
     DBH_distribution_group = hdf_file["DBH_distribution"]
+    if driver['LIGHT_COUNTERS']:
+        LightCounters_group = hdf_file["LightCounters"]                    # size: narrows, len(LIGHT_COUNTER_COLUMNS)
     ## Debug groups
     if driver['DEBUG']:
         # weather
@@ -79,6 +88,20 @@ def StartSimulation(driver_filename, output_filename, driver):
 
     simulation_years_logged = []
 
+    # with incremental light updates, the leaf area and available light of the previous year are kept here
+    light_state = {} if driver['LIGHT_INCREMENTAL'] else None
+    # the light is computed every LIGHT_REFRESH_YEARS years (or sooner if the leaf area drifts), and re-used in between
+    available_light_mat = None
+    light_refresh_year = None
+    light_refresh_leaf_area_mat = None   # the total leaf area of each plot when the light was last computed
+    light_fresh_years = []
+    light_cached_years = []
+    light_precision_reports = []   # the float32 vs float64 light comparison of each year (LIGHT_PRECISION_REPORT)
+    # with the light split into domains, the worker processes are started once for the whole simulation
+    light_pool = None
+    if driver['LIGHT_DOMAINS'] != (1, 1) and driver['LIGHT_PROCESSES'] != 1:
+        light_pool = create_light_pool(driver['LIGHT_PROCESSES'])
+
     ##specify whether to generate random weather or read it in from a file (usually an HDF output from a previous run)
     #if driver["CLIMATE_RANDOM"] == False:
     #    climate_filepath = driver['Climate_record_file_path']
@@ -101,62 +124,130 @@ def StartSimulation(driver_filename, output_filename, driver):
         # generate weather:
         monthly_temp_mat_lst, \
         initial_soil_water_mat, \
-        GDD_matrix, drydays_fraction_mat = generate_weather(driver, initial_soil_water_mat, year)
+        GDD_matrix, drydays_fraction_mat = generate_weather(driver, initial_soil_water_mat, year, weather_stream)
         #if year==2100:  #this and the line below are printouts for testing
         #    print "GDD mat=", GDD_matrix[:,0]
         # kill trees (stressed trees from previous years get to fear for their lives and some may die)
         DBH_matrix, stress_flag_matrix, \
-        species_code_matrix, crown_base_matrix = kill_trees(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_base_matrix, number_of_species)
-
-        # compute species specific values for each tree, most of these are f(DBH)
-        tree_height_matrix, \
-        total_leaf_area_matrix, \
-        biomass_matrix, \
-        optimal_growth_increment_matrix, \
-        optimal_biomass_matrix, \
-        basal_area_matrix, \
-        biovolume_matrix, \
-        optimal_biovolume_matrix, \
-        optimal_biovolume_increment_matrix = compute_individual_tree_values(DBH_matrix, species_code_matrix, crown_base_matrix)
-
-        # compute the actual leaf area (TODO: check that this value doesn't get out of control, unrealistic, implement QC, although LAIs in the lower 20s have been reported)
-        actual_leaf_area_mat = compute_actual_leaf_area(DBH_matrix, species_code_matrix, crown_base_matrix, 
-                                                        tree_height_matrix, total_leaf_area_matrix, z_size_m, driver['plot_area_m2'])
+        species_code_matrix, crown_base_matrix = kill_trees(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_base_matrix, number_of_species,
+                                                            workspace=workspace)
+
+        if driver['TREE_KERNEL_FUSED']:
+            # one pass over the trees computes the values of each tree used this year, the actual leaf area, and the basal
+            # area and biomass by plot by species (see compute_tree_values_and_leaf_area)
+            tree_height_matrix, \
+            total_leaf_area_matrix, \
+            optimal_growth_increment_matrix, \
+            basal_area_matrix, \
+            optimal_biovolume_increment_matrix, \
+            actual_leaf_area_mat, \
+            basal_area_by_plot_by_species_matrix, \
+            biomass_by_plot_by_species_matrix = compute_tree_values_and_leaf_area(DBH_matrix, species_code_matrix, crown_base_matrix,
+                                                                                  driver['plot_area_m2'], number_of_species,
+                                                                                  workspace=workspace)
+        else:
+            # compute species specific values for each tree, most of these are f(DBH)
+            tree_height_matrix, \
+            total_leaf_area_matrix, \
+            biomass_matrix, \
+            optimal_growth_increment_matrix, \
+            optimal_biomass_matrix, \
+            basal_area_matrix, \
+            biovolume_matrix, \
+            optimal_biovolume_matrix, \
+            optimal_biovolume_increment_matrix = compute_individual_tree_values(DBH_matrix, species_code_matrix, crown_base_matrix,
+                                                                                workspace=workspace)
+
+            # compute the actual leaf area (TODO: check that this value doesn't get out of control, unrealistic, implement QC, although LAIs in the lower 20s have been reported)
+            actual_leaf_area_mat = compute_actual_leaf_area(DBH_matrix, species_code_matrix, crown_base_matrix, 
+                                                            tree_height_matrix, total_leaf_area_matrix, z_size_m, driver['plot_area_m2'],
+                                                            workspace=workspace)
 
 
         # compute the weather related factors at the plot level
         GDD_3D_spp_factor_matrix, \
-        soil_moist_3D_spp_factor_matrix = compute_species_factors_weather(GDD_matrix, drydays_fraction_mat, number_of_species)
+        soil_moist_3D_spp_factor_matrix = compute_plot_species_factors_weather(GDD_matrix, drydays_fraction_mat, number_of_species,
+                                                                              driver['weather_plot_classes'])
 
 
         # compute 3D light using a more efficient algorithm
-        available_light_mat = compute_light(actual_leaf_area_mat, dem_offset_index_mat, 
-                                            radiation_fraction_mat, arrows_list, 
-                                            x_size_m,y_size_m,z_size_m)
-
-        # compute crown base:
-        crown_base_matrix = compute_crown_base(DBH_matrix, species_code_matrix, tree_height_matrix,
-                                               crown_base_matrix, available_light_mat)
-
-
-        # compute the ground-level and vertical profile of light factors for each species on each plot
-        ground_light_3D_spp_factor_matrix, \
-        available_light_spp_factor_matrix = light_factor_compute(available_light_mat,
-                                                                 tree_height_matrix, crown_base_matrix,
-                                                                 species_code_matrix, number_of_species)
-
-
-        # based on the limits of degree day and light factors, compute what the biovolume will be on each plot
-        likely_biovolume_increment_matrix = compute_plot_likely_biovolume_increment(species_code_matrix, GDD_3D_spp_factor_matrix, 
-                                                                                    available_light_spp_factor_matrix, 
-                                                                                    optimal_biovolume_increment_matrix)
-        # compute the relative soil fertility (based on ratio of what the plot can support to likely biovolume increment)
-        relative_soil_fertility_matrix = biovolume_compute_relative_soil_fertility_matrix(likely_biovolume_increment_matrix, #units: m3/tree
-                                                                                          driver['biovolume_soil_fert_mat'])  #units: m3/plot
-
-
-        # compute the soil/nutrition/site-index factor and the permafrost factor (size of each matrix: nx,ny,nspp)
-        soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix = compute_species_factors_soil(relative_soil_fertility_matrix, number_of_species, driver['permafrost_mat'])
+        light_stats = {}
+        plot_leaf_area_mat = np.sum(actual_leaf_area_mat, axis=2,
+                                    out=workspace_buffer(workspace, 'plot_leaf_area', (nx,ny), dtype=actual_leaf_area_mat.dtype))
+        light_fresh = light_refresh_needed(driver, year, light_refresh_year, plot_leaf_area_mat, light_refresh_leaf_area_mat)
+        if light_fresh:
+            leaf_area_segments = None
+            if driver['LIGHT_SPARSE']:
+                # the leaf area of every plot column as runs of constant density, in one pass over the leaf area matrix
+                leaf_area_segments = build_leaf_area_segments(actual_leaf_area_mat)
+            available_light_mat = compute_light(actual_leaf_area_mat, dem_offset_index_mat, 
+                                                radiation_fraction_mat, arrows_list, 
+                                                x_size_m,y_size_m,z_size_m,
+                                                parallel=(driver['LIGHT_THREADS'] != 1),
+                                                engine=driver['LIGHT_ENGINE'], ray_tables=ray_tables,
+                                                canopy_bound=driver['LIGHT_CANOPY_BOUND'],
+                                                tolerance=driver['LIGHT_TOLERANCE'], light_stats=light_stats,
+                                                light_state=light_state, change_threshold=driver['LIGHT_CHANGE_THRESHOLD'],
+                                                tile_size=driver['LIGHT_TILE_SIZE'],
+                                                domains=driver['LIGHT_DOMAINS'], light_pool=light_pool,
+                                                leaf_area_segments=leaf_area_segments,
+                                                count=driver['LIGHT_COUNTERS'], workspace=workspace)
+            light_refresh_year = year
+            # plot_leaf_area_mat is re-used next year, so keep a copy
+            light_refresh_leaf_area_mat = workspace_buffer(workspace, 'light_refresh_leaf_area', (nx,ny), dtype=plot_leaf_area_mat.dtype)
+            light_refresh_leaf_area_mat[...] = plot_leaf_area_mat
+            light_fresh_years.append(year)
+            if driver['LIGHT_COUNTERS']:
+                # counted by the light engine while computing the light (see light3d.light_counters_table)
+                light_counters_table = light_stats['light_counters']
+                LightCounters_group['%.4d' % year] = light_counters_table
+        else:
+            light_cached_years.append(year)
+
+        # the precision report needs the factors of the trees before they grow, so it uses the separate steps below
+        grow_fused = driver['TREE_KERNEL_FUSED'] and not (driver['LIGHT_PRECISION_REPORT'] and light_fresh)
+        if grow_fused:
+            # one pass over each plot computes the crown base, the light factors, the soil fertility and permafrost factors,
+            # and grows the trees (see grow_trees_fused); DBH, crown base and stress flags are updated in place
+            relative_soil_fertility_matrix, \
+            soil_fert_3D_spp_factor_matrix, \
+            permafrost_factor_matrix, \
+            ground_light_3D_spp_factor_matrix, \
+            partial_growth_factor_matrix, \
+            sprout_factor_matrix, \
+            available_light_spp_factor_matrix, \
+            growth_factor_matrix = grow_trees_fused(available_light_mat, DBH_matrix, species_code_matrix, crown_base_matrix,
+                                                    stress_flag_matrix, tree_height_matrix, optimal_growth_increment_matrix,
+                                                    optimal_biovolume_increment_matrix, GDD_3D_spp_factor_matrix,
+                                                    soil_moist_3D_spp_factor_matrix, driver['biovolume_soil_fert_mat'],
+                                                    driver['permafrost_mat'], number_of_species, keep_tree_factors=driver['DEBUG'],
+                                                    workspace=workspace)
+        else:
+            # compute crown base:
+            crown_base_matrix = compute_crown_base(DBH_matrix, species_code_matrix, tree_height_matrix,
+                                                   crown_base_matrix, available_light_mat)
+
+
+            # compute the ground-level and vertical profile of light factors for each species on each plot
+            ground_light_3D_spp_factor_matrix, \
+            available_light_spp_factor_matrix = light_factor_compute(available_light_mat,
+                                                                     tree_height_matrix, crown_base_matrix,
+                                                                     species_code_matrix, number_of_species, workspace=workspace)
+
+
+            # based on the limits of degree day and light factors, compute what the biovolume will be on each plot
+            likely_biovolume_increment_matrix = compute_plot_likely_biovolume_increment(species_code_matrix, GDD_3D_spp_factor_matrix, 
+                                                                                        available_light_spp_factor_matrix, 
+                                                                                        optimal_biovolume_increment_matrix, workspace=workspace)
+            # compute the relative soil fertility (based on ratio of what the plot can support to likely biovolume increment)
+            relative_soil_fertility_matrix = biovolume_compute_relative_soil_fertility_matrix(likely_biovolume_increment_matrix, #units: m3/tree
+                                                                                              driver['biovolume_soil_fert_mat'],  #units: m3/plot
+                                                                                              workspace=workspace)
+
+
+            # compute the soil/nutrition/site-index factor and the permafrost factor (size of each matrix: nx,ny,nspp)
+            soil_fert_3D_spp_factor_matrix, permafrost_factor_matrix = compute_species_factors_soil(relative_soil_fertility_matrix, number_of_species, driver['permafrost_mat'],
+                                                                                                    workspace=workspace)
 
 
         #when run on the local host, this is what gets printed to terminal during model run for each year
@@ -174,20 +265,53 @@ def StartSimulation(driver_filename, output_filename, driver):
         print "  dem offset = ", dem_offset
         print "  Max Tree Height = ", max_tree_height
         print "  Ground Light Factors by Species: ", ground_light_3D_spp_factor_matrix[0,0]
-
-
-        # computing the regeneration factor for each species on each plot
-        # first, compute min(smf,sff,permafrost)*gddf   (below ground factors & thermal effects)
-        partial_growth_factor_matrix = np.minimum(np.minimum(soil_moist_3D_spp_factor_matrix, soil_fert_3D_spp_factor_matrix), permafrost_factor_matrix) * GDD_3D_spp_factor_matrix
-
-        # grow trees
-        DBH_matrix, stress_flag_matrix, \
-        growth_factor_matrix = grow_trees(DBH_matrix, species_code_matrix, available_light_spp_factor_matrix, 
-                                          partial_growth_factor_matrix, stress_flag_matrix, optimal_growth_increment_matrix,species_code_to_stress_threshold)
-
-        # sizes of matrices: inputs: (nx,ny,spp_in_sim) * min((nx,ny,spp_in_sim),(nx,ny,spp_in_sim)) * (nx,ny,spp_in_sim)
-        # sprout_factor_matrix = ground_light_3D_spp_factor_matrix * np.minimum(soil_moist_3D_spp_factor_matrix, soil_fert_3D_spp_factor_matrix) * GDD_3D_spp_factor_matrix
-        sprout_factor_matrix = ground_light_3D_spp_factor_matrix * partial_growth_factor_matrix
+        if not light_fresh:
+            print "  Available Light re-used from %d" % light_refresh_year
+        if driver['LIGHT_TOLERANCE'] > 0. and light_fresh:
+            print "  Max Available Light Error (all plots) = ", light_stats['max_light_error']
+        if driver['LIGHT_INCREMENTAL'] and light_fresh:
+            print "  Light Voxels Refreshed (all plots) = ", light_stats['voxels_refreshed']
+        if driver['LIGHT_COUNTERS'] and light_fresh:
+            print "  Light Rays Traced = %d, Mean Steps per Ray = %.2f" % \
+                (np.sum(light_counters_table[:,4]),
+                 np.sum(light_counters_table[:,4] * light_counters_table[:,5]) / max(np.sum(light_counters_table[:,4]), 1.))
+            if driver['LIGHT_ENGINE'] == 'per_arrow':
+                print "  Light Seconds per Arrow = %.4f" % np.mean(light_counters_table[:,8])
+
+
+        if not grow_fused:
+            # computing the regeneration factor for each species on each plot
+            # first, compute min(smf,sff,permafrost)*gddf   (below ground factors & thermal effects)
+            partial_growth_factor_matrix = workspace_buffer(workspace, 'partial_growth_factor', GDD_3D_spp_factor_matrix.shape)
+            np.minimum(soil_moist_3D_spp_factor_matrix, soil_fert_3D_spp_factor_matrix, out=partial_growth_factor_matrix)
+            np.minimum(partial_growth_factor_matrix, permafrost_factor_matrix, out=partial_growth_factor_matrix)
+            np.multiply(partial_growth_factor_matrix, GDD_3D_spp_factor_matrix, out=partial_growth_factor_matrix)
+
+            if driver['LIGHT_PRECISION_REPORT'] and light_fresh:
+                precision_report = compare_light_precision(actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat,
+                                                           arrows_list, x_size_m,y_size_m,z_size_m,
+                                                           tree_height_matrix, crown_base_matrix, species_code_matrix,
+                                                           number_of_species, DBH_matrix, partial_growth_factor_matrix,
+                                                           stress_flag_matrix, optimal_growth_increment_matrix,
+                                                           parallel=(driver['LIGHT_THREADS'] != 1),
+                                                           engine=driver['LIGHT_ENGINE'], ray_tables=ray_tables,
+                                                           canopy_bound=driver['LIGHT_CANOPY_BOUND'],
+                                                           tolerance=driver['LIGHT_TOLERANCE'],
+                                                           tile_size=driver['LIGHT_TILE_SIZE'],
+                                                           domains=driver['LIGHT_DOMAINS'], light_pool=light_pool)
+                light_precision_reports.append([year] + list(precision_report))
+                print "  Light float32 - float64 (max, mean): Available Light = %.3g, %.3g  Tree Light Factors = %.3g, %.3g  Growth Factors = %.3g, %.3g" % precision_report
+
+            # grow trees
+            DBH_matrix, stress_flag_matrix, \
+            growth_factor_matrix = grow_trees(DBH_matrix, species_code_matrix, available_light_spp_factor_matrix, 
+                                              partial_growth_factor_matrix, stress_flag_matrix, optimal_growth_increment_matrix,species_code_to_stress_threshold,
+                                              workspace=workspace)
+
+            # sizes of matrices: inputs: (nx,ny,spp_in_sim) * min((nx,ny,spp_in_sim),(nx,ny,spp_in_sim)) * (nx,ny,spp_in_sim)
+            # sprout_factor_matrix = ground_light_3D_spp_factor_matrix * np.minimum(soil_moist_3D_spp_factor_matrix, soil_fert_3D_spp_factor_matrix) * GDD_3D_spp_factor_matrix
+            sprout_factor_matrix = np.multiply(ground_light_3D_spp_factor_matrix, partial_growth_factor_matrix,
+                                               out=workspace_buffer(workspace, 'sprout_factor', partial_growth_factor_matrix.shape))
 
         #this also gets printed to local host terminal during model run for each year
         print "  Sprout Factor Matrix by Species: ", sprout_factor_matrix[0,0]
@@ -204,12 +328,16 @@ def StartSimulation(driver_filename, output_filename, driver):
 
 
         ### group by plot and by species
-        #basal area computation
-        basal_area_by_plot_by_species_matrix = compute_basal_area_by_plot_by_species(basal_area_matrix, species_code_matrix, number_of_species)
-        #biomass computation
-        biomass_by_plot_by_species_matrix = compute_biomass_by_plot_by_species(biomass_matrix, species_code_matrix, number_of_species)
+        if not driver['TREE_KERNEL_FUSED']:
+            #basal area computation
+            basal_area_by_plot_by_species_matrix = compute_basal_area_by_plot_by_species(basal_area_matrix, species_code_matrix, number_of_species,
+                                                                                         workspace=workspace)
+            #biomass computation
+            biomass_by_plot_by_species_matrix = compute_biomass_by_plot_by_species(biomass_matrix, species_code_matrix, number_of_species,
+                                                                                   workspace=workspace)
         #stem density for tree with DBH>=8.0cm, grouped by species. This is computed on a plot by plot basis.
-        stems_by_plot_by_species_matrix = compute_stems_by_plot_by_species(DBH_matrix, species_code_matrix, number_of_species)
+        stems_by_plot_by_species_matrix = compute_stems_by_plot_by_species(DBH_matrix, species_code_matrix, number_of_species,
+                                                                           workspace=workspace)
 
         # store data at the beginning of each year
         # storing data : function in driver decides if data is stored this year (could be stored at 10-yr intervals, etc.)
@@ -235,12 +363,23 @@ def StartSimulation(driver_filename, output_filename, driver):
                 GrowthFactor_group[sim_year] = growth_factor_matrix                       # size: nx,ny,ntrees
                 SproutFactor_group[sim_year] = sprout_factor_matrix                       # size: nx,ny,nspp
 
+    if light_pool is not None:
+        light_pool.close()
+        light_pool.join()
+
     ##close the climate record hdf file
     #if driver["CLIMATE_RANDOM"] == False:
     #    hdf_climate_file.close()
 
     # to the driver, add the list of years logged in the hdf file 
     driver['simulation_years_logged'] = simulation_years_logged
+    # store the years the available light was computed in, and the years it was re-used from an earlier year
+    hdf_file['LightFreshYears'] = np.array(light_fresh_years, dtype=int)
+    hdf_file['LightCachedYears'] = np.array(light_cached_years, dtype=int)
+    if driver['LIGHT_PRECISION_REPORT']:
+        # one row per year the light was computed: year, then the max and mean absolute float32 - float64 difference of
+        # the available light, the tree light factors and the growth factors (see compare_light_precision)
+        hdf_file['LightPrecisionReport'] = np.array(light_precision_reports, dtype=float).reshape(-1, 7)
     # store the driver as a pickled (dill) string in the hdf file (this allows access to driver from HDF file upon analysis)
     hdf_file['driver'] = np.array(dill.dumps(driver))
     # store a string copy of the driver file in the hdf
@@ -289,6 +428,7 @@ def initialization(driver_filename, output_filename, driver):
                                             soil moisture
                 tree_type_look_up_table --  a list of species participating in sim
 	            arrows_list 			--  list of tuples for direct & diffuse angles for light computation (see manual)
+                ray_tables              --  pre-computed path of each arrow through the grid (only for the 'tables' light engine, otherwise None)
                 actual_leaf_area_mat    --  contains -1 below ground and 0 above ground for each plot and air space above plot
                                             size: nx, ny, vertical space = (max_tree_ht+(max elevation in sim - min elevation in sim))
                 dem_offset_index_mat    --  a matrix with elevations above the minimum elev on sim'ed terrain, 
@@ -303,7 +443,13 @@ def initialization(driver_filename, output_filename, driver):
                 species_code_matrix -- records the specie of each tree in sim, size: sim grid by number of trees on each plot
                 stress_flag_matrix  -- records the stress flags for each tree in sim, size: sim grid by number of trees 
                                        on each plot
+                workspace           -- the matrices re-used from year to year for the values computed every year (see workspace.py)
+                weather_stream      -- the weather of all of the simulation years (see load_or_generate_weather_stream), None
+                                       without WEATHER_STREAM; kept out of the driver, which is pickled into the HDF file
     """
+    # keep the input rasters as binary arrays in RASTER_CACHE_DIR, so later runs memory-map them instead of parsing the
+    # ascii grids again (older drivers do not have this key, so read every raster with GDAL)
+    set_raster_cache_dir(driver.get('RASTER_CACHE_DIR', None))
     #size of simulation area, the size of each plot, and the North-West corner coordinate
     driver['DEM_mat'], x_size_m, y_size_m, NWx, NWy = read_in_ascii_attributes(driver['DEM_file_path'])
     # hardcode 1m as the step size in the vertical dimension (may want to change this later to accelerate light computation)
@@ -339,6 +485,33 @@ def initialization(driver_filename, output_filename, driver):
     # for PET, which is needed for soil moisture calculation:
     monthly_radiation_files_path = driver['monthly_radiation_files_path']  #WattHours/m2 accumulated for each month
     driver['radiation_mat_lst'] = one_time_radiation_readin(monthly_radiation_files_path,nx,ny)
+    # compute the weather and the weather factors once for each group of plots with the same lapse rate adjustment and monthly
+    # radiation (see weather.find_weather_plot_classes), unless nearly every plot differs (same results either way)
+    driver['weather_plot_classes'] = None
+    if driver.get('WEATHER_PLOT_CLASSES', True):
+        plot_classes = find_weather_plot_classes(driver['elevation_lapse_rate_adjustment_matrix'], driver['radiation_mat_lst'])
+        nclasses = len(plot_classes['plot_x'])
+        if nclasses <= nx * ny // 2:
+            driver['weather_plot_classes'] = plot_classes
+            print 'Info :: weather computed for %d plot classes instead of %d plots' % (nclasses, nx * ny)
+    if driver['weather_plot_classes'] is None:
+        weather_lapse_rate_adj_mat = driver['elevation_lapse_rate_adjustment_matrix']
+        weather_radiation_mat_lst = driver['radiation_mat_lst']
+    else:
+        weather_lapse_rate_adj_mat = driver['weather_plot_classes']['lapse_rate_adj']
+        weather_radiation_mat_lst = driver['weather_plot_classes']['radiation_mat_lst']
+    # generate the weather of all of the simulation years up front from random numbers of its own (WEATHER_STREAM), seeded by
+    # WEATHER_SEED, and keep it in WEATHER_CACHE_DIR for later runs with the same climate and grid (older drivers do not have these keys)
+    driver['WEATHER_STREAM'] = driver.get('WEATHER_STREAM', False)
+    weather_stream = None
+    if driver['WEATHER_STREAM']:
+        weather_stream = load_or_generate_weather_stream(driver['return_annual_weather_function'],
+                                                         range(driver['sim_start_year'], driver['sim_stop_year']+1),
+                                                         driver['DDBASE'], driver['minT'], driver['maxT'],
+                                                         weather_lapse_rate_adj_mat,
+                                                         weather_radiation_mat_lst, driver['FC'], driver['WP'],
+                                                         initial_soil_water_mat, driver.get('WEATHER_SEED', 0),
+                                                         cache_dir=driver.get('WEATHER_CACHE_DIR', None))
     # for the soil fertility matrices:
     driver['site_index_mat'] = read_in_ascii(driver["Site_index_file_path"])  #values 1-5, 1=fertile soil, 5=poor soil, based on Orlov??? 1927 classification of soils for Russia
     if driver['site_index_mat'].shape != (nx,ny):
@@ -392,10 +565,90 @@ def initialization(driver_filename, output_filename, driver):
         #assert(False)
     else:
         raise Exception("Can't grow trees in hyperbolic space! Select a proper LIGHT_MODE in driver (1D or 3D)!")
+    # number of threads for the light computation (older drivers do not have this key, so run the serial light code)
+    driver['LIGHT_THREADS'] = driver.get('LIGHT_THREADS', 1)
+    if driver['LIGHT_THREADS'] != 1:
+        print 'Info :: light computation running on %d threads' % set_light_threads(driver['LIGHT_THREADS'])
+    # the light engine used to trace the arrows (older drivers use the original per arrow sweep)
+    driver['LIGHT_ENGINE'] = driver.get('LIGHT_ENGINE', 'per_arrow')
+    if driver['LIGHT_MODE']=='1D':
+        # light only comes from straight overhead, so a cumulative sum down each column replaces the ray tracer
+        driver['LIGHT_ENGINE'] = 'prefix_sum'
+    elif driver['LIGHT_ENGINE'] not in ('per_arrow', 'fused', 'tables'):
+        raise Exception("Unknown LIGHT_ENGINE %s in driver! Select per_arrow, fused or tables for LIGHT_MODE 3D!" % driver['LIGHT_ENGINE'])
+    # with the tables engine, give full light to the voxels above the canopy tops each arrow can reach without tracing them
+    # (older drivers trace every voxel)
+    driver['LIGHT_CANOPY_BOUND'] = driver.get('LIGHT_CANOPY_BOUND', False)
+    if driver['LIGHT_CANOPY_BOUND'] and driver['LIGHT_ENGINE'] != 'tables':
+        print 'Info :: LIGHT_CANOPY_BOUND is only used by the tables light engine, tracing every voxel'
+        driver['LIGHT_CANOPY_BOUND'] = False
+    # split the grid into LIGHT_DOMAINS (along x, y) computed by LIGHT_PROCESSES worker processes for very large landscapes
+    # (older drivers do not have these keys, so compute the light of the whole grid at once)
+    driver['LIGHT_DOMAINS'] = tuple(driver.get('LIGHT_DOMAINS', (1, 1)))
+    driver['LIGHT_PROCESSES'] = driver.get('LIGHT_PROCESSES', 1)
+    if driver['LIGHT_DOMAINS'] != (1, 1):
+        print 'Info :: light computed in %d x %d domains, LIGHT_ENGINE, LIGHT_CANOPY_BOUND, LIGHT_INCREMENTAL and LIGHT_TILE_SIZE are not used' % driver['LIGHT_DOMAINS']
+    # stop tracing an arrow once the light it delivers is at most LIGHT_TOLERANCE (0 traces every arrow to the end)
+    driver['LIGHT_TOLERANCE'] = driver.get('LIGHT_TOLERANCE', 0.)
+    if driver['LIGHT_TOLERANCE'] > 0. and driver['LIGHT_ENGINE'] not in ('fused', 'tables') and driver['LIGHT_DOMAINS'] == (1, 1):
+        print 'Info :: LIGHT_TOLERANCE is only used by the fused and tables light engines, tracing every arrow to the end'
+        driver['LIGHT_TOLERANCE'] = 0.
+    # only re-trace the light of voxels whose arrows pass through plots with leaf area changes larger than LIGHT_CHANGE_THRESHOLD
+    driver['LIGHT_INCREMENTAL'] = driver.get('LIGHT_INCREMENTAL', False)
+    driver['LIGHT_CHANGE_THRESHOLD'] = driver.get('LIGHT_CHANGE_THRESHOLD', 0.)
+    if driver['LIGHT_INCREMENTAL'] and (driver['LIGHT_ENGINE'] != 'tables' or driver['LIGHT_DOMAINS'] != (1, 1)):
+        print 'Info :: LIGHT_INCREMENTAL is only used by the tables light engine, computing all of the light every year'
+        driver['LIGHT_INCREMENTAL'] = False
+    # visit the grid in tiles of LIGHT_TILE_SIZE x LIGHT_TILE_SIZE plots to keep the leaf area in the cache (0 = no tiling)
+    driver['LIGHT_TILE_SIZE'] = driver.get('LIGHT_TILE_SIZE', 0)
+    if driver['LIGHT_TILE_SIZE'] > 0 and driver['LIGHT_ENGINE'] != 'tables':
+        print 'Info :: LIGHT_TILE_SIZE is only used by the tables light engine, visiting the grid plot by plot'
+        driver['LIGHT_TILE_SIZE'] = 0
+    # with the tables engine, trace the light through runs of constant leaf area built from the leaf area matrix
+    driver['LIGHT_SPARSE'] = driver.get('LIGHT_SPARSE', False)
+    if driver['LIGHT_SPARSE']:
+        if driver['LIGHT_ENGINE'] != 'tables' or driver['LIGHT_DOMAINS'] != (1, 1) or driver['LIGHT_INCREMENTAL']:
+            print 'Info :: LIGHT_SPARSE is only used by the tables light engine without LIGHT_DOMAINS or LIGHT_INCREMENTAL'
+            driver['LIGHT_SPARSE'] = False
+        elif driver['LIGHT_TILE_SIZE'] > 0:
+            print 'Info :: LIGHT_TILE_SIZE is not used with LIGHT_SPARSE, visiting the grid plot by plot'
+            driver['LIGHT_TILE_SIZE'] = 0
+    # compute the light every LIGHT_REFRESH_YEARS years, or as soon as the total leaf area of any plot changes by more than
+    # the fraction LIGHT_REFRESH_DRIFT (older drivers do not have these keys, so compute the light every year)
+    driver['LIGHT_REFRESH_YEARS'] = driver.get('LIGHT_REFRESH_YEARS', 1)
+    driver['LIGHT_REFRESH_DRIFT'] = driver.get('LIGHT_REFRESH_DRIFT', 0.)
+    # the precision of the leaf area, available light and light factor matrices (older drivers do not have this key)
+    driver['LIGHT_PRECISION'] = driver.get('LIGHT_PRECISION', 'float64')
+    if driver['LIGHT_PRECISION'] not in ('float64', 'float32'):
+        raise Exception("LIGHT_PRECISION must be 'float64' or 'float32', received %s" % driver['LIGHT_PRECISION'])
+    # compare the light computed in float32 and float64 every year the light is computed
+    driver['LIGHT_PRECISION_REPORT'] = driver.get('LIGHT_PRECISION_REPORT', False)
+    # count the rays, steps, terrain hits and wrap arounds of each arrow in the light engine, every year the light is computed
+    driver['LIGHT_COUNTERS'] = driver.get('LIGHT_COUNTERS', False)
+    if driver['LIGHT_COUNTERS']:
+        if driver['LIGHT_ENGINE'] not in ('per_arrow', 'fused', 'tables') or driver['LIGHT_DOMAINS'] != (1, 1) or \
+                driver['LIGHT_SPARSE']:
+            print 'Info :: LIGHT_COUNTERS are only counted by the per_arrow, fused and tables light engines without LIGHT_DOMAINS or LIGHT_SPARSE'
+            driver['LIGHT_COUNTERS'] = False
+        elif driver['LIGHT_TILE_SIZE'] > 0:
+            print 'Info :: LIGHT_TILE_SIZE is not used with LIGHT_COUNTERS, visiting the grid plot by plot'
+            driver['LIGHT_TILE_SIZE'] = 0
+    # visit the trees in two fused passes each year, before and after the light computation (see
+    # compute_tree_values_and_leaf_area and grow_trees_fused; older drivers do not have this key, so use the separate steps)
+    driver['TREE_KERNEL_FUSED'] = driver.get('TREE_KERNEL_FUSED', False)
     # set up an empty actual leaf area matrix that has been adjusted for elevation in the DEM = these are the initial conditions w/o tree but w/terrain
     actual_leaf_area_mat, dem_offset_index_mat = prepare_actual_leaf_area_mat_from_dem(dem_mat=driver['DEM_mat'], 
                                                              zsize=z_size_m, 
                                                              max_tree_ht=driver['MAX_TREE_HEIGHT'])  # the maximum height a tree can reach in m
+    # The path of every arrow through the grid does not change during the simulation, so the 'tables' light engine
+    # pre-computes it once here. The yearly leaf area matrix (see compute_actual_leaf_area) is MAX_TREE_HEIGHT high.
+    # If LIGHT_TABLES_CACHE_DIR is set in the driver, the tables are stored there and re-used by later runs on the same DEM.
+    if driver['LIGHT_ENGINE'] == 'tables' and driver['LIGHT_DOMAINS'] == (1, 1):
+        ray_tables = load_or_build_ray_tables(arrows_list, dem_offset_index_mat, 
+                                              nz=int(math.ceil(driver['MAX_TREE_HEIGHT'] / float(z_size_m))), zsize=z_size_m,
+                                              cache_dir=driver.get('LIGHT_TABLES_CACHE_DIR', None))
+    else:
+        ray_tables = None
     # Read in the radiation fraction matrix that is used to scale the proportion of radiation (unitless ratio)
     # that is available to every location on the DEM at ground-level. This will be used to account for terrain shading.
     # Ground-level light, post accounting for shading by terrain, is pretty much the same as the
@@ -433,15 +686,25 @@ def initialization(driver_filename, output_filename, driver):
         grp12 = hdf_file.create_group("AvailableLightFactor")    # size: nx,ny,ntrees
         grp13 = hdf_file.create_group("SproutFactor")            # size: nx,ny,nspp
         grp14 = hdf_file.create_group("GrowthFactor")            # size: nx,ny,ntrees
+    # the work and time of each light arrow, for every year the light is computed
+    if driver['LIGHT_COUNTERS']:
+        grp15 = hdf_file.create_group("LightCounters")           # size: narrows, len(LIGHT_COUNTER_COLUMNS)
+        grp15.attrs['columns'] = np.array(LIGHT_COUNTER_COLUMNS)
+
 
+    # the matrices of the values computed again every year (tree values, leaf area, factors, sums by species), allocated
+    # once here and re-used every year (see workspace.py)
+    workspace = create_workspace(plots_x, plots_y, driver["MAX_TREES_PER_PLOT"], number_of_species, driver['MAX_TREE_HEIGHT'],
+                                 driver['LIGHT_PRECISION'])
 
     return driver, initial_soil_water_mat, \
-           arrows_list, actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, plot_area, \
-           DBH_matrix, crown_base_matrix, species_code_matrix, stress_flag_matrix, seed_bank_matrix, hdf_file
+           arrows_list, ray_tables, actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, plot_area, \
+           DBH_matrix, crown_base_matrix, species_code_matrix, stress_flag_matrix, seed_bank_matrix, hdf_file, workspace, \
+           weather_stream
 
 
 
-def generate_weather(driver, initial_soil_water_mat, year):
+def generate_weather(driver, initial_soil_water_mat, year, weather_stream=None):
     """
     Generate average monthly temperatures and precipitation sums from avg and std values provided in driver file from 
     historical data.
@@ -450,30 +713,54 @@ def generate_weather(driver, initial_soil_water_mat, year):
                 intial_soil_water_mat -- initialized at field capacity (FC) to start the simulation off with sufficient
                                          soil moisture (cm in top 1m of soil)
                 year -- current simulation year (integer)
+                weather_stream -- the weather of all of the simulation years generated at initialization (WEATHER_STREAM),
+                                  None to generate the weather of this year
 
     Returns:    soil_moisture_mat --     a fraction 0 to 1 of soil moisture on each plot based on precip sim and PET calc;
                                          PET is temp & readiation-based
                 GDD_matrix --            a matrix the size of the sim grid of accumulated growing degrees over this year in sim
                 drydays_fraction_mat -- the fraction 0 to 1 of the growing season in drought
     """
-    temperature_avg_vec, temperature_std_vec, rain_avg_vec, rain_std_vec = driver['return_annual_weather_function'](year)  #units: deg C, deg C, cm, cm
-
-    GDD_matrix, \
-    monthly_temp_mat_lst, \
-    total_growing_season_mat = GrowingDegreeDays_calc(ddbase = driver["DDBASE"], monthly_temperature_avgs_lst = temperature_avg_vec, 
-                                                      monthly_temperature_stds_lst = temperature_std_vec, 
-                                                      monthly_temperature_mins_lst = driver["minT"],
-                                                      monthly_temperature_maxs_lst = driver["maxT"],
-                                                      lapse_rate_adj_mat = driver['elevation_lapse_rate_adjustment_matrix'])
-    # simulate random precipitation
-    monthly_sim_rain_vec = rain_sim(rainfall_monthly_avgs = rain_avg_vec, rainfall_monthly_stds = rain_std_vec)
-    
-    radiation_mat_lst = driver["radiation_mat_lst"]  #Watt-Hours/m2, a matrix for each month contains a montly value for each plot
-    soil_moisture_mat, \
-    drydays_fraction_mat = drydays(total_growing_season_mat = total_growing_season_mat, soil_moisture_mat = initial_soil_water_mat, 
-                                   wilting_point = driver['WP'], monthly_temp_mat_lst = monthly_temp_mat_lst, 
-                                   radiation_mat_lst = radiation_mat_lst, field_capacity = driver['FC'],
-                                   monthly_sim_rain_vec = monthly_sim_rain_vec, ddbase = driver["DDBASE"]) 
+    # with plot classes, the weather is computed on a grid of one plot per class and then spread back to every plot
+    plot_classes = driver['weather_plot_classes']
+    if plot_classes is None:
+        lapse_rate_adj_mat = driver['elevation_lapse_rate_adjustment_matrix']
+        radiation_mat_lst = driver["radiation_mat_lst"]  #Watt-Hours/m2, a matrix for each month contains a montly value for each plot
+    else:
+        lapse_rate_adj_mat = plot_classes['lapse_rate_adj']
+        radiation_mat_lst = plot_classes['radiation_mat_lst']
+        if np.ndim(initial_soil_water_mat) == 2:
+            initial_soil_water_mat = compress_plots(initial_soil_water_mat, plot_classes)
+
+    if weather_stream is not None:
+        # the weather of this year was generated at initialization (the soil water carries over inside the stream)
+        monthly_temp_mat_lst, soil_moisture_mat, \
+        GDD_matrix, drydays_fraction_mat = weather_stream_year(weather_stream, year - driver['sim_start_year'],
+                                                               lapse_rate_adj_mat)
+    else:
+        temperature_avg_vec, temperature_std_vec, rain_avg_vec, rain_std_vec = driver['return_annual_weather_function'](year)  #units: deg C, deg C, cm, cm
+
+        GDD_matrix, \
+        monthly_temp_mat_lst, \
+        total_growing_season_mat = GrowingDegreeDays_calc(ddbase = driver["DDBASE"], monthly_temperature_avgs_lst = temperature_avg_vec, 
+                                                          monthly_temperature_stds_lst = temperature_std_vec, 
+                                                          monthly_temperature_mins_lst = driver["minT"],
+                                                          monthly_temperature_maxs_lst = driver["maxT"],
+                                                          lapse_rate_adj_mat = lapse_rate_adj_mat)
+        # simulate random precipitation
+        monthly_sim_rain_vec = rain_sim(rainfall_monthly_avgs = rain_avg_vec, rainfall_monthly_stds = rain_std_vec)
+
+        soil_moisture_mat, \
+        drydays_fraction_mat = drydays(total_growing_season_mat = total_growing_season_mat, soil_moisture_mat = initial_soil_water_mat, 
+                                       wilting_point = driver['WP'], monthly_temp_mat_lst = monthly_temp_mat_lst, 
+                                       radiation_mat_lst = radiation_mat_lst, field_capacity = driver['FC'],
+                                       monthly_sim_rain_vec = monthly_sim_rain_vec, ddbase = driver["DDBASE"]) 
+
+    if plot_classes is not None:
+        monthly_temp_mat_lst = [expand_plots(monthly_temp_mat, plot_classes) for monthly_temp_mat in monthly_temp_mat_lst]
+        soil_moisture_mat = expand_plots(soil_moisture_mat, plot_classes)
+        GDD_matrix = expand_plots(GDD_matrix, plot_classes)
+        drydays_fraction_mat = expand_plots(drydays_fraction_mat, plot_classes)
 
     return monthly_temp_mat_lst, soil_moisture_mat, GDD_matrix, drydays_fraction_mat
 
@@ -582,10 +869,9 @@ def biomass_plot_wide_relative_soil_fertility(DBH_vec, biomass_vec, opt_inc_vec,
 '''
 
 ############ biovolume increment using only above ground factors ################
-@numba.jit()
 def compute_plot_likely_biovolume_increment(species_code_matrix, GDD_3D_spp_factor_matrix, 
                                             available_light_spp_factor_matrix, 
-                                            optimal_biovolume_increment_matrix):
+                                            optimal_biovolume_increment_matrix, workspace=None):
     """
     Compute the biovolume that each plot will contain if the growth is not limited by any below ground factors such as soil moisture
     or soil fertility.
@@ -599,14 +885,23 @@ def compute_plot_likely_biovolume_increment(species_code_matrix, GDD_3D_spp_fact
                 optimal_biovolume_increment_matrix -- the optimal biovolume increment that could occur under optimal conditions
                                                       for each tree in the simulation
                               size : nx, ny, ntrees
+                workspace -- the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
     Returns : likely_biovolume_increment_matrix -- the biovolume increment for each tree when only taking into account above
                                                    ground factors
                                                    size : nx,ny,ntrees
     """
     nx, ny, ntrees = species_code_matrix.shape
-    likely_biovolume_increment_matrix = np.zeros((nx,ny,ntrees))
+    likely_biovolume_increment_matrix = workspace_buffer(workspace, 'likely_biovolume_increment', (nx,ny,ntrees))
+    return compute_plot_likely_biovolume_increment_numba(species_code_matrix, GDD_3D_spp_factor_matrix,
+                                                         available_light_spp_factor_matrix, optimal_biovolume_increment_matrix,
+                                                         likely_biovolume_increment_matrix)
 
+@numba.jit(nopython=True)
+def compute_plot_likely_biovolume_increment_numba(species_code_matrix, GDD_3D_spp_factor_matrix,
+                                                  available_light_spp_factor_matrix, optimal_biovolume_increment_matrix,
+                                                  likely_biovolume_increment_matrix):
+    nx, ny, ntrees = species_code_matrix.shape
     for x in range(nx):
         for y in range(ny):
             for tree in range(ntrees):
@@ -622,9 +917,9 @@ def compute_plot_likely_biovolume_increment(species_code_matrix, GDD_3D_spp_fact
 
 
 ##### soil fertility computed from biovolume #####
-@numba.jit()
 def biovolume_compute_relative_soil_fertility_matrix(likely_biovolume_increment_matrix,
-                                                     plot_max_biovolume_increment_matrix): #comes from site index to biovolume convert
+                                                     plot_max_biovolume_increment_matrix, #comes from site index to biovolume convert
+                                                     workspace=None):
     """
     Compute the ratio of likely biovolume increment to what the plot can support.
 
@@ -632,18 +927,26 @@ def biovolume_compute_relative_soil_fertility_matrix(likely_biovolume_increment_
                                                       size : nx,ny,ntrees
                  plot_max_biovolume_increment_matrix -- the maximum biovolume increment that each plot can support (Gross Primary Productivity cap based on site index)
                                                       size : nx,ny
+                 workspace -- the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
     Returns : relative_soil_fertility_matrix -- the ratio of what the plot can support to the possible biovolume increment
                                                 size : nx,ny
     """
     nx,ny,ntrees = likely_biovolume_increment_matrix.shape
-    relative_soil_fertility_matrix = np.zeros((nx,ny))
-    # sum the biovolume increment for all trees on each plot, size:nx,ny
-    plot_likely_biovolume_increment_mat = np.sum(likely_biovolume_increment_matrix, axis=2)
+    relative_soil_fertility_matrix = workspace_buffer(workspace, 'relative_soil_fertility', (nx,ny))
+    return biovolume_compute_relative_soil_fertility_matrix_numba(likely_biovolume_increment_matrix,
+                                                                  plot_max_biovolume_increment_matrix, relative_soil_fertility_matrix)
 
+@numba.jit(nopython=True)
+def biovolume_compute_relative_soil_fertility_matrix_numba(likely_biovolume_increment_matrix,
+                                                           plot_max_biovolume_increment_matrix, relative_soil_fertility_matrix):
+    nx,ny,ntrees = likely_biovolume_increment_matrix.shape
     for x in range(nx):
         for y in range(ny):
-            plot_likely_biovolume_increment = plot_likely_biovolume_increment_mat[x,y]
+            # sum the biovolume increment for all trees on this plot
+            plot_likely_biovolume_increment = 0.
+            for ind in range(ntrees):
+                plot_likely_biovolume_increment += likely_biovolume_increment_matrix[x,y,ind]
             plot_max_biovolume_increment = plot_max_biovolume_increment_matrix[x,y]
             if plot_likely_biovolume_increment <= plot_max_biovolume_increment:
                 relative_soil_fertility_matrix[x,y] = 1.0
@@ -655,8 +958,8 @@ def biovolume_compute_relative_soil_fertility_matrix(likely_biovolume_increment_
 ##### end soil fertility computed from biovolume #####
 
 
-@numba.jit()
-def light_factor_compute(available_light_mat, tree_height_matrix, crown_base_matrix, species_code_matrix, number_of_species):
+def light_factor_compute(available_light_mat, tree_height_matrix, crown_base_matrix, species_code_matrix, number_of_species,
+                         workspace=None):
     """
     compute available light for each step through the canopy
     compute ground-level light
@@ -669,17 +972,26 @@ def light_factor_compute(available_light_mat, tree_height_matrix, crown_base_mat
                                         on each plot
                 species_code_matrix  -- records the specie of each tree in sim, size: sim grid by number of trees on each plot
                 number_of_species    -- the number of species participating in sim
+                workspace            -- the matrices re-used from year to year (see workspace.py), None to allocate new ones
 
     Returns:    ground_light_spp_factor_matrix -- size: nx,ny,spp_in_sim
                 available_light_spp_factor_matrix -- size: nx,ny,ntrees
 
     """
     nx, ny, ntrees = tree_height_matrix.shape
-    available_light_spp_factor_matrix = np.zeros((nx,ny,ntrees))
-    ground_light_spp_factor_matrix = np.zeros((nx,ny,number_of_species))
+    available_light_spp_factor_matrix = workspace_buffer(workspace, 'tree_light_factor', (nx,ny,ntrees))
+    ground_light_spp_factor_matrix = workspace_buffer(workspace, 'ground_light_factor', (nx,ny,number_of_species))
     # compute a 4D matrix (nx,ny,nz,spp) containing the light factors by height and by species
-    light_factor_by_species_matrix = compute_available_light_factors_by_species(available_light_mat, number_of_species)
+    light_factor_by_species_matrix = compute_available_light_factors_by_species(available_light_mat, number_of_species,
+                                                                                workspace=workspace)
+    return light_factor_compute_numba(light_factor_by_species_matrix, tree_height_matrix, crown_base_matrix, species_code_matrix,
+                                      ground_light_spp_factor_matrix, available_light_spp_factor_matrix)
 
+@numba.jit(nopython=True)
+def light_factor_compute_numba(light_factor_by_species_matrix, tree_height_matrix, crown_base_matrix, species_code_matrix,
+                               ground_light_spp_factor_matrix, available_light_spp_factor_matrix):
+    nx, ny, ntrees = tree_height_matrix.shape
+    number_of_species = ground_light_spp_factor_matrix.shape[2]
     # for each individual tree the light factor is averaged over the length of the tree crown (crown base to height)
     for x in range(nx):
         for y in range(ny):
@@ -697,6 +1009,8 @@ def light_factor_compute(available_light_mat, tree_height_matrix, crown_base_mat
 
                     tree_light_factor /= float(crown_length)
                     available_light_spp_factor_matrix[x,y,ind] = tree_light_factor
+                else:
+                    available_light_spp_factor_matrix[x,y,ind] = 0.
 
             # build the nx,ny,nspp ground_light_matrix used for sprouting
             for spp in range(number_of_species):
@@ -800,7 +1114,8 @@ def sprout_saplings_v2_3(DBH_matrix, crown_base_matrix, species_code_matrix, str
 
 #@numba.jit(nopython=True)
 def grow_trees(DBH_matrix, species_code_matrix, available_light_spp_factor_matrix, 
-                     partial_growth_factor_matrix, stress_flag_matrix, optimal_growth_increment_matrix,species_code_to_stress_threshold):
+                     partial_growth_factor_matrix, stress_flag_matrix, optimal_growth_increment_matrix,species_code_to_stress_threshold,
+                     workspace=None):
     """
     Increment DBH based on optimal diameter increment (passed in) and the stresses the tree experiences based on environmental conditions/limitations.
 
@@ -812,13 +1127,14 @@ def grow_trees(DBH_matrix, species_code_matrix, available_light_spp_factor_matri
                  optimal_growth_increment_matrix -- optimal growth increment (cm) for each tree
                                                     matrix size: nx,ny,spp_in_sim
                  species_code_to_stress_threshold -- look-up-table for species-specific minimum annual growth requirements (as fraction of opt inc)
+                 workspace -- the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
     Returns:    DBH_matrix -- records DBH for every tree in sim, size: sim grid by number of trees on each plot
                 stress_flag_matrix -- the stress flag accumulator for each tree in the simulation; size: nx,ny,ntrees
                 growth_factor_matrix -- the growth factor for each tree in the simulation; size: nx,ny,ntrees
     """
     nx,ny,ntrees = DBH_matrix.shape
-    growth_factor_matrix = np.zeros((nx,ny,ntrees))
+    growth_factor_matrix = workspace_buffer(workspace, 'growth_factor', (nx,ny,ntrees), zero=True)
     for x in range(nx):
         for y in range(ny):
             for individual in range(ntrees): #address of each cell in 3-D matrix
@@ -843,7 +1159,7 @@ def grow_trees(DBH_matrix, species_code_matrix, available_light_spp_factor_matri
     return DBH_matrix, stress_flag_matrix, growth_factor_matrix
 
 
-def kill_trees(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_base_matrix, number_of_species):
+def kill_trees(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_base_matrix, number_of_species, workspace=None):
     """
     
 
@@ -854,16 +1170,17 @@ def kill_trees(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_base_m
                  crown_base_matrix -- records the crown base for each tree in sim, size: sim grid by number of trees 
                                       on each plot
                  number_of_species -- scalar number of species in this simulation
+                 workspace -- the matrices re-used from year to year (see workspace.py), None to allocate new ones
 
     Returns:      DBH_matrix -- records DBH for every tree in sim, size: sim grid by number of trees on each plot
                   stress_flag_matrix -- records the stress flags for each tree in sim, size: sim grid by number of trees 
                                         on each plot
     """
     # compute a matrix containing the age mortality probability for each tree
-    age_mortality_probability_mat = np.zeros(DBH_matrix.shape, dtype=np.double)
-    for current_species_code in range(number_of_species):
-        mat_locations = (species_code_matrix == current_species_code)
-        age_mortality_probability_mat[mat_locations] = species_code_to_age_mortality_function[current_species_code]()  #species-specific through AGEMAX
+    age_mortality_probability_vec = np.array([species_code_to_age_mortality_function[current_species_code]()  #species-specific through AGEMAX
+                                              for current_species_code in range(number_of_species)], dtype=np.double)
+    age_mortality_probability_mat = workspace_buffer(workspace, 'age_mortality_probability', DBH_matrix.shape)
+    species_age_mortality_probability_numba(species_code_matrix, age_mortality_probability_vec, age_mortality_probability_mat)
     # compute a matrix of random numbers
     a_random_mat = np.random.random(DBH_matrix.shape)
     b_random_mat = np.random.random(DBH_matrix.shape)
@@ -872,6 +1189,21 @@ def kill_trees(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_base_m
                             age_mortality_probability_mat, a_random_mat, b_random_mat)
 
 
+@numba.jit(nopython=True)
+def species_age_mortality_probability_numba(species_code_matrix, age_mortality_probability_vec, age_mortality_probability_mat):
+    # the age mortality probability of the species of each tree, 0 where there is no tree
+    nx,ny,ntrees = species_code_matrix.shape
+    number_of_species = age_mortality_probability_vec.shape[0]
+    for x in range(nx):
+        for y in range(ny):
+            for ind in range(ntrees):
+                species_code = species_code_matrix[x,y,ind]
+                if species_code >= 0 and species_code < number_of_species:
+                    age_mortality_probability_mat[x,y,ind] = age_mortality_probability_vec[species_code]
+                else:
+                    age_mortality_probability_mat[x,y,ind] = 0.
+
+
 @numba.jit(nopython=True)
 def kill_trees_numba(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_base_matrix, 
                      age_mortality_probability_mat, a_random_mat, b_random_mat):
@@ -904,7 +1236,9 @@ def kill_trees_numba(DBH_matrix, species_code_matrix, stress_flag_matrix, crown_
     return DBH_matrix, stress_flag_matrix, species_code_matrix, crown_base_matrix
 
 
-def compute_light(actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, arrows_list, xsize,ysize,zsize):
+def compute_light(actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, arrows_list, xsize,ysize,zsize, parallel=False, engine='per_arrow', ray_tables=None, canopy_bound=False,
+                  tolerance=0., light_stats=None, light_state=None, change_threshold=0., tile_size=0,
+                  domains=(1, 1), light_pool=None, leaf_area_segments=None, count=False, workspace=None):
     """
 
     Parameters:  actual_leaf_area_mat   --  contains the column of actual leaf area for each plot in the simulation grid
@@ -918,6 +1252,34 @@ def compute_light(actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction
                  xsize,ysize,zsize      --  dimensions along the edges of each plot
                                             usually specified at 10m x 10m (horizontal resolution) 
                                             by 1m (vertical resolution)
+                 parallel               --  if True, spread the plots across the threads set by LIGHT_THREADS in the driver
+                 engine                 --  how the arrows are traced, 'per_arrow', 'fused', 'tables' or 'prefix_sum'
+                                            (LIGHT_ENGINE in the driver, see light3d.compute_3D_light_matrix)
+                 ray_tables             --  pre-computed path of each arrow through the grid, needed by the 'tables' engine
+                 canopy_bound           --  if True, the 'tables' engine gives full light to the voxels above the highest canopy
+                                            each arrow can reach instead of tracing them (same results)
+                 tolerance              --  stop tracing an arrow once the light it delivers is at most this value
+                                            (LIGHT_TOLERANCE in the driver, 0 traces every arrow to the end)
+                 light_stats            --  optional dictionary, filled with 'max_light_error': the largest possible
+                                            over-estimate of the available light in any voxel due to the tolerance,
+                                            and 'voxels_refreshed': the number of voxels computed by the 'tables' engine
+                 light_state            --  dictionary kept from year to year for incremental light updates with the 'tables'
+                                            engine (LIGHT_INCREMENTAL in the driver), None to compute all of the light
+                 change_threshold       --  with incremental light updates, the change in the leaf area of a voxel that makes
+                                            the light of the voxels whose arrows pass through it be computed again
+                                            (LIGHT_CHANGE_THRESHOLD in the driver, 0 gives the same results as computing all of the light)
+                 tile_size              --  with the 'tables' engine, visit the grid in tiles of tile_size x tile_size plots
+                                            (LIGHT_TILE_SIZE in the driver, 0 = plot by plot, same results)
+                 domains                --  the number of domains along x and y to split the grid into, each computed from
+                                            its own window of the leaf area (LIGHT_DOMAINS in the driver, see light_domains.py)
+                 light_pool             --  the worker processes computing the domains, None to compute them one at a time
+                 leaf_area_segments     --  with the 'tables' engine, the leaf area of every plot column as runs of constant
+                                            density (LIGHT_SPARSE in the driver, see light3d.build_leaf_area_segments),
+                                            None to read the leaf area from actual_leaf_area_mat (same results)
+                 count                  --  if True, the 'per_arrow', 'fused' and 'tables' engines also count their work along
+                                            every arrow, stored as light_stats['light_counters'] (LIGHT_COUNTERS in the driver)
+                 workspace              --  the matrices re-used from year to year (see workspace.py), None to allocate a new
+                                            available light matrix (the domains always allocate their own)
                  
     Returns:     available_light_mat -- available light matrix
     """
@@ -925,15 +1287,104 @@ def compute_light(actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction
     nx,ny,nz = actual_leaf_area_mat.shape
     # finally compute the available light matrix based on the actual leaf area and the "arrow" directions and proportions
     # actual_leaf_area_mat will have 0s and -1s in it during 1st year of sim, then populated with other values (-1s stay same)
+    if domains != (1, 1):
+        return compute_3D_light_matrix_domains(actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat,
+                                               xsize,ysize,zsize, arrows_list, domains[0], domains[1], pool=light_pool,
+                                               tolerance=tolerance, light_stats=light_stats)
     available_light_mat = compute_3D_light_matrix(actual_leaf_area_mat, 
                                                   dem_offset_index_mat,
                                                   radiation_fraction_mat, #scaled by max radiation received on s-facing slopes >10deg, computed in GIS
                                                   xsize,ysize,zsize,  # dimesions (in meters) along each plot box
-                                                  arrows_list) #list of tuples for direct & diffuse angles for light computation
+                                                  arrows_list, #list of tuples for direct & diffuse angles for light computation
+                                                  parallel=parallel, engine=engine, ray_tables=ray_tables,
+                                                  canopy_bound=canopy_bound, tolerance=tolerance,
+                                                  light_stats=light_stats, light_state=light_state,
+                                                  change_threshold=change_threshold, tile_size=tile_size,
+                                                  leaf_area_segments=leaf_area_segments, count=count,
+                                                  out=workspace_buffer(workspace, 'available_light', (nx,ny,nz),
+                                                                       dtype=actual_leaf_area_mat.dtype))
 
     return available_light_mat
 
 
+def compute_plot_species_factors_weather(GDD_matrix, drydays_fraction_mat, number_of_species, plot_classes):
+    """
+    The species specific degree day and soil moisture factors of every plot (see compute_species_factors_weather),
+    computed once for each plot class and spread back to the plots of the class (the weather of every plot of a class
+    is the same, see weather.find_weather_plot_classes).
+
+    Parameters:  plot_classes -- the weather plot classes, None to compute the factors of each plot
+
+    Returns:     GDD_3D_spp_factor_matrix, soil_moist_3D_spp_factor_matrix -- size: nx,ny,nspp
+    """
+    if plot_classes is None:
+        return compute_species_factors_weather(GDD_matrix, drydays_fraction_mat, number_of_species)
+    GDD_3D_spp_factor_matrix, \
+    soil_moist_3D_spp_factor_matrix = compute_species_factors_weather(compress_plots(GDD_matrix, plot_classes),
+                                                                      compress_plots(drydays_fraction_mat, plot_classes),
+                                                                      number_of_species)
+    return expand_plots(GDD_3D_spp_factor_matrix, plot_classes), expand_plots(soil_moist_3D_spp_factor_matrix, plot_classes)
+
+
+def light_refresh_needed(driver, year, light_refresh_year, plot_leaf_area_mat, light_refresh_leaf_area_mat):
+    """
+    Decide whether the available light has to be computed this year, or if the light of the last year it was computed
+    can be re-used. The light is computed every LIGHT_REFRESH_YEARS years (from the driver), and also whenever the total
+    leaf area of any plot has changed by more than the fraction LIGHT_REFRESH_DRIFT (from the driver, 0 to turn off) since.
+
+    Parameters:  year                        --  the current simulation year
+                 light_refresh_year          --  the last year the light was computed, None if it has not been computed yet
+                 plot_leaf_area_mat          --  the total actual leaf area of each plot this year, size: nx,ny
+                 light_refresh_leaf_area_mat --  the total actual leaf area of each plot when the light was last computed
+
+    Returns:     True if the light has to be computed this year
+    """
+    if light_refresh_year is None or year - light_refresh_year >= driver['LIGHT_REFRESH_YEARS']:
+        return True
+    if driver['LIGHT_REFRESH_DRIFT'] > 0.:
+        # plots that had no leaves when the light was computed count as drifted as soon as they have leaves
+        leaf_area_change_mat = np.abs(plot_leaf_area_mat - light_refresh_leaf_area_mat)
+        if np.any(leaf_area_change_mat > driver['LIGHT_REFRESH_DRIFT'] * light_refresh_leaf_area_mat):
+            return True
+    return False
+
+
+def compare_light_precision(actual_leaf_area_mat, dem_offset_index_mat, radiation_fraction_mat, arrows_list, xsize,ysize,zsize,
+                            tree_height_matrix, crown_base_matrix, species_code_matrix, number_of_species,
+                            DBH_matrix, partial_growth_factor_matrix, stress_flag_matrix, optimal_growth_increment_matrix,
+                            **light_kwargs):
+    """
+    Compute the light of the same state in float64 and in float32 (see LIGHT_PRECISION in the driver) and measure how
+    much the available light, the light factor of each tree and the growth factor of each tree differ.
+    Nothing in the simulation state is changed (the trees are grown on copies of DBH_matrix and stress_flag_matrix).
+
+    Parameters:  actual_leaf_area_mat    --  the leaf area of this year, in either precision (a float32 leaf area is
+                                             used as is for the float64 light, so only the light pipeline is compared)
+                 dem_offset_index_mat ... zsize  --  as for compute_light
+                 tree_height_matrix ... optimal_growth_increment_matrix  --  as for light_factor_compute and grow_trees
+                 light_kwargs            --  the light engine settings passed on to compute_light
+
+    Returns:     the max and mean absolute differences of the available light, of the tree light factors and of the
+                 growth factors (6 values)
+    """
+    results = []
+    for precision in (np.float64, np.float32):
+        available_light_mat = compute_light(actual_leaf_area_mat.astype(precision), dem_offset_index_mat, radiation_fraction_mat,
+                                            arrows_list, xsize,ysize,zsize, **light_kwargs)
+        _, available_light_spp_factor_matrix = light_factor_compute(available_light_mat, tree_height_matrix, crown_base_matrix,
+                                                                    species_code_matrix, number_of_species)
+        _, _, growth_factor_matrix = grow_trees(DBH_matrix.copy(), species_code_matrix, available_light_spp_factor_matrix,
+                                                partial_growth_factor_matrix, stress_flag_matrix.copy(),
+                                                optimal_growth_increment_matrix, species_code_to_stress_threshold)
+        results.append((available_light_mat, available_light_spp_factor_matrix, growth_factor_matrix))
+
+    report = []
+    for double_mat, single_mat in zip(results[0], results[1]):
+        difference_mat = np.abs(single_mat.astype(np.float64) - double_mat)
+        report += [np.max(difference_mat), np.mean(difference_mat)]
+    return tuple(report)
+
+
 @numba.jit
 def compute_crown_base(DBH_matrix, species_code_matrix, tree_height_matrix, 
                          crown_base_matrix, available_light_mat):
@@ -969,7 +1420,7 @@ def compute_crown_base(DBH_matrix, species_code_matrix, tree_height_matrix,
     return crown_base_matrix
 
 
-def compute_basal_area_by_plot_by_species(basal_area_matrix, species_code_matrix, number_of_species):
+def compute_basal_area_by_plot_by_species(basal_area_matrix, species_code_matrix, number_of_species, workspace=None):
     """
     Computes basal area for each tree in the DBH matrix based on the tree's DBH. 
     The equation is the same for all species. The plumbing is in place to change
@@ -986,12 +1437,13 @@ def compute_basal_area_by_plot_by_species(basal_area_matrix, species_code_matrix
     Parameters:  basal_area_matrix         --  records basal area for every tree in sim, size: sim grid by number of trees on each plot
                  species_code_matrix       -- record the species code for every tree in sim; size: sim grid by number of trees on each plot
                  number_of_species         -- integer number of species in this simulation
+                 workspace                 -- the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
     Returns:     grouped_basal_area_matrix  --  returns a basal area (in square meters) summed up for every species on a plot
                                         size: nx,ny,spp_in_sim
     """
     nx, ny, nind = basal_area_matrix.shape
-    grouped_basal_area_matrix = np.zeros((nx,ny,number_of_species))
+    grouped_basal_area_matrix = workspace_buffer(workspace, 'basal_area_by_species', (nx,ny,number_of_species))
     return compute_basal_area_by_plot_by_species_numba(basal_area_matrix, species_code_matrix, number_of_species, grouped_basal_area_matrix)
 
 @numba.jit(nopython=True)
@@ -1011,7 +1463,7 @@ def compute_basal_area_by_plot_by_species_numba(basal_area_matrix, species_code_
     return grouped_basal_area_matrix
 
 
-def compute_biomass_by_plot_by_species(biomass_matrix, species_code_matrix, number_of_species):
+def compute_biomass_by_plot_by_species(biomass_matrix, species_code_matrix, number_of_species, workspace=None):
     """
     Group biomass by plot and by species. Get rid of the -1 species (-1 is a flag for no tree/no species).
     The result contains only the plot by plot average biomass values for each species present on the plot.
@@ -1019,12 +1471,13 @@ def compute_biomass_by_plot_by_species(biomass_matrix, species_code_matrix, numb
     Parameters:  biomass_matrix          --  records the biomass of each tree in sim, size: sim grid by number of trees on each plot
                  species_code_matrix     --  records the specie of each tree in sim, size: sim grid by number of trees on each plot
                  number_of_species       --  the number of species in the simulation
+                 workspace               --  the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
     Returns:     biomass_matrix          --  returns a biomass (kg) summed up for every species on a plot
                                              size: nx,ny,spp_in_sim
     """
     nx, ny, nind = biomass_matrix.shape
-    grouped_biomass_matrix = np.zeros((nx,ny,number_of_species))
+    grouped_biomass_matrix = workspace_buffer(workspace, 'biomass_by_species', (nx,ny,number_of_species))
     return compute_biomass_by_plot_by_species_numba(biomass_matrix, species_code_matrix, number_of_species, grouped_biomass_matrix)
 
 @numba.jit(nopython=True)
@@ -1044,19 +1497,20 @@ def compute_biomass_by_plot_by_species_numba(biomass_matrix, species_code_matrix
     return grouped_biomass_matrix
 
 
-def compute_stems_by_plot_by_species(DBH_matrix, species_code_matrix, number_of_species):
+def compute_stems_by_plot_by_species(DBH_matrix, species_code_matrix, number_of_species, workspace=None):
     """
     Calculating stem density for stems >=?cm in DBH, for each species in sim, for each plot in sim grid.
 
     Parameters:  DBH_matrix              --  records DBH for every tree in sim, size: sim grid by number of trees on each plot
                  species_code_matrix     --  records the specie of each tree in sim, size: sim grid by number of trees on each plot
                  species_in_sim          --  the number of species in the simulation
+                 workspace               --  the matrices re-used from year to year (see workspace.py), None to allocate a new one
 
     Returns:     DBH_distribution_matrix --  for each plot, count the number of stems >=8cm @ DBH for each species present
                                              size: nx, ny, spp_in_sim
     """
     nx,ny,ntrees = DBH_matrix.shape
-    stems_matrix = np.zeros((nx,ny,number_of_species))
+    stems_matrix = workspace_buffer(workspace, 'stems_by_species', (nx,ny,number_of_species))
     THRESHOLD = 4.  #min DBH in cm used to count stem density
     return compute_stems_by_plot_by_species_numba(DBH_matrix, species_code_matrix, number_of_species, stems_matrix, THRESHOLD)
 
@@ -1105,6 +1559,7 @@ if __name__ == '__main__':
                                      compute_available_light_factors_by_species, \
                                      compute_individual_tree_values, \
                                      compute_actual_leaf_area, \
+                                     compute_tree_values_and_leaf_area, grow_trees_fused, \
                                      number_of_species, species_code_to_name, species_code_to_CP, species_code_to_SEED, \
                                      species_code_to_age_mortality_function, species_code_to_inseeding_lag, name_to_species_code, species_code_to_stress_threshold
     ######################
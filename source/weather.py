@@ -1,10 +1,122 @@
+import hashlib
+import math
+import os
+import shutil
 import numpy as np   # numpy for numerical code (arrays, etc.)
+import numba
 from read_in_ascii import read_in_ascii #from filename import function
 from make_ERDASimg import generate_ERDASimg_grid
 
 #Degree day base for boreal forest photosynthesis 5.0 degrees C
 ddbase = 5.0
 
+#######################################################################
+# days in each month
+DAYS_IN_MONTH_lst = [31,28,31,30,31,30,31,31,30,31,30,31]
+
+@numba.jit(nopython=True)
+def standard_normal_cdf(x):
+    """
+    Probability that a standard normal value is below x.
+    """
+    return 0.5 * math.erfc(-x / math.sqrt(2.))
+
+@numba.jit(nopython=True)
+def standard_normal_quantile(p):
+    """
+    The standard normal value with probability p of being below it: Acklam's rational approximation (relative error
+    below 1.2e-9) refined by one Halley step to full double precision.
+    """
+    if p <= 0.:
+        return -np.inf
+    if p >= 1.:
+        return np.inf
+    P_LOW = 0.02425
+    if p < P_LOW or p > 1. - P_LOW:
+        # the tails
+        q = math.sqrt(-2. * math.log(min(p, 1. - p)))
+        x = (((((-7.784894002430293e-03*q - 3.223964580411365e-01)*q - 2.400758277161838e+00)*q
+               - 2.549671010429519e+00)*q + 4.374664141464968e+00)*q + 2.938163982698783e+00) / \
+            ((((7.784695709041462e-03*q + 3.224671290700398e-01)*q + 2.445134137142996e+00)*q
+              + 3.754408661907416e+00)*q + 1.)
+        if p > 0.5:
+            x = -x
+    else:
+        # the middle
+        q = p - 0.5
+        r = q * q
+        x = (((((-3.969683028665376e+01*r + 2.209460984245205e+02)*r - 2.759285104469687e+02)*r
+               + 1.383577518672690e+02)*r - 3.066479806614716e+01)*r + 2.506628277459239e+00) * q / \
+            (((((-5.447609879822406e+01*r + 1.615858368580409e+02)*r - 1.556989798598866e+02)*r
+               + 6.680131188771972e+01)*r - 1.328068155288572e+01)*r + 1.)
+    e = standard_normal_cdf(x) - p
+    u = e * math.sqrt(2. * math.pi) * math.exp(0.5 * x * x)
+    return x - u / (1. + 0.5 * x * u)
+
+@numba.jit(nopython=True)
+def sample_truncated_normal_numba(mean_vec, std_vec, low_vec, high_vec, uniform_vec, sample_vec):
+    """
+    Turn uniform random numbers into normal random numbers truncated to low..high, by inverting the normal
+    distribution over the probabilities between the bounds. This is the distribution the redraw-until-in-range
+    scheme gives, with one draw per value however tight the bounds are.
+    """
+    for i in range(len(sample_vec)):
+        mean = mean_vec[i]
+        std = std_vec[i]
+        if std <= 0.:
+            sample_vec[i] = min(max(mean, low_vec[i]), high_vec[i])
+            continue
+        a = (low_vec[i] - mean) / std
+        b = (high_vec[i] - mean) / std
+        # bounds in the upper tail are mirrored into the lower tail, where the probabilities are exact
+        flip = a > 0.
+        if flip:
+            a, b = -b, -a
+        cdf_a = standard_normal_cdf(a)
+        cdf_b = standard_normal_cdf(b)
+        z = standard_normal_quantile(cdf_a + uniform_vec[i] * (cdf_b - cdf_a))
+        # rounding could put the value a hair outside the bounds
+        z = min(max(z, a), b)
+        if flip:
+            z = -z
+        sample_vec[i] = mean + std * z
+    return sample_vec
+
+def generate_daily_temperatures_matrix(monthly_temperature_avgs_lst, monthly_temperature_stds_lst,
+                                       monthly_temperature_mins_lst, monthly_temperature_maxs_lst, nyears=1,
+                                       random_state=np.random):
+    """
+    Generate a temperature for each day of nyears years: normal around the monthly average with the monthly standard
+    deviation, truncated to the monthly min and max (see sample_truncated_normal_numba), all in one call.
+
+    Parameters : monthly_temperature_avgs_lst -- 12 monthly averages for temperature each month
+                 monthly_temperature_stds_lst -- 12 monthly standard deviations of the daily temperatures
+                 monthly_temperature_mins_lst -- 12 min temperature values, no day is colder
+                 monthly_temperature_maxs_lst -- 12 max temperature values, no day is warmer
+                                                 (each of these can also be a matrix of 12 values for each year, size: nyears, 12)
+                 nyears -- the number of years to generate
+                 random_state -- where the random numbers come from (np.random.RandomState), default numpy's global one
+    Returns : daily_temperature_mat -- matrix of the temperatures, size: nyears, 12 (MONTH), 31 (DAY)
+                                       (nan past the last day of each month)
+    """
+    NMONTH = 12
+    NDAY = 31
+    # the days of every month that exist, e.g. (1, 28) is the 29th of February and does not
+    day_exists_mat = np.arange(NDAY)[np.newaxis,:] < np.array(DAYS_IN_MONTH_lst)[:,np.newaxis]
+    ndays = np.sum(day_exists_mat)
+    # the statistics of the month of each day of every year
+    month_of_day_vec = np.tile(np.nonzero(day_exists_mat)[0], nyears)
+    year_of_day_vec = np.repeat(np.arange(nyears), ndays)
+    def daily_values(monthly_lst):
+        return np.broadcast_to(np.asarray(monthly_lst, dtype=np.float64), (nyears, NMONTH))[year_of_day_vec, month_of_day_vec]
+    sample_vec = sample_truncated_normal_numba(daily_values(monthly_temperature_avgs_lst), daily_values(monthly_temperature_stds_lst),
+                                               daily_values(monthly_temperature_mins_lst), daily_values(monthly_temperature_maxs_lst),
+                                               random_state.rand(nyears * ndays), np.zeros(nyears * ndays))
+    # start with all nans and then fill in the days that exist
+    daily_temperature_mat = np.zeros((nyears, NMONTH, NDAY)) + np.nan
+    daily_temperature_mat[:, day_exists_mat] = sample_vec.reshape(nyears, ndays)
+    return daily_temperature_mat
+
 #######################################################################
 def GrowingDegreeDays_calc(ddbase, monthly_temperature_avgs_lst, monthly_temperature_stds_lst, 
                            monthly_temperature_mins_lst, monthly_temperature_maxs_lst, lapse_rate_adj_mat):
@@ -27,67 +139,45 @@ def GrowingDegreeDays_calc(ddbase, monthly_temperature_avgs_lst, monthly_tempera
     Returns : GDD_mat -- a numpy matrix of growing degrees accumulated over the entire year for each plot
               monthly_temp_lst -- a list of 12 matrices of monthly temperatures for each plot
     """
-    #### CONSTANTS
-    DAYS_IN_MONTH_lst = [31.,28.,31.,30.,31.,30.,31.,31.,30.,31.,30.,31.]  # days in each month
-    monthly_Tmaxs_vec = np.array(monthly_temperature_maxs_lst)
-    ####
-    def generate_daily_temperatures(month_avg, month_std, num_days):
-        # generate X numbers for a gaussian distribution
-        return month_std * np.random.randn(num_days) + month_avg
-
-    def generate_month_temperature(month_avg, month_std, minT, maxT, month_number):
-        ndays = DAYS_IN_MONTH_lst[month_number]
-        daily_temp_vec = generate_daily_temperatures(month_avg, month_std, ndays)
-        # if any of the daily values are outside of the range of allowed values, pick new numbers
-        # this removes the long tail from the right and left side of the distribution
-        while np.any( daily_temp_vec > maxT ) or np.any( daily_temp_vec < minT ):
-            new_temps_vec = generate_daily_temperatures(month_avg, month_std, ndays)
-            daily_temp_vec[daily_temp_vec > maxT] = new_temps_vec[daily_temp_vec > maxT]
-            daily_temp_vec[daily_temp_vec < minT] = new_temps_vec[daily_temp_vec < minT]
-
-        return daily_temp_vec
-
-    # generate a temperature value for each day of the year, but return them in a matrix (MONTH, DAY)
-    # Note : some of the returned values will be nan due to different number of days in each month
-    def generate_temperatures_matrix(monthly_temperature_avgs_lst, monthly_temperature_stds_lst, 
-                                     monthly_minT_vec,  monthly_maxT_vec):
-        NMONTH = 12
-        NDAY = 31
-        # start with all nans and then we will fill in data as we go
-        daily_temperature_mat = np.zeros((NMONTH, NDAY)) + np.nan
-        month_index = 0
-        for month_avg, month_std, month_minT, month_maxT in zip(monthly_temperature_avgs_lst, monthly_temperature_stds_lst, 
-                                                                monthly_temperature_mins_lst, monthly_temperature_maxs_lst):
-            daily_temp_vec = generate_month_temperature(month_avg, month_std, month_minT, month_maxT, month_index)
-            ndays = DAYS_IN_MONTH_lst[month_index]
-            daily_temperature_mat[month_index,0:ndays] = daily_temp_vec
-            month_index += 1
-        return daily_temperature_mat
-
     # 0) start with the daily temperature values (daily weather for all of geographical grid)
-    daily_temperature_mat = generate_temperatures_matrix(monthly_temperature_avgs_lst, monthly_temperature_stds_lst, 
-                                                         monthly_temperature_mins_lst, monthly_temperature_maxs_lst)
+    daily_temperature_mat = generate_daily_temperatures_matrix(monthly_temperature_avgs_lst, monthly_temperature_stds_lst, 
+                                                               monthly_temperature_mins_lst, monthly_temperature_maxs_lst)[0]
+    return growing_degree_days_from_daily_temperatures(daily_temperature_mat, ddbase, lapse_rate_adj_mat)
+
+
+def growing_degree_days_from_daily_temperatures(daily_temperature_mat, ddbase, lapse_rate_adj_mat):
+    """
+    Compute the growing degree days, monthly temperatures and growing season length of every plot from the daily
+    temperatures of one year (see GrowingDegreeDays_calc).
+
+    Parameters : daily_temperature_mat -- the temperature of each day of the year, size: 12 (MONTH), 31 (DAY), nan past
+                                          the last day of each month (see generate_daily_temperatures_matrix)
+                 ddbase -- degree day base
+                 lapse_rate_adj_mat -- matrix of adjustment values to correct temps based on elev/lapse rate
+    Returns : GDD_mat -- a numpy matrix of growing degrees accumulated over the entire year for each plot
+              monthly_temp_lst -- a list of 12 matrices of monthly temperatures for each plot
+              total_growing_season_mat -- the number of days above ddbase for each plot
+    """
     ## start geographic specific 
     # for each geographic grid location and each day subtract DDBASE and add the lapse rate adjustment
     # 1) add temp to adj_val for each square in geographic grid; 
     # 2) subtract DDBASE (5.5C) for each square in geographic grid; 
     # 3) sum growing degree days for the year
-    nx, ny = lapse_rate_adj_mat.shape
-    GDD_mat = np.zeros((nx, ny))
-    total_growing_season_mat = np.zeros((nx, ny))
-    for x in range(nx):
-        for y in range(ny):
-            lapse_rate_adj = lapse_rate_adj_mat[x,y]
-            growing_degree_mat = daily_temperature_mat - ddbase + lapse_rate_adj
-            # every day that is below 0 set to 0
-            growing_degree_mat[np.less(growing_degree_mat, 0)] = 0.
-            # compute the growing degree days for the year
-            growing_degree_days = np.nansum(growing_degree_mat)
-            # compute the growing season length as the number of days that have a temperature above DDBASE
-            growing_season_ndays = np.sum( np.greater(growing_degree_mat, 0) )
-            # store the growing degree days value for this geographic grid point
-            GDD_mat[x,y] = growing_degree_days
-            total_growing_season_mat[x,y] = growing_season_ndays
+    # Only the lapse rate adjustment differs from plot to plot, so the daily temperatures are sorted once: a plot grows on
+    # every day warmer than DDBASE - lapse_rate_adj, which are the days after the first n_cold days of the sorted year, and
+    # its growing degree days are the sum of those days (a suffix sum) plus (lapse_rate_adj - DDBASE) for each of them.
+    # This looks up every plot of the grid at once instead of summing the whole year for each plot.
+    sorted_daily_temperature_vec = np.sort(daily_temperature_mat[~np.isnan(daily_temperature_mat)])
+    ndays = len(sorted_daily_temperature_vec)
+    # warm_sum_vec[n_cold] is the sum of the temperatures of all days after the n_cold coldest days
+    warm_sum_vec = np.zeros(ndays + 1)
+    warm_sum_vec[:ndays] = np.cumsum(sorted_daily_temperature_vec[::-1])[::-1]
+    # the number of days that are not above DDBASE (growing degrees of 0) for each plot
+    n_cold_mat = np.searchsorted(sorted_daily_temperature_vec, ddbase - lapse_rate_adj_mat, side='right')
+    # compute the growing season length as the number of days that have a temperature above DDBASE
+    total_growing_season_mat = np.array(ndays - n_cold_mat, dtype=np.float64)
+    # compute the growing degree days for the year
+    GDD_mat = warm_sum_vec[n_cold_mat] + total_growing_season_mat * (lapse_rate_adj_mat - ddbase)
 
     # build up a list by month where each value in the list is a 2D matrix that hold the adjusted month temperature for
     # each point on the geographic grid
@@ -236,18 +326,32 @@ def rain_sim(rainfall_monthly_avgs, rainfall_monthly_stds):
 
     Returns : rainfall_vec -- a list of 12 simulated monthly rainfall values for this year of sim
     """
+    monthly_sim_rain_vec = simulate_monthly_rain(rainfall_monthly_avgs, rainfall_monthly_stds)[0]
+    print "annual rain: ", np.sum(monthly_sim_rain_vec)
+    return monthly_sim_rain_vec
+
+
+def simulate_monthly_rain(rainfall_monthly_avgs, rainfall_monthly_stds, nyears=1, random_state=np.random):
+    """
+    Simulate the monthly rainfall of nyears years at once (see rain_sim).
+
+    Parameters: rainfall_monthly_avgs -- 12 monthly averages for rainfall, or 12 for each year (size: nyears, 12)
+                rainfall_monthly_stds -- 12 monthly standard deviations for rainfall, or 12 for each year
+                nyears -- the number of years to simulate
+                random_state -- where the random numbers come from (np.random.RandomState), default numpy's global one
+
+    Returns : monthly_sim_rain_mat -- the simulated rainfall of each month of each year, size: nyears, 12
+    """
     # store the monthly rainfall statistics
-    mean_rain_by_month_vec = np.array(rainfall_monthly_avgs)
-    std_rain_by_month_vec = np.array(rainfall_monthly_stds)
-    normal_randn_vec = np.random.randn(12)  # get 12 random numbers with zero mean and std=1
-    monthly_sim_rain_vec = mean_rain_by_month_vec + std_rain_by_month_vec * normal_randn_vec
-    monthly_sim_rain_vec[monthly_sim_rain_vec<0] = 0
+    mean_rain_by_month_mat = np.broadcast_to(np.asarray(rainfall_monthly_avgs, dtype=np.float64), (nyears, 12))
+    std_rain_by_month_mat = np.broadcast_to(np.asarray(rainfall_monthly_stds, dtype=np.float64), (nyears, 12))
+    normal_randn_mat = random_state.randn(nyears, 12)  # get 12 random numbers a year with zero mean and std=1
+    monthly_sim_rain_mat = mean_rain_by_month_mat + std_rain_by_month_mat * normal_randn_mat
+    monthly_sim_rain_mat[monthly_sim_rain_mat<0] = 0
     # precipitation is always underestimated due to loss due to winds. According to Bonan, increase the observed rain by 10% (for Alaska boreal)
     # (maybe more for Siberia?) to better represent simulated rain:
-    monthly_sim_rain_vec = monthly_sim_rain_vec * 1.1
-
-    print "annual rain: ", np.sum(monthly_sim_rain_vec)
-    return monthly_sim_rain_vec
+    monthly_sim_rain_mat = monthly_sim_rain_mat * 1.1
+    return monthly_sim_rain_mat
 
 
 
@@ -271,7 +375,51 @@ def soil_moisture(monthly_sim_rain, PET_mat, last_months_soil_water_mat, field_c
     return soil_moisture_mat
 
 
-def drydays(total_growing_season_mat, soil_moisture_mat, wilting_point, monthly_temp_mat_lst, radiation_mat_lst, field_capacity, monthly_sim_rain_vec, ddbase):
+@numba.jit(nopython=True)
+def soil_water_month_numba(soil_moisture_mat, dry_days_mat, monthly_temp_mat, rad_raster_mat,
+                           monthly_sim_rain, field_capacity, wilting_point, ddbase, days_this_month):
+    """
+    One month of PET (see PET, scaled down to AET), soil water (see soil_moisture) and drought days for every plot,
+    updating soil_moisture_mat and dry_days_mat in place. The arithmetic is the same as those functions, without
+    making any new matrices (and monthly_temp_mat is not changed).
+    """
+    nx, ny = soil_moisture_mat.shape
+    for x in range(nx):
+        for y in range(ny):
+            monthly_temp = monthly_temp_mat[x,y]
+            if monthly_temp <= 0:
+                monthly_temp = -3. #this will result in PET=0 for temps <=0C, at which PET should not be occuring
+            total_energy = rad_raster_mat[x,y] * 3600
+            PET = 0.7 * ((0.025 * (monthly_temp + 3.0) * (total_energy))/(2430.0*10000.0))
+            soil_moisture = (soil_moisture_mat[x,y] + monthly_sim_rain) - PET
+            if soil_moisture > field_capacity:
+                soil_moisture = field_capacity  #the excess runs off
+            if soil_moisture < (wilting_point - 5.):
+                soil_moisture = wilting_point - 5. #so soil water can still recharge over the winter
+            soil_moisture_mat[x,y] = soil_moisture
+            # drought: less soil water than wilting point within the growing season
+            if soil_moisture <= wilting_point and monthly_temp >= ddbase:
+                dry_days_mat[x,y] += days_this_month
+
+@numba.jit(nopython=True)
+def growing_season_fraction_numba(dry_days_mat, total_growing_season_mat):
+    """
+    Divide the dry days of every plot by its growing season length in place, giving nan (no dry days) or inf like
+    numpy does for plots without a growing season.
+    """
+    nx, ny = dry_days_mat.shape
+    for x in range(nx):
+        for y in range(ny):
+            if total_growing_season_mat[x,y] != 0:
+                dry_days_mat[x,y] = dry_days_mat[x,y] / total_growing_season_mat[x,y]
+            elif dry_days_mat[x,y] == 0:
+                dry_days_mat[x,y] = np.nan
+            else:
+                dry_days_mat[x,y] = np.inf
+    return dry_days_mat
+
+def drydays(total_growing_season_mat, soil_moisture_mat, wilting_point, monthly_temp_mat_lst, radiation_mat_lst, field_capacity, monthly_sim_rain_vec, ddbase,
+            out_soil_moisture_mat=None, out_drydays_fraction_mat=None):
     """
     Take growing season length and soil moisture=f(FC,rain,lastmonthssoilmoist,PET{T&radiation})
     and compute the fraction of dry days within the growing season
@@ -284,30 +432,186 @@ def drydays(total_growing_season_mat, soil_moisture_mat, wilting_point, monthly_
                 field_capacity -- specified in driver, soil moisture in excess of this is considered runoff
                 monthly_sim_rain_vec -- list of monthly precip (each plot in simulated area is considered to receive same amount of precip, due to how small the 
                                         simulated area is)
+                out_soil_moisture_mat, out_drydays_fraction_mat -- optional matrices the size of the grid to return the results in
+                                        (out_soil_moisture_mat can be soil_moisture_mat), new matrices are made if None
 
     Returns: soil_moisture_mat = december's soil moisture from this year to be used to initiate the soil moisture computation next year
              drydays_fraction_mat =  = a fraction of growing season spent in drought this year (0 to 1)
     """
-    days_this_month_lst = [31.,28.,31.,30.,31.,30.,31.,31.,30.,31.,30.,31.]  # days in each month    
-    dry_days_accumulator_mat = np.zeros(total_growing_season_mat.shape)
+    nx, ny = total_growing_season_mat.shape
+    if out_soil_moisture_mat is None:
+        out_soil_moisture_mat = np.empty((nx, ny))
+    if out_drydays_fraction_mat is None:
+        out_drydays_fraction_mat = np.empty((nx, ny))
+    # the first year starts from a single soil water value (field capacity) for all plots
+    out_soil_moisture_mat[...] = soil_moisture_mat
+    soil_moisture_mat = out_soil_moisture_mat
+    # the dry days are tallied in the output matrix, then turned into a fraction of the growing season
+    dry_days_accumulator_mat = out_drydays_fraction_mat
+    dry_days_accumulator_mat[...] = 0.
     for month in range(12):
-        PET_mat = PET(monthly_temp_mat = monthly_temp_mat_lst[month], rad_raster_mat = radiation_mat_lst[month])
-        # since actual evapotranspiration (AET) is about 70% of PET, scale down the computed PET:
-        PET_mat = 0.7 * PET_mat
-        soil_moisture_mat = soil_moisture(monthly_sim_rain = monthly_sim_rain_vec[month], PET_mat = PET_mat, 
-                                          last_months_soil_water_mat = soil_moisture_mat, 
-                                          field_capacity = field_capacity, wilting_point = wilting_point)
-        boolean_drought_mat = np.where(((soil_moisture_mat<=wilting_point) & (monthly_temp_mat_lst[month]>=ddbase)),1,0) #assigns 0 to every plot where there is less soil water than wilting point and within growing season
-        drought_this_month_mat = boolean_drought_mat * days_this_month_lst[month] # number of days in dought
-        dry_days_accumulator_mat = dry_days_accumulator_mat + drought_this_month_mat #tallies drought days this year for each plot
-#        print "PET monthly sum for all plots:  ", PET_mat.sum(), "monthly rain summed up over all plots:  ", monthly_sim_rain_vec[month]*900.
-    drydays_fraction_mat = dry_days_accumulator_mat/total_growing_season_mat
+        # PET, soil water and drought days of every plot in one pass over the grid (see soil_water_month_numba)
+        soil_water_month_numba(soil_moisture_mat, dry_days_accumulator_mat, monthly_temp_mat_lst[month], radiation_mat_lst[month],
+                               float(monthly_sim_rain_vec[month]), float(field_capacity), float(wilting_point), float(ddbase),
+                               float(DAYS_IN_MONTH_lst[month]))
+    drydays_fraction_mat = growing_season_fraction_numba(dry_days_accumulator_mat, total_growing_season_mat)
         
 #    print "rain:  ", monthly_sim_rain_vec
 #    print "dry days fraction:  ", drydays_fraction_mat
     return soil_moisture_mat, drydays_fraction_mat
 
 
+######################################################################################################
+# The growing degree days, soil water and dry days of a plot only depend on its lapse rate adjustment and its 12 monthly
+# radiation values (the daily temperatures and rain are the same for the whole grid, and the soil water starts at field
+# capacity everywhere), so plots with the same values always have the same weather. On flat or gently varying DEMs many
+# plots share these values, and the weather is computed once for each of these "plot classes" instead of for each plot.
+def find_weather_plot_classes(lapse_rate_adj_mat, radiation_mat_lst):
+    """
+    Group the plots with the same lapse rate adjustment and monthly radiation into plot classes.
+
+    Parameters : lapse_rate_adj_mat -- matrix of adjustment values to correct temps based on elev/lapse rate
+                 radiation_mat_lst -- list of matrices of monthly cumulative incident radiation for each plot
+    Returns : plot_classes -- dictionary of
+                              'class_index' -- the plot class of each plot, size: nx, ny
+                              'plot_x', 'plot_y' -- a plot of each class, size: nclasses
+                              'lapse_rate_adj' -- the lapse rate adjustment of each class, size: nclasses, 1
+                              'radiation_mat_lst' -- list of the monthly radiation of each class, each of size: nclasses, 1
+    """
+    nx, ny = lapse_rate_adj_mat.shape
+    plot_inputs_mat = np.column_stack([np.ravel(lapse_rate_adj_mat)] + [np.ravel(radiation_mat) for radiation_mat in radiation_mat_lst])
+    plot_inputs_mat = np.asarray(plot_inputs_mat, dtype=np.float64)
+    unique_inputs_mat, first_plot_vec, class_index_vec = np.unique(plot_inputs_mat, axis=0, return_index=True, return_inverse=True)
+    plot_classes = dict(class_index=class_index_vec.reshape(nx, ny),
+                        plot_x=first_plot_vec // ny,
+                        plot_y=first_plot_vec % ny)
+    plot_classes['lapse_rate_adj'] = compress_plots(lapse_rate_adj_mat, plot_classes)
+    plot_classes['radiation_mat_lst'] = [compress_plots(radiation_mat, plot_classes) for radiation_mat in radiation_mat_lst]
+    return plot_classes
+
+def compress_plots(plot_mat, plot_classes):
+    """
+    The values of a plot of each class: size nx, ny, ... becomes nclasses, 1, ... (a grid one plot wide)
+    """
+    return plot_mat[plot_classes['plot_x'], plot_classes['plot_y']][:, np.newaxis]
+
+def expand_plots(class_mat, plot_classes):
+    """
+    The values of each plot from the values of its class: size nclasses, 1, ... becomes nx, ny, ...
+    """
+    return class_mat[:, 0][plot_classes['class_index']]
+
+######################################################################################################
+# the weather of every year of a simulation can be generated up front as a "weather stream", which only depends on
+# the weather function, the random seed and the grid, so replicate and scenario runs sharing a climate can re-use it
+WEATHER_STREAM_FIELDS = ('monthly_temperature',   # size: nyears, 12, the monthly average temperature before the lapse rate adjustment
+                         'monthly_rain',          # size: nyears, 12
+                         'GDD',                   # size: nyears, nx, ny
+                         'drydays_fraction',      # size: nyears, nx, ny
+                         'soil_water')            # size: nyears, nx, ny, the soil water at the end of the year
+
+def generate_weather_stream(weather_function, years, ddbase, monthly_temperature_mins_lst, monthly_temperature_maxs_lst,
+                            lapse_rate_adj_mat, radiation_mat_lst, field_capacity, wilting_point, initial_soil_water_mat, seed):
+    """
+    Generate the weather of all of the simulation years: the daily temperatures and monthly rain of all years are drawn
+    in one batch each from a random number generator of their own (so the weather does not depend on the random numbers
+    used by the rest of the simulation), then the growing degree days and dry days of every plot are computed year by
+    year (the soil water carries over from one year to the next).
+
+    Parameters : weather_function -- returns the monthly temperature averages and stds and rain averages and stds of a year
+                                     (return_annual_weather_function in the driver)
+                 years -- the simulation years
+                 seed -- the seed of the weather random numbers
+                 see GrowingDegreeDays_calc and drydays for the others
+    Returns : weather_stream -- dictionary of the WEATHER_STREAM_FIELDS matrices
+    """
+    random_state = np.random.RandomState(seed)
+    nyears = len(years)
+    temperature_avg_mat, temperature_std_mat, rain_avg_mat, rain_std_mat = \
+        [np.array(stats, dtype=np.float64) for stats in zip(*[weather_function(year) for year in years])]
+    daily_temperature_mat = generate_daily_temperatures_matrix(temperature_avg_mat, temperature_std_mat,
+                                                               monthly_temperature_mins_lst, monthly_temperature_maxs_lst,
+                                                               nyears=nyears, random_state=random_state)
+    monthly_sim_rain_mat = simulate_monthly_rain(rain_avg_mat, rain_std_mat, nyears=nyears, random_state=random_state)
+
+    nx, ny = lapse_rate_adj_mat.shape
+    weather_stream = dict(monthly_temperature=np.nanmean(daily_temperature_mat, axis=2),
+                          monthly_rain=monthly_sim_rain_mat,
+                          GDD=np.zeros((nyears, nx, ny)),
+                          drydays_fraction=np.zeros((nyears, nx, ny)),
+                          soil_water=np.zeros((nyears, nx, ny)))
+    soil_moisture_mat = initial_soil_water_mat
+    for y in range(nyears):
+        GDD_mat, monthly_temp_mat_lst, \
+        total_growing_season_mat = growing_degree_days_from_daily_temperatures(daily_temperature_mat[y], ddbase, lapse_rate_adj_mat)
+        soil_moisture_mat, \
+        drydays_fraction_mat = drydays(total_growing_season_mat = total_growing_season_mat, soil_moisture_mat = soil_moisture_mat,
+                                       wilting_point = wilting_point, monthly_temp_mat_lst = monthly_temp_mat_lst,
+                                       radiation_mat_lst = radiation_mat_lst, field_capacity = field_capacity,
+                                       monthly_sim_rain_vec = monthly_sim_rain_mat[y], ddbase = ddbase)
+        weather_stream['GDD'][y] = GDD_mat
+        weather_stream['drydays_fraction'][y] = drydays_fraction_mat
+        weather_stream['soil_water'][y] = soil_moisture_mat
+    return weather_stream
+
+def load_or_generate_weather_stream(weather_function, years, ddbase, monthly_temperature_mins_lst, monthly_temperature_maxs_lst,
+                                    lapse_rate_adj_mat, radiation_mat_lst, field_capacity, wilting_point, initial_soil_water_mat,
+                                    seed, cache_dir=None):
+    """
+    Get the weather stream of all of the simulation years (see generate_weather_stream). When a cache folder is given, the
+    stream is stored there as one .npy file per field, and any later run with the same weather function, seed and grid
+    memory-maps those files instead of generating the weather again.
+
+    Parameters : cache_dir -- folder in which to store/look up the weather streams, None means do not cache
+                 see generate_weather_stream for the others
+    Returns : weather_stream -- dictionary of the WEATHER_STREAM_FIELDS matrices (read-only memory maps when cached)
+    """
+    stream_args = (weather_function, years, ddbase, monthly_temperature_mins_lst, monthly_temperature_maxs_lst,
+                   lapse_rate_adj_mat, radiation_mat_lst, field_capacity, wilting_point, initial_soil_water_mat, seed)
+    if cache_dir is None:
+        return generate_weather_stream(*stream_args)
+
+    # the cache folder name is a checksum of everything the weather depends on: the weather function (by name and by the
+    # statistics it returns for every year, so a changed climate scenario is never mistaken for the cached one), the seed and the grid
+    key = hashlib.sha1()
+    key.update('%s.%s' % (weather_function.__module__, weather_function.__name__))
+    key.update(np.array([weather_function(year) for year in years], dtype=np.float64).tostring())
+    key.update(str((list(years), ddbase, list(monthly_temperature_mins_lst), list(monthly_temperature_maxs_lst),
+                    field_capacity, wilting_point, seed, lapse_rate_adj_mat.shape)))
+    key.update(np.ascontiguousarray(lapse_rate_adj_mat, dtype=np.float64).tostring())
+    for radiation_mat in radiation_mat_lst:
+        key.update(np.ascontiguousarray(radiation_mat, dtype=np.float64).tostring())
+    key.update(np.ascontiguousarray(initial_soil_water_mat, dtype=np.float64).tostring())
+    stream_dir = os.path.join(cache_dir, 'weather_stream_%s' % key.hexdigest())
+    if not os.path.isdir(stream_dir):
+        weather_stream = generate_weather_stream(*stream_args)
+        # write to a temporary folder first, so a replicate starting at the same time never reads a partial stream
+        tmp_dir = '%s.%d.tmp' % (stream_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        for field in WEATHER_STREAM_FIELDS:
+            np.save(os.path.join(tmp_dir, '%s.npy' % field), weather_stream[field])
+        try:
+            os.rename(tmp_dir, stream_dir)
+            print 'Info :: Saved weather stream to %s' % stream_dir
+        except OSError:
+            # another run saved the same stream first
+            shutil.rmtree(tmp_dir)
+    else:
+        print 'Info :: Loaded weather stream from %s' % stream_dir
+    return dict((field, np.load(os.path.join(stream_dir, '%s.npy' % field), mmap_mode='r')) for field in WEATHER_STREAM_FIELDS)
+
+def weather_stream_year(weather_stream, year_index, lapse_rate_adj_mat):
+    """
+    The weather of one year of the weather stream, as returned by sibbork.generate_weather.
+
+    Parameters : year_index -- the number of years since the first year of the stream
+    Returns : monthly_temp_mat_lst, soil_moisture_mat, GDD_matrix, drydays_fraction_mat
+    """
+    monthly_temp_mat_lst = [weather_stream['monthly_temperature'][year_index, month] + lapse_rate_adj_mat for month in range(12)]
+    return monthly_temp_mat_lst, np.array(weather_stream['soil_water'][year_index]), \
+           np.array(weather_stream['GDD'][year_index]), np.array(weather_stream['drydays_fraction'][year_index])
+
+
 ######################################################################################################
 
 #if __name__ == '__main__':
@@ -0,0 +1,71 @@
+"""
+The workspace of the yearly simulation: preallocated matrices for the values that are computed again every year
+(the values of each tree, the leaf area, the light, soil and growth factors, the sums by species, ...).
+
+The workspace is a dictionary of named matrices created once in initialization (see create_workspace) and passed to
+the functions of the yearly loop, which write their results into these matrices instead of allocating new ones, so a
+year allocates (almost) nothing once the simulation is running and the memory of a large grid is known at the start.
+The results of a function given a workspace are only valid until the same function is called again the next year:
+anything that has to be kept from one year to the next is copied (the HDF output copies the matrices it stores).
+"""
+import numpy as np
+
+
+def create_workspace(nx, ny, ntrees, number_of_species, max_tree_height, light_dtype):
+    """
+    Allocate the matrices of the workspace.
+
+    Parameters: nx, ny -- the size of the simulation grid
+                ntrees -- the maximum number of trees on a plot (MAX_TREES_PER_PLOT in the driver)
+                number_of_species -- the number of species in the simulation
+                max_tree_height -- the height of the actual leaf area and available light columns (MAX_TREE_HEIGHT in the driver)
+                light_dtype -- the precision of the leaf area, available light and light factor matrices (LIGHT_PRECISION)
+
+    Returns: workspace -- dictionary of matrices by name
+    """
+    workspace = {}
+    # the values of each tree, size: nx,ny,ntrees
+    for name in ('tree_height', 'total_leaf_area', 'biomass', 'optimal_growth_increment', 'optimal_biomass', 'basal_area',
+                 'biovolume', 'optimal_biovolume', 'optimal_biovolume_increment', 'likely_biovolume_increment',
+                 'tree_light_factor', 'growth_factor', 'age_mortality_probability'):
+        workspace[name] = np.zeros((nx,ny,ntrees))
+    # the values of each species on each plot, size: nx,ny,nspp
+    for name in ('ground_light_factor', 'soil_fertility_factor', 'permafrost_factor', 'partial_growth_factor',
+                 'sprout_factor', 'basal_area_by_species', 'biomass_by_species', 'stems_by_species'):
+        workspace[name] = np.zeros((nx,ny,number_of_species))
+    # the values of each plot, size: nx,ny
+    workspace['relative_soil_fertility'] = np.zeros((nx,ny))
+    # the leaf area of each plot column, its total, and the total when the light was last computed
+    workspace['actual_leaf_area'] = np.zeros((nx,ny,max_tree_height), dtype=light_dtype)
+    workspace['plot_leaf_area'] = np.zeros((nx,ny), dtype=light_dtype)
+    workspace['light_refresh_leaf_area'] = np.zeros((nx,ny), dtype=light_dtype)
+    # the available light of each plot column (kept until the light is computed again, see LIGHT_REFRESH_YEARS)
+    workspace['available_light'] = np.zeros((nx,ny,max_tree_height), dtype=light_dtype)
+    # the light factors by height and by species of each plot column
+    workspace['light_factor_by_species'] = np.zeros((nx,ny,max_tree_height,number_of_species), dtype=light_dtype)
+
+    return workspace
+
+
+def workspace_buffer(workspace, name, shape, dtype=np.float64, zero=False):
+    """
+    Return the matrix called name from the workspace, or a new matrix of zeros if there is no workspace. A matrix of
+    another shape or dtype than asked for (e.g. available light columns of another height) is replaced
+    by a new one, which is kept in the workspace for the next years.
+
+    Parameters: workspace -- the workspace (see create_workspace), None to allocate a new matrix
+                name -- the name of the matrix in the workspace
+                shape, dtype -- the shape and dtype of the matrix
+                zero -- True to set the matrix to 0 (for results that are summed up), False when every value is written
+
+    Returns: the matrix
+    """
+    if workspace is None:
+        return np.zeros(shape, dtype=dtype)
+    buffer = workspace.get(name)
+    if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+        buffer = np.zeros(shape, dtype=dtype)
+        workspace[name] = buffer
+    elif zero:
+        buffer.fill(0)
+    return buffer